@@ -36,6 +36,9 @@ import sys
 
 script_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(script_path)
+sys.path.append(f"{dirname(script_path)}/source/slurm_installer")
+
+from security_group_rules import SecurityGroupRules
 
 logger = logging.getLogger(__file__)
 logger_formatter = logging.Formatter('%(levelname)s: %(message)s')
@@ -45,6 +48,26 @@ logger.addHandler(logger_streamHandler)
 logger.propagate = False
 logger.setLevel(logging.INFO)
 
+NFS_PORTS = [('tcp', 2049, 2049)]
+LUSTRE_PORTS = [('tcp', 988, 988), ('tcp', 1018, 1023)]
+ONTAP_PORTS = [(protocol, port, port) for port in [111, 635, 2049, 4045, 4046] for protocol in ['tcp', 'udp']]
+ZFS_PORTS = [(protocol, from_port, to_port) for (from_port, to_port) in [(111, 111), (2049, 2049), (20001, 20003)] for protocol in ['tcp', 'udp']]
+
+# Traffic that the cluster needs: (source security groups, destination security groups, ports, description)
+FSX_CLIENT_SGS = ['SlurmLoginNodeSG', 'SlurmHeadNodeSG', 'SlurmComputeNodeSG']
+REQUIRED_TRAFFIC = [
+    (['SlurmComputeNodeSG'], ['SlurmHeadNodeSG'], NFS_PORTS, "NFS"),
+    (['SlurmHeadNodeSG', 'SlurmComputeNodeSG'], ['SlurmLoginNodeSG'], [('tcp', 1024, 65535)], "ephemeral"),
+    (['SlurmLoginNodeSG'], ['SlurmHeadNodeSG'], NFS_PORTS, "NFS"),
+    (['SlurmLoginNodeSG'], ['SlurmComputeNodeSG'], [('tcp', 6818, 6818)], "slurmd"),
+    (['SlurmLoginNodeSG'], ['SlurmHeadNodeSG', 'SlurmdbdSG'], [('tcp', 6819, 6819)], "slurmdbd"),
+    (['SlurmLoginNodeSG'], ['SlurmHeadNodeSG'], [('tcp', 6820, 6829)], "slurmctld"),
+    (['SlurmLoginNodeSG'], ['SlurmHeadNodeSG'], [('tcp', 6830, 6830)], "slurmrestd"),
+    (FSX_CLIENT_SGS + ['SlurmFsxLustreSG', 'ExistingFsxLustreSG'], ['SlurmFsxLustreSG', 'ExistingFsxLustreSG'], LUSTRE_PORTS, "lustre"),
+    (FSX_CLIENT_SGS, ['SlurmFsxOntapSG', 'ExistingFsxOntapSG'], ONTAP_PORTS, "FSx Ontap NFS"),
+    (FSX_CLIENT_SGS, ['SlurmFsxZfsSG', 'ExistingFsxZfsSG'], ZFS_PORTS, "FSx OpenZfs NFS"),
+]
+
 class CreateSlurmSecurityGroups():
 
     def __init__(self):
@@ -62,6 +85,7 @@ class CreateSlurmSecurityGroups():
         parser.add_argument("--fsxz-security-group-id", type=str, help="Id of security group attached to FSx for OpenZfs file systems.")
         parser.add_argument("--cdk-cmd", type=str, choices=["deploy", "create", "update", "diff", "ls", "list", "synth", "synthesize", "destroy", "bootstrap"], default="create")
         parser.add_argument("--min-pc-version", type=str, default="3.12.0", help="Minimum version of ParallelCluster being used. Used to control security group rules required by PC.")
+        parser.add_argument("--validate", action='store_true', default=False, help="Check that the security groups in the stack allow the traffic that the cluster needs.")
         parser.add_argument("--debug", action='store_const', const=True, default=False, help="Enable CDK debug mode")
         args = parser.parse_args()
 
@@ -186,6 +210,52 @@ class CreateSlurmSecurityGroups():
             # synth, ls etc ..
             pass
 
+        if args.validate and args.cdk_cmd != 'destroy':
+            if not self.validate_security_groups(args.region, args.stack_name):
+                sys.exit(1)
+
+    def validate_security_groups(self, region, stack_name):
+        '''
+        Check that the security groups created by the stack allow the traffic that the cluster needs.
+
+        Returns:
+            True if all of the required traffic is allowed.
+        '''
+        logger.info("\n====== Validating security groups ======\n")
+        cfn_client = boto3.client("cloudformation", region_name=region)
+        try:
+            stack_dict = cfn_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+        except ClientError:
+            logger.error(f"{fg('red')}{stack_name} stack not found.{attr('reset')}")
+            return False
+        security_group_ids = {}
+        for output in stack_dict.get('Outputs', []):
+            if output['OutputKey'].endswith('SGId'):
+                security_group_ids[output['OutputKey'][0:-2]] = output['OutputValue']
+        ec2_client = boto3.client("ec2", region_name=region)
+        security_groups = ec2_client.describe_security_groups(GroupIds=sorted(set(security_group_ids.values())))['SecurityGroups']
+        sg_rules = SecurityGroupRules(security_groups)
+
+        num_errors = 0
+        for source_sg_names, destination_sg_names, ports, description in REQUIRED_TRAFFIC:
+            for source_sg_name in source_sg_names:
+                if source_sg_name not in security_group_ids:
+                    continue
+                for destination_sg_name in destination_sg_names:
+                    if destination_sg_name not in security_group_ids:
+                        continue
+                    for protocol, from_port, to_port in ports:
+                        if sg_rules.can_reach(security_group_ids[source_sg_name], security_group_ids[destination_sg_name], protocol, from_port, to_port):
+                            logger.debug(f"{source_sg_name} can reach {destination_sg_name} on {protocol} {from_port}-{to_port} ({description})")
+                        else:
+                            logger.error(f"{fg('red')}{source_sg_name} can't reach {destination_sg_name} on {protocol} {from_port}-{to_port} ({description}){attr('reset')}")
+                            num_errors += 1
+        if num_errors:
+            logger.error(f"{fg('red')}{num_errors} required security group rules are missing.{attr('reset')}")
+            return False
+        logger.info(f"{fg('green')}Security groups allow all of the required traffic.{attr('reset')}")
+        return True
+
 if __name__ == "__main__":
     app = CreateSlurmSecurityGroups()
     app.main()
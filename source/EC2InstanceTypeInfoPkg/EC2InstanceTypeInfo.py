@@ -21,6 +21,7 @@ import boto3
 from botocore.exceptions import ClientError
 import csv
 from datetime import datetime
+from EC2InstanceTypeInfoPkg.check_instance_type_info import check_instance_type_and_family_info
 from EC2InstanceTypeInfoPkg.get_savings_plans import SavingsPlanInfo
 from EC2InstanceTypeInfoPkg.retry_boto3_throttling import retry_boto3_throttling
 import json
@@ -375,37 +376,7 @@ class EC2InstanceTypeInfo:
         '''
         Raises KeyError
         '''
-        for region, region_dict in self.instance_type_and_family_info.items():
-            for instance_type, instance_type_dict in region_dict['instance_types'].items():
-                try:
-                    assert 'architecture' in instance_type_dict
-                    assert 'SustainedClockSpeedInGhz' in instance_type_dict
-                    assert 'SustainedClockSpeedInGhz' in instance_type_dict
-                    assert 'DefaultVCpus' in instance_type_dict
-                    assert 'DefaultCores' in instance_type_dict
-                    assert 'DefaultThreadsPerCore' in instance_type_dict
-                    assert 'ValidThreadsPerCore' in instance_type_dict
-                    assert 'DefaultThreadsPerCore' in instance_type_dict
-                    assert 'MemoryInMiB' in instance_type_dict
-                    assert 'SSDCount' in instance_type_dict
-                    assert 'SSDTotalSizeGB' in instance_type_dict
-                    assert 'Hypervisor' in instance_type_dict
-                    assert 'NetworkPerformance' in instance_type_dict
-                    if 'pricing' in instance_type_dict:
-                        assert 'ComputeSavingsPlan' in instance_type_dict['pricing']
-                except:
-                    logger.error(f"{instance_type} instance type missing data:\n{json.dumps(instance_type_dict, indent=4)}")
-                    raise
-            for instance_family, instance_family_dict in region_dict['instance_families'].items():
-                try:
-                    assert 'instance_types' in instance_family_dict
-                    assert 'architecture' in instance_family_dict
-                    assert 'MaxCoreCount' in instance_family_dict
-                    assert 'MaxInstanceType' in instance_family_dict
-                    assert 'MaxInstanceSize' in instance_family_dict
-                except:
-                    logger.error(f"{instance_family} family missing data:\n{json.dumps(instance_family_dict, indent=4)}")
-                    raise
+        check_instance_type_and_family_info(self.instance_type_and_family_info)
 
     def print_csv(self, filename=""):
         if filename:
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+Check the format of cached instance type and family info.
+
+Kept separate from EC2InstanceTypeInfo so that it can be used without importing boto3.
+"""
+
+import json
+import logging
+
+logger = logging.getLogger(__file__)
+
+INSTANCE_TYPE_KEYS = [
+    'architecture',
+    'SustainedClockSpeedInGhz',
+    'DefaultVCpus',
+    'DefaultCores',
+    'DefaultThreadsPerCore',
+    'ValidThreadsPerCore',
+    'MemoryInMiB',
+    'SSDCount',
+    'SSDTotalSizeGB',
+    'Hypervisor',
+    'NetworkPerformance',
+]
+
+INSTANCE_FAMILY_KEYS = [
+    'instance_types',
+    'architecture',
+    'MaxCoreCount',
+    'MaxInstanceType',
+    'MaxInstanceSize',
+]
+
+def check_instance_type_and_family_info(instance_type_and_family_info):
+    '''
+    Check that the info has the current format.
+
+    Raises KeyError
+    '''
+    for region, region_dict in instance_type_and_family_info.items():
+        for required_key in ['instance_types', 'instance_families']:
+            if required_key not in region_dict:
+                logger.error(f"{region} missing {required_key}")
+                raise KeyError(f"{region} missing {required_key}")
+        for instance_type, instance_type_dict in region_dict['instance_types'].items():
+            missing_keys = [key for key in INSTANCE_TYPE_KEYS if key not in instance_type_dict]
+            if 'pricing' in instance_type_dict and 'ComputeSavingsPlan' not in instance_type_dict['pricing']:
+                missing_keys.append('pricing.ComputeSavingsPlan')
+            if missing_keys:
+                logger.error(f"{instance_type} instance type missing data:\n{json.dumps(instance_type_dict, indent=4)}")
+                raise KeyError(f"{instance_type} instance type missing {missing_keys}")
+        for instance_family, instance_family_dict in region_dict['instance_families'].items():
+            missing_keys = [key for key in INSTANCE_FAMILY_KEYS if key not in instance_family_dict]
+            if missing_keys:
+                logger.error(f"{instance_family} family missing data:\n{json.dumps(instance_family_dict, indent=4)}")
+                raise KeyError(f"{instance_family} family missing {missing_keys}")
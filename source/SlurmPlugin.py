@@ -17,28 +17,29 @@ OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+# The plugin is used by short lived scripts so keep the imports light.
+# boto3 and EC2InstanceTypeInfo are imported when they are first needed.
+# tests/test_slurm_plugin_import_time.py checks the import time against a budget.
 import argparse
-import boto3
+import atexit
 from botocore.exceptions import ClientError
 from collections import Counter
 from copy import deepcopy
 from datetime import datetime, timezone
-from EC2InstanceTypeInfoPkg.EC2InstanceTypeInfo import EC2InstanceTypeInfo
+from EC2InstanceTypeInfoPkg.check_instance_type_info import check_instance_type_and_family_info
 from functools import wraps
-from isodate import parse_duration
-from jinja2 import Template as Template
 import json
 import logging
 from logging import error, info, warning
 import os
 from os import environ, path
 from os.path import dirname, realpath
-from pkg_resources import resource_filename
 import pprint
 import random
 import re
 # Subprocess not being used to execute user supplied data
 import subprocess # nosec
+import sys
 from sys import exit
 from tempfile import NamedTemporaryFile
 from textwrap import dedent
@@ -46,7 +47,7 @@ import threading
 import time
 import traceback
 from typing import List
-import yaml
+import weakref
 
 logger = logging.getLogger(__file__)
 logger_formatter = logging.Formatter('%(levelname)s:%(asctime)s: %(message)s')
@@ -58,8 +59,223 @@ logger.setLevel(logging.INFO)
 
 pp = pprint.PrettyPrinter(indent=4)
 
+# Parsed instance type info files keyed by filename.
+# The value is ((mtime_ns, size), instance_type_and_family_info) so that a changed file is read again.
+_instance_type_info_cache = {}
+
+def load_instance_type_info(json_filename):
+    '''
+    Read and check the cached instance type and family info without making any AWS API calls.
+
+    Each version of the file is only checked once.
+
+    Raises:
+        ValueError: The file isn't valid json.
+        KeyError: The file doesn't have the current format.
+
+    Returns:
+        dict: instance_type_and_family_info[region]
+    '''
+    st = os.stat(json_filename)
+    file_version = (st.st_mtime_ns, st.st_size)
+    cached = _instance_type_info_cache.get(json_filename)
+    if cached and cached[0] == file_version:
+        return cached[1]
+    with open(json_filename, 'r') as fh:
+        instance_type_and_family_info = json.load(fh)
+    check_instance_type_and_family_info(instance_type_and_family_info)
+    _instance_type_info_cache[json_filename] = (file_version, instance_type_and_family_info)
+    return instance_type_and_family_info
+
+class LazyClients(dict):
+    '''
+    Dictionary of boto3 clients keyed by region that are only created when they are first used.
+    '''
+    def __init__(self, create_client):
+        '''
+        Args:
+            create_client: Function that takes a region and returns the client.
+        '''
+        super().__init__()
+        self.create_client = create_client
+        self.lock = threading.Lock()
+
+    def __missing__(self, region):
+        with self.lock:
+            if region not in self:
+                self[region] = self.create_client(region)
+            return dict.__getitem__(self, region)
+
+# CloudWatchMetrics instances that may have buffered data points.
+# Weak references so that the exit handler doesn't keep every instance alive.
+_cloudwatch_metrics_instances = weakref.WeakSet()
+
+def _close_cloudwatch_metrics():
+    '''
+    Flush all of the CloudWatchMetrics instances when the process exits.
+    '''
+    for cloudwatch_metrics in list(_cloudwatch_metrics_instances):
+        cloudwatch_metrics.close()
+
+atexit.register(_close_cloudwatch_metrics)
+
+class CloudWatchMetrics:
+    '''
+    Buffer CloudWatch metric data points in memory and publish them in batches.
+
+    In api mode the data points with the same name, dimensions, and unit are aggregated into a statistic set
+    and published with put_metric_data with up to MAX_METRIC_DATA metrics per call.
+    In emf mode the data points are written as CloudWatch embedded metric format (EMF) log lines so no API calls are made.
+    The CloudWatch agent or a log subscription turns the log lines into metrics.
+
+    The buffer is flushed every flush_interval seconds by a background thread and when the process exits.
+    The thread stops when the buffer is empty so that an idle instance isn't kept alive by it.
+    '''
+
+    MODES = ['api', 'emf', 'disabled']
+
+    # Maximum number of metrics in a put_metric_data call
+    MAX_METRIC_DATA = 1000
+
+    # Maximum number of values in an EMF log line
+    MAX_EMF_VALUES = 100
+
+    def __init__(self, namespace, create_client, mode='api', flush_interval=60, emf_filename=None):
+        '''
+        Args:
+            namespace (str): CloudWatch namespace
+            create_client: Function that returns a CloudWatch client. Only called when the first batch is published.
+            mode (str): api, emf, or disabled
+            flush_interval (int): Seconds between flushes
+            emf_filename (str): File to append EMF log lines to. Defaults to stdout.
+        '''
+        if mode not in self.MODES:
+            raise ValueError(f"Invalid metrics mode {mode}. Valid modes: {self.MODES}")
+        self.namespace = namespace
+        self.create_client = create_client
+        self.mode = mode
+        self.flush_interval = flush_interval
+        self.emf_filename = emf_filename
+
+        # {(name, dimensions, unit): {'Timestamp': datetime, 'Values': [float]}}
+        self.buffer = {}
+        self.lock = threading.Lock()
+        self.flush_thread = None
+        self.stop_event = threading.Event()
+        _cloudwatch_metrics_instances.add(self)
+
+    def put_metric(self, name, value, dimensions=[], unit='Count'):
+        '''
+        Add a data point to the buffer.
+
+        Args:
+            name (str): Metric name
+            value (float): Value
+            dimensions (list): [{'Name': str, 'Value': str}]
+            unit (str): CloudWatch unit
+        '''
+        if self.mode == 'disabled':
+            return
+        key = (name, tuple((dimension['Name'], str(dimension['Value'])) for dimension in dimensions), unit)
+        with self.lock:
+            if key not in self.buffer:
+                self.buffer[key] = {'Timestamp': datetime.now(timezone.utc), 'Values': []}
+            self.buffer[key]['Values'].append(float(value))
+            if not self.flush_thread:
+                self.flush_thread = threading.Thread(target=self._flush_periodically, name='CloudWatchMetrics', daemon=True)
+                self.flush_thread.start()
+
+    def _flush_periodically(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception(f"Error publishing CloudWatch metrics")
+            with self.lock:
+                if not self.buffer:
+                    self.flush_thread = None
+                    return
+
+    def flush(self):
+        '''
+        Publish all of the buffered data points.
+        '''
+        with self.lock:
+            buffer = self.buffer
+            self.buffer = {}
+        if not buffer:
+            return
+        if self.mode == 'api':
+            self._put_metric_data(buffer)
+        elif self.mode == 'emf':
+            self._write_emf(buffer)
+
+    def close(self):
+        self.stop_event.set()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception(f"Error publishing CloudWatch metrics")
+
+    def _put_metric_data(self, buffer):
+        metric_data = []
+        for (name, dimensions, unit), data in buffer.items():
+            values = data['Values']
+            metric_data.append({
+                'MetricName': name,
+                'Dimensions': [{'Name': dimension_name, 'Value': dimension_value} for dimension_name, dimension_value in dimensions],
+                'Timestamp': data['Timestamp'],
+                'StatisticValues': {
+                    'SampleCount': len(values),
+                    'Sum': sum(values),
+                    'Minimum': min(values),
+                    'Maximum': max(values)
+                },
+                'Unit': unit
+            })
+        cw_client = self.create_client()
+        for index in range(0, len(metric_data), self.MAX_METRIC_DATA):
+            cw_client.put_metric_data(
+                Namespace = self.namespace,
+                MetricData = metric_data[index:index + self.MAX_METRIC_DATA]
+            )
+        logger.debug(f"Published {len(metric_data)} metrics to {self.namespace}")
+
+    def _write_emf(self, buffer):
+        lines = []
+        for (name, dimensions, unit), data in buffer.items():
+            timestamp = int(data['Timestamp'].timestamp() * 1000)
+            values = data['Values']
+            for index in range(0, len(values), self.MAX_EMF_VALUES):
+                emf = {
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [{
+                            'Namespace': self.namespace,
+                            'Dimensions': [[dimension_name for dimension_name, dimension_value in dimensions]],
+                            'Metrics': [{'Name': name, 'Unit': unit}]
+                        }]
+                    },
+                    name: values[index:index + self.MAX_EMF_VALUES]
+                }
+                for dimension_name, dimension_value in dimensions:
+                    emf[dimension_name] = dimension_value
+                lines.append(json.dumps(emf))
+        if self.emf_filename:
+            with open(self.emf_filename, 'a') as fh:
+                fh.write('\n'.join(lines) + '\n')
+        else:
+            print('\n'.join(lines), file=sys.stdout, flush=True)
+
 class SlurmPlugin:
 
+    CW_NAMESPACE = 'SLURM'
+
+    CW_INSTANCE_TYPE_INFO_CACHED = 'InstanceTypeInfoCached'
+    CW_INSTANCE_TYPE_INFO_UPDATED = 'InstanceTypeInfoUpdated'
+    CW_INSTANCE_CONFIG_SELECTION_TIME = 'InstanceConfigSelectionTime'
+    CW_INSTANCE_TYPES_SELECTED = 'InstanceTypesSelected'
+
     def __init__(self, slurm_config_file=f"/opt/slurm/config/slurm_config.json", region=None):
         if slurm_config_file:
             with open(slurm_config_file, 'r') as fh:
@@ -99,29 +315,89 @@ class SlurmPlugin:
 
         self.instance_types = None
 
-        # Create all of the boto3 clients in one place so can make sure that all client api calls get throttling retries.
-        # Create first so that can publish metrics for unhandled exceptions
-        self.cw = boto3.client('cloudwatch')
-
-        try:
-            self.ssm_client = boto3.client('ssm')
-            self.ec2 = {}
-            self.ec2_describe_instances_paginator = {}
-            self.sts_client = {}
-            for region in self.compute_regions:
-                self.ec2[region] = boto3.client('ec2', region_name=region)
-                self.ec2_describe_instances_paginator[region] = self.ec2[region].get_paginator('describe_instances')
-                self.sts_client[region] = boto3.client('sts', region_name=region)
-        except:
-            logger.exception('Unhandled exception in SlurmPlugin constructor')
-            self.publish_cw_metrics(self.CW_UNHANDLED_PLUGIN_CONSTRUCTOR_EXCEPTION, 1, [])
-            raise
+        # All of the boto3 clients are created in one place so can make sure that all client api calls get throttling retries.
+        # They are created when they are first used so that callers that don't need them don't pay for them.
+        self._cw = None
+        self._ssm_client = None
+        self.ec2 = LazyClients(lambda region: self.create_client('ec2', region))
+        self.ec2_describe_instances_paginator = LazyClients(lambda region: self.ec2[region].get_paginator('describe_instances'))
+        self.sts_client = LazyClients(lambda region: self.create_client('sts', region))
+
+        # Metrics are buffered and published in batches so that instrumentation doesn't add API calls to each event.
+        # Without a slurm config file the plugin isn't running on the cluster, for example in the CDK app, so metrics are disabled by default.
+        self.metrics = CloudWatchMetrics(
+            self.CW_NAMESPACE,
+            lambda: self.cw,
+            mode = environ.get('SLURM_PLUGIN_METRICS_MODE', self.config.get('CloudWatchMetricsMode', 'api' if slurm_config_file else 'disabled')),
+            flush_interval = self.config.get('CloudWatchMetricsFlushInterval', 60),
+            emf_filename = self.config.get('CloudWatchMetricsEmfFile', None)
+        )
         return
 
-    def get_instance_type_and_family_info(self):
-        logger.debug(f"get_instance_type_and_family_info()")
-        eC2InstanceTypeInfo = EC2InstanceTypeInfo(self.compute_regions, get_savings_plans=False, json_filename=self.config['InstanceTypeInfoFile'])
+    def create_client(self, service_name, region=None):
+        import boto3
+        return boto3.client(service_name, region_name=region)
+
+    def publish_cw_metrics(self, metric_name, value, dimensions, unit='Count'):
+        '''
+        Buffer a metric data point. It is published by self.metrics in the background or when the process exits.
+
+        Args:
+            metric_name (str): Metric name
+            value (float): Value
+            dimensions (list): [{'Name': str, 'Value': str}]
+            unit (str): CloudWatch unit
+        '''
+        self.metrics.put_metric(metric_name, value, dimensions, unit)
+
+    @property
+    def cw(self):
+        if not self._cw:
+            self._cw = self.create_client('cloudwatch')
+        return self._cw
+
+    @property
+    def ssm_client(self):
+        if not self._ssm_client:
+            self._ssm_client = self.create_client('ssm')
+        return self._ssm_client
+
+    def get_instance_type_and_family_info(self, offline=None):
+        '''
+        Get the instance type and family info for the compute regions.
+
+        If the cached catalog in InstanceTypeInfoFile already has all of the compute regions and the current format then it is read directly
+        without creating an EC2InstanceTypeInfo, which calls describe_regions and possibly the pricing API.
+        Otherwise EC2InstanceTypeInfo is used so that an invalid catalog is renamed and created again.
+
+        Args:
+            offline (bool): True to only use the cached catalog, False to always use EC2InstanceTypeInfo.
+                The default is to use the cached catalog if it is complete.
+        '''
+        logger.debug(f"get_instance_type_and_family_info(offline={offline})")
+        json_filename = self.config['InstanceTypeInfoFile']
+        if offline is not False:
+            instance_type_and_family_info = None
+            if path.exists(json_filename):
+                try:
+                    instance_type_and_family_info = load_instance_type_info(json_filename)
+                except Exception as e:
+                    logger.warning(f"Invalid data in {json_filename}: {e}")
+                    instance_type_and_family_info = {}
+                missing_regions = [region for region in self.compute_regions if region not in instance_type_and_family_info]
+                if missing_regions:
+                    logger.debug(f"{json_filename} is missing {missing_regions}")
+                    instance_type_and_family_info = None
+            if instance_type_and_family_info:
+                self.instance_type_and_family_info = instance_type_and_family_info
+                self.publish_cw_metrics(self.CW_INSTANCE_TYPE_INFO_CACHED, 1, [])
+                return
+            if offline:
+                raise ValueError(f"{json_filename} doesn't exist, is invalid, or doesn't have all of the compute regions: {self.compute_regions}")
+        from EC2InstanceTypeInfoPkg.EC2InstanceTypeInfo import EC2InstanceTypeInfo
+        eC2InstanceTypeInfo = EC2InstanceTypeInfo(self.compute_regions, get_savings_plans=False, json_filename=json_filename)
         self.instance_type_and_family_info = eC2InstanceTypeInfo.instance_type_and_family_info
+        self.publish_cw_metrics(self.CW_INSTANCE_TYPE_INFO_UPDATED, 1, [])
 
     def get_instance_family(self, instanceType):
         instance_family = instanceType.split(r'.')[0]
@@ -218,13 +494,14 @@ class SlurmPlugin:
     def get_SSDTotalSizeGB(self, region, instance_type):
         return self.instance_type_and_family_info[region]['instance_types'][instance_type]['SSDTotalSizeGB']
 
-    def get_instance_types_from_instance_config(self, instance_config: dict, regions: List[str], instance_type_info: EC2InstanceTypeInfo) -> dict:
+    def get_instance_types_from_instance_config(self, instance_config: dict, regions: List[str], instance_type_info: 'EC2InstanceTypeInfo') -> dict:
         '''
         Get instance types selected by the config file.
 
         Returns:
             dict: Dictionary of dictionary of instance types in each region. instance_types[region]{instance_types: {UseOnDemand: bool, UseSpot: bool, DisableSimultaneousMultithreading: bool}}
         '''
+        start_time = time.perf_counter()
         instance_config = deepcopy(instance_config)
 
         default_instance_type_config = {
@@ -343,12 +620,15 @@ class SlurmPlugin:
                     region_instance_types[instance_type] = instance_type_config
 
             instance_types[region] = region_instance_types
+            self.publish_cw_metrics(self.CW_INSTANCE_TYPES_SELECTED, len(region_instance_types), [{'Name': 'Region', 'Value': region}])
+        self.publish_cw_metrics(self.CW_INSTANCE_CONFIG_SELECTION_TIME, time.perf_counter() - start_time, [], unit='Seconds')
         return instance_types
 
     def get_region_name(self, region_code):
         '''
         Translate region code to region name
         '''
+        from pkg_resources import resource_filename
         endpoint_file = resource_filename('botocore', 'data/endpoints.json')
         try:
             with open(endpoint_file, 'r') as f:
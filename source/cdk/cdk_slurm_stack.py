@@ -39,6 +39,8 @@ from aws_cdk import (
     aws_sns_subscriptions as subs,
     aws_sqs as sqs,
     aws_ssm as ssm,
+    aws_stepfunctions as sfn,
+    aws_stepfunctions_tasks as sfn_tasks,
     CfnOutput,
     CfnResource,
     CustomResource,
@@ -67,6 +69,7 @@ from packaging.version import parse as parse_version
 from pprint import PrettyPrinter
 import re
 from shutil import make_archive
+from slurm_conf import get_onprem_compute_node_settings
 import subprocess
 from subprocess import check_output
 import sys
@@ -1233,6 +1236,11 @@ class CdkSlurmStack(Stack):
     def create_parallel_cluster_assets(self):
         # Create a secure hash of all of the assets so that changes can be easily detected to trigger cluster updates.
         self.assets_hash = sha512()
+        # Also keep a hash of each ansible role and config file so that head node updates only need to run the roles that changed.
+        self.asset_hashes = {
+            'Roles': {},
+            'Files': {}
+        }
 
         self.parallel_cluster_asset_read_policy = iam.ManagedPolicy(
             self, "ParallelClusterAssetReadPolicy",
@@ -1263,6 +1271,42 @@ class CdkSlurmStack(Stack):
                         'ec2:ModifyNetworkInterfaceAttribute',
                     ],
                     resources=['*']
+                ),
+                # Allow on_compute_node_configured.sh to publish its step timings.
+                # This policy is only attached to the compute nodes so put it here instead of creating a new one.
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=[
+                        'cloudwatch:PutMetricData',
+                    ],
+                    resources=['*'],
+                    conditions={'StringEquals': {'cloudwatch:namespace': 'SLURM'}}
+                )
+            ]
+        )
+
+        # Head node scripts that call EC2 and CloudWatch directly.
+        # The head node already has several managed policies so these are combined to stay under the managed policies per role quota.
+        self.parallel_cluster_head_node_spot_price_and_metrics_policy = iam.ManagedPolicy(
+            self, "ParallelClusterHeadNodeSpotPriceAndMetricsPolicy",
+            path = '/parallelcluster/',
+            statements = [
+                # Allow update_spot_node_weights.py to get the current spot prices.
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=[
+                        'ec2:DescribeSpotPriceHistory',
+                    ],
+                    resources=['*']
+                ),
+                # Allow poll_license_servers.py to publish its metrics.
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=[
+                        'cloudwatch:PutMetricData',
+                    ],
+                    resources=['*'],
+                    conditions={'StringEquals': {'cloudwatch:namespace': 'SLURM'}}
                 )
             ]
         )
@@ -1370,6 +1414,12 @@ class CdkSlurmStack(Stack):
                 Body   = playbooks_zipfile_fh
             )
         os.remove(playbooks_zipfile_filename)
+        playbooks_dir = 'resources/playbooks'
+        roles_dir = f"{playbooks_dir}/roles"
+        for role in sorted(os.listdir(roles_dir)):
+            self.asset_hashes['Roles'][role] = self.get_directory_hash(f"{roles_dir}/{role}")
+        # Changes to the playbooks, inventories, or ansible.cfg can affect any role.
+        self.asset_hashes['Files']['playbooks'] = self.get_directory_hash(playbooks_dir, exclude_dirs=[roles_dir])
 
         if 'DomainJoinedInstance' in self.config:
             self.configure_users_groups_json_sns_topic_arn_parameter_name = f"/{self.config['slurm']['ClusterName']}/ConfigureUsersGroupsJsonSnsTopicArn"
@@ -1432,6 +1482,7 @@ class CdkSlurmStack(Stack):
             'config/bin/create_users_groups_json_configure.sh',
             'config/bin/create_users_groups_json_deconfigure.sh',
             'config/bin/create_users_groups.py',
+            'config/bin/get_unchanged_ansible_roles.py',
             'config/bin/install-rootless-docker.sh',
             'config/bin/on_head_node_start.sh',
             'config/bin/on_head_node_configured.sh',
@@ -1456,6 +1507,7 @@ class CdkSlurmStack(Stack):
                 Body   = local_file_content
             )
             self.assets_hash.update(bytes(local_file_content, 'utf-8'))
+            self.asset_hashes['Files'][file_to_upload] = sha512(bytes(local_file_content, 'utf-8')).hexdigest()
 
         # Build files for custom ParallelCluster AMIs
         self.ami_builds = {
@@ -1527,7 +1579,9 @@ class CdkSlurmStack(Stack):
             self.assets_bucket,
             s3_key)
         with open(local_file, 'rb') as fh:
-            self.assets_hash.update(fh.read())
+            local_file_content = fh.read()
+        self.assets_hash.update(local_file_content)
+        self.asset_hashes['Files']['config/ansible/ansible_head_node_vars.yml'] = sha512(local_file_content).hexdigest()
 
         ansible_compute_node_template_vars = self.get_instance_template_vars('ParallelClusterComputeNode')
         fh = NamedTemporaryFile('w', delete=False)
@@ -1542,7 +1596,9 @@ class CdkSlurmStack(Stack):
             self.assets_bucket,
             s3_key)
         with open(local_file, 'rb') as fh:
-            self.assets_hash.update(fh.read())
+            local_file_content = fh.read()
+        self.assets_hash.update(local_file_content)
+        self.asset_hashes['Files']['config/ansible/ansible_compute_node_vars.yml'] = sha512(local_file_content).hexdigest()
 
         ansible_external_login_node_template_vars = self.get_instance_template_vars('ParallelClusterExternalLoginNode')
         fh = NamedTemporaryFile('w', delete=False)
@@ -1557,7 +1613,52 @@ class CdkSlurmStack(Stack):
             self.assets_bucket,
             s3_key)
         with open(local_file, 'rb') as fh:
-            self.assets_hash.update(fh.read())
+            local_file_content = fh.read()
+        self.assets_hash.update(local_file_content)
+        self.asset_hashes['Files']['config/ansible/ansible_external_login_node_vars.yml'] = sha512(local_file_content).hexdigest()
+
+        # Subset of the instance type catalog for the configured instance types.
+        # Used by head node scripts that need instance shapes and prices without calling the AWS pricing APIs.
+        instance_types_info = self.plugin.instance_type_and_family_info[self.cluster_region]['instance_types']
+        instance_type_info = {
+            self.cluster_region: {
+                'instance_types': {}
+            }
+        }
+        for instance_type in sorted(self.instance_type_configs.keys()):
+            instance_type_info[self.cluster_region]['instance_types'][instance_type] = {}
+            for key in ['DefaultCores', 'DefaultThreadsPerCore', 'DefaultVCpus', 'MemoryInMiB', 'pricing']:
+                if key in instance_types_info[instance_type]:
+                    instance_type_info[self.cluster_region]['instance_types'][instance_type][key] = instance_types_info[instance_type][key]
+        instance_type_info_content = json.dumps(instance_type_info, indent=4, sort_keys=True)
+        self.s3_client.put_object(
+            Bucket = self.assets_bucket,
+            Key    = f"{self.assets_base_key}/config/instance_type_info.json",
+            Body   = instance_type_info_content
+        )
+        self.assets_hash.update(bytes(instance_type_info_content, 'utf-8'))
+        self.asset_hashes['Files']['config/instance_type_info.json'] = sha512(bytes(instance_type_info_content, 'utf-8')).hexdigest()
+
+        # Used by on_head_node_configured.sh to decide which ansible roles need to be run on an update.
+        self.s3_client.put_object(
+            Bucket = self.assets_bucket,
+            Key    = f"{self.assets_base_key}/config/asset_hashes.json",
+            Body   = json.dumps(self.asset_hashes, indent=4, sort_keys=True)
+        )
+
+    def get_directory_hash(self, directory, exclude_dirs=[]):
+        '''
+        Get a sha512 hash of the relative paths and contents of all of the files in a directory.
+        '''
+        directory_hash = sha512()
+        for dirpath, dirnames, filenames in os.walk(directory, followlinks=True):
+            dirnames[:] = sorted([subdir for subdir in dirnames if subdir != '__pycache__' and path.join(dirpath, subdir) not in exclude_dirs])
+            for filename in sorted(filenames):
+                filename = path.join(dirpath, filename)
+                directory_hash.update(bytes(path.relpath(filename, directory), 'utf-8'))
+                with open(filename, 'rb') as fh:
+                    directory_hash.update(fh.read())
+        return directory_hash.hexdigest()
 
     def create_vpc(self):
         logger.info(f"VpcId: {self.config['VpcId']}")
@@ -1669,6 +1770,8 @@ class CdkSlurmStack(Stack):
     def create_parallel_cluster_lambdas(self):
         self.create_callSlurmRestApiLambda()
 
+        self.create_ssm_command_waiter()
+
         self.parallel_cluster_lambda_layer = aws_lambda.LayerVersion(self, "ParallelClusterLambdaLayer",
             description = 'ParallelCluster Layer',
             code = aws_lambda.Code.from_bucket(
@@ -2156,9 +2259,11 @@ class CdkSlurmStack(Stack):
             environment = {
                 'ClusterName': self.config['slurm']['ClusterName'],
                 'ErrorSnsTopicArn': self.config.get('ErrorSnsTopicArn', ''),
-                'Region': self.cluster_region
+                'Region': self.cluster_region,
+                'SsmCommandWaiterStateMachineArn': self.ssm_command_waiter_state_machine.state_machine_arn
             }
         )
+        self.ssm_command_waiter_state_machine.grant_start_execution(self.update_head_node_lambda)
         self.update_head_node_lambda.add_to_role_policy(
             statement=iam.PolicyStatement(
                 effect=iam.Effect.ALLOW,
@@ -2200,9 +2305,11 @@ class CdkSlurmStack(Stack):
                     'ErrorSnsTopicArn': self.config.get('ErrorSnsTopicArn', ''),
                     'Region': self.cluster_region,
                     'DomainJoinedInstanceTagsJson': json.dumps(self.config['DomainJoinedInstance']['Tags']),
-                    'SlurmLoginNodeSGId': self.config['DomainJoinedInstance'].get('SecurityGroupId', 'None')
+                    'SlurmLoginNodeSGId': self.config['DomainJoinedInstance'].get('SecurityGroupId', 'None'),
+                    'SsmCommandWaiterStateMachineArn': self.ssm_command_waiter_state_machine.state_machine_arn
                 }
             )
+            self.ssm_command_waiter_state_machine.grant_start_execution(self.configure_users_groups_json_lambda)
             self.configure_users_groups_json_lambda.add_to_role_policy(
                 statement=iam.PolicyStatement(
                     effect=iam.Effect.ALLOW,
@@ -2247,9 +2354,11 @@ class CdkSlurmStack(Stack):
                     'Region': self.cluster_region,
                     'ClusterName': self.config['slurm']['ClusterName'],
                     'ErrorSnsTopicArn': self.config.get('ErrorSnsTopicArn', ''),
-                    'ExternalLoginNodesConfigJson': json.dumps(self.config['ExternalLoginNodes'])
+                    'ExternalLoginNodesConfigJson': json.dumps(self.config['ExternalLoginNodes']),
+                    'SsmCommandWaiterStateMachineArn': self.ssm_command_waiter_state_machine.state_machine_arn
                 }
             )
+            self.ssm_command_waiter_state_machine.grant_start_execution(self.configure_external_login_nodes_lambda)
             self.configure_external_login_nodes_lambda.add_to_role_policy(
                 statement=iam.PolicyStatement(
                     effect=iam.Effect.ALLOW,
@@ -2257,6 +2366,7 @@ class CdkSlurmStack(Stack):
                         'ec2:DescribeInstances',
                         'ec2:ModifyInstanceAttribute',
                         'ssm:GetCommandInvocation',
+                        'ssm:ListCommandInvocations',
                         'ssm:SendCommand',
                     ],
                     resources=['*']
@@ -2361,6 +2471,92 @@ class CdkSlurmStack(Stack):
                         )
                     )
 
+    def create_ssm_command_waiter(self):
+        '''
+        Create a state machine that waits for an SSM command to complete.
+
+        Lambdas that run SSM commands start an execution instead of blocking until the command completes.
+        The state machine checks the command every 30 seconds until it completes or the Deadline in the execution input passes and then reports the result.
+        If the command was run for a custom resource then the custom resource is completed with the command output.
+        '''
+        ssmCommandWaiterLambdaAsset = s3_assets.Asset(self, "SsmCommandWaiterAsset", path="resources/lambdas/SsmCommandWaiter")
+        self.ssm_command_waiter_lambda = aws_lambda.Function(
+            self, "SsmCommandWaiterLambda",
+            function_name=f"{self.stack_name}-SsmCommandWaiter",
+            description="Check SSM command status and report the result",
+            memory_size=128,
+            runtime=get_PARALLEL_CLUSTER_LAMBDA_RUNTIME(parse_version(self.config['slurm']['ParallelClusterConfig']['Version'])),
+            architecture=aws_lambda.Architecture.ARM_64,
+            timeout=Duration.minutes(1),
+            log_retention=logs.RetentionDays.INFINITE,
+            handler="SsmCommandWaiter.lambda_handler",
+            code=aws_lambda.Code.from_bucket(ssmCommandWaiterLambdaAsset.bucket, ssmCommandWaiterLambdaAsset.s3_object_key),
+            environment = {
+                'ErrorSnsTopicArn': self.config.get('ErrorSnsTopicArn', '')
+            }
+        )
+        self.ssm_command_waiter_lambda.add_to_role_policy(
+            statement=iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=[
+                    'ssm:ListCommandInvocations',
+                ],
+                resources=['*']
+                )
+            )
+        if 'ErrorSnsTopicArn' in self.config:
+            self.ssm_command_waiter_lambda.add_to_role_policy(
+                statement=iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=[
+                        'sns:Publish'
+                    ],
+                    resources=[self.config['ErrorSnsTopicArn']]
+                    )
+                )
+
+        # The lambda raises CommandInProgress until the command completes or the deadline passes.
+        # The deadline is set by the lambda that sent the command based on the command's timeout.
+        # Custom resources cap it at 45 minutes so that the result is reported before the 1 hour CloudFormation timeout.
+        check_command_task = sfn_tasks.LambdaInvoke(
+            self, "CheckSsmCommand",
+            lambda_function = self.ssm_command_waiter_lambda,
+            payload_response_only = True
+        )
+        check_command_task.add_retry(
+            errors = ['Lambda.TooManyRequestsException'],
+            interval = Duration.seconds(5),
+            backoff_rate = 2,
+            max_attempts = 5
+        )
+        wait_task = sfn.Wait(
+            self, "WaitForSsmCommand",
+            time = sfn.WaitTime.duration(Duration.seconds(30))
+        )
+        wait_task.next(check_command_task)
+        # Any other error is reported as a failure so that the custom resource doesn't wait for the CloudFormation timeout.
+        report_result_task = sfn_tasks.LambdaInvoke(
+            self, "ReportSsmCommandResult",
+            lambda_function = self.ssm_command_waiter_lambda,
+            payload_response_only = True
+        )
+        report_result_task.add_retry(
+            errors = ['Lambda.TooManyRequestsException'],
+            interval = Duration.seconds(5),
+            backoff_rate = 2,
+            max_attempts = 5
+        )
+        # Discard the error so that the input is passed unchanged to the next check.
+        check_command_task.add_catch(wait_task, errors=['CommandInProgress'], result_path=sfn.JsonPath.DISCARD)
+        check_command_task.add_catch(report_result_task, errors=['States.ALL'], result_path='$.Error')
+        # Backstop in case the deadline is wrong. The longest deadline is ConfigureExternalLoginNodes's 95 minutes.
+        self.ssm_command_waiter_state_machine = sfn.StateMachine(
+            self, "SsmCommandWaiterStateMachine",
+            state_machine_name = f"{self.stack_name}-SsmCommandWaiter",
+            definition_body = sfn.DefinitionBody.from_chainable(check_command_task),
+            timeout = Duration.hours(2)
+        )
+
     def create_callSlurmRestApiLambda(self):
         callSlurmRestApiLambdaAsset = s3_assets.Asset(self, "CallSlurmRestApiLambdaAsset", path="resources/lambdas/CallSlurmRestApi")
         self.call_slurm_rest_api_lambda = aws_lambda.Function(
@@ -2482,6 +2678,7 @@ class CdkSlurmStack(Stack):
             instance_template_vars['slurmrestd_socket_dir'] = '/opt/slurm/com'
             instance_template_vars['slurmrestd_socket'] = f"{instance_template_vars['slurmrestd_socket_dir']}/slurmrestd.socket"
             instance_template_vars['slurmrestd_uid'] = self.config['slurm']['SlurmCtl']['SlurmrestdUid']
+            instance_template_vars['spot_node_weights'] = config_schema.PARALLEL_CLUSTER_SUPPORTS_NODE_WEIGHTS(self.PARALLEL_CLUSTER_VERSION)
             if 'Xio' in self.config['slurm']:
                 instance_template_vars['xio_mgt_ip'] = self.config['slurm']['Xio']['ManagementServerIp']
                 instance_template_vars['xio_availability_zone'] = self.config['slurm']['Xio']['AvailabilityZone']
@@ -2499,6 +2696,8 @@ class CdkSlurmStack(Stack):
                 instance_template_vars['xwo_config'] = self.config['slurm']['Xwo']
                 instance_template_vars['xwo_config']['ExtraMounts'] = self.config['slurm'].get('storage', {}).get('ExtraMounts', [])
         elif instance_role == 'ParallelClusterExternalLoginNode':
+            instance_template_vars['assets_bucket']                      = self.assets_bucket
+            instance_template_vars['assets_base_key']                    = self.assets_base_key
             instance_template_vars['enable_pyxis']                       = self.config['slurm']['ParallelClusterConfig']['EnablePyxis']
             instance_template_vars['slurm_version']                      = get_SLURM_VERSION(self.config)
             instance_template_vars['parallel_cluster_enroot_version']    = get_PARALLEL_CLUSTER_ENROOT_VERSION(self.config)
@@ -2766,6 +2965,7 @@ class CdkSlurmStack(Stack):
         self.parallel_cluster_config['HeadNode']['Iam']['AdditionalIamPolicies'].append({'Policy': '{{ParallelClusterSnsPublishPolicyArn}}'})
         self.parallel_cluster_config['HeadNode']['Iam']['AdditionalIamPolicies'].append({'Policy': '{{ParallelClusterJwtWritePolicyArn}}'})
         self.parallel_cluster_config['HeadNode']['Iam']['AdditionalIamPolicies'].append({'Policy': '{{ParallelClusterMungeKeyWritePolicyArn}}'})
+        self.parallel_cluster_config['HeadNode']['Iam']['AdditionalIamPolicies'].append({'Policy': '{{ParallelClusterHeadNodeSpotPriceAndMetricsPolicyArn}}'})
         if 'AdditionalIamPolicies' in self.config['slurm']['SlurmCtl']:
             for iam_policy_arn in self.config['slurm']['SlurmCtl']['AdditionalIamPolicies']:
                 self.parallel_cluster_config['HeadNode']['Iam']['AdditionalIamPolicies'].append({'Policy': iam_policy_arn})
@@ -3090,18 +3290,14 @@ class CdkSlurmStack(Stack):
             if not path.exists(self.config['slurm']['InstanceConfig']['OnPremComputeNodes']['ConfigFile']):
                 logger.error(f"slurm/InstanceConfig/OnPremComputeNodes/ConfigFile: On-premises compute nodes config file not found: {self.config['slurm']['InstanceConfig']['OnPremComputeNodes']['ConfigFile']}")
                 exit(1)
-            fh = open(self.config['slurm']['InstanceConfig']['OnPremComputeNodes']['ConfigFile'], 'r')
-            for line in fh.readline():
-                line = line.strip()
-                if not line: continue
-                if re.match(r'\s*#', line): continue
-                key_value_pairs = line.split(' ')
-                if not key_value_pairs: continue
-                slurm_settings_dict = {}
-                for key_value_pair in key_value_pairs:
-                    (key, value) = key_value_pair.split('=', 1)
-                    slurm_settings_dict[key] = value
-                self.parallel_cluster_config['Scheduling']['SlurmSettings']['CustomSlurmSettings'].append(slurm_settings_dict)
+            try:
+                onprem_slurm_settings = get_onprem_compute_node_settings(
+                    self.config['slurm']['InstanceConfig']['OnPremComputeNodes']['ConfigFile'],
+                    self.config['slurm']['InstanceConfig']['OnPremComputeNodes']['Partition'])
+            except ValueError as e:
+                logger.error(f"slurm/InstanceConfig/OnPremComputeNodes/ConfigFile: {e}")
+                exit(1)
+            self.parallel_cluster_config['Scheduling']['SlurmSettings']['CustomSlurmSettings'].extend(onprem_slurm_settings)
 
         # Create custom partitions based on those created by ParallelCluster
         for partition in partition_nodesets:
@@ -3269,6 +3465,10 @@ class CdkSlurmStack(Stack):
             key = 'ParallelClusterMungeKeyWritePolicyArn',
             value = self.parallel_cluster_munge_key_write_policy.managed_policy_arn
         )
+        self.create_parallel_cluster_config_lambda.add_environment(
+            key = 'ParallelClusterHeadNodeSpotPriceAndMetricsPolicyArn',
+            value = self.parallel_cluster_head_node_spot_price_and_metrics_policy.managed_policy_arn
+        )
         self.create_parallel_cluster_config_lambda.add_environment(
             key = 'ParallelClusterSnsPublishPolicyArn',
             value = self.parallel_cluster_sns_publish_policy.managed_policy_arn
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+Parse slurm.conf style files and convert them to ParallelCluster CustomSlurmSettings.
+"""
+
+import logging
+import re
+
+logger = logging.getLogger(__file__)
+
+SLURM_CONF_PAIR_RE = re.compile(r'([^\s=]+)=("[^"]*"|\S*)')
+HOSTLIST_RANGE_RE = re.compile(r'^(?P<prefix>[^\[\]]*)\[(?P<ranges>[^\[\]]+)\](?P<suffix>[^\[\]]*)$')
+
+# Node settings that are different for each node and can't be used to group nodes
+NODE_ADDRESS_KEYS = ['NodeAddr', 'NodeHostname']
+
+def read_slurm_conf_lines(fh):
+    '''
+    Read the logical lines of a slurm.conf file one at a time.
+
+    Comments and blank lines are skipped and lines that end with a backslash are joined with the next line.
+    '''
+    logical_line = ''
+    for line in fh:
+        line = line.split('#', 1)[0].rstrip()
+        if line.endswith('\\'):
+            logical_line += line[:-1]
+            continue
+        logical_line += line
+        if logical_line.strip():
+            yield logical_line.strip()
+        logical_line = ''
+    if logical_line.strip():
+        yield logical_line.strip()
+
+def parse_slurm_conf_line(line):
+    '''
+    Parse the key=value pairs of a slurm.conf line.
+
+    Returns:
+        dict with the keys in the order that they are in the line
+    '''
+    settings = {}
+    for (key, value) in SLURM_CONF_PAIR_RE.findall(line):
+        settings[key] = value
+    return settings
+
+def expand_hostlist(hostlist):
+    '''
+    Expand a hostlist expression into its host names.
+
+    Only a single bracketed range per comma separated term is supported, for example node[001-010,020].
+    '''
+    if '[' not in hostlist and ',' not in hostlist:
+        return [hostlist]
+    hostnames = []
+    for term in split_hostlist(hostlist):
+        match = HOSTLIST_RANGE_RE.match(term)
+        if not match:
+            if '[' in term or ']' in term:
+                raise ValueError(f"Unsupported hostlist expression: {term}")
+            hostnames.append(term)
+            continue
+        for index_range in match.group('ranges').split(','):
+            if '-' in index_range:
+                (first, last) = index_range.split('-', 1)
+            else:
+                first = last = index_range
+            width = len(first)
+            for index in range(int(first), int(last) + 1):
+                hostnames.append(f"{match.group('prefix')}{index:0{width}d}{match.group('suffix')}")
+    return hostnames
+
+def split_hostlist(hostlist):
+    '''
+    Split a hostlist expression into its comma separated terms.
+
+    Commas inside of [] are part of a range and aren't separators.
+    '''
+    terms = []
+    depth = 0
+    start = 0
+    for index, c in enumerate(hostlist):
+        if c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            terms.append(hostlist[start:index])
+            start = index + 1
+    terms.append(hostlist[start:])
+    return [term for term in terms if term]
+
+def get_hostname_sort_keys(hostnames):
+    '''
+    Get the keys that sort host names in the order that compress_hostlist expands them.
+
+    Host names that end in a number are grouped by prefix and number width and sorted by number.
+    Numbers are only grouped by width if the prefix has zero padded numbers of that width
+    so that node9 and node10 are in the same group but node0009 and node10 aren't.
+
+    Returns:
+        {hostname: (prefix, width, index)}
+        The index is -1 for host names that don't end in a number.
+    '''
+    split_hostnames = {}
+    padded_widths = {}
+    for hostname in hostnames:
+        prefix = hostname.rstrip('0123456789')
+        index = hostname[len(prefix):]
+        split_hostnames[hostname] = (prefix, index)
+        if len(index) > 1 and index[0] == '0':
+            padded_widths.setdefault(prefix, set()).add(len(index))
+    sort_keys = {}
+    for hostname, (prefix, index) in split_hostnames.items():
+        if not index:
+            sort_keys[hostname] = (hostname, -1, -1)
+            continue
+        width = len(index) if len(index) in padded_widths.get(prefix, ()) else 0
+        sort_keys[hostname] = (prefix, width, int(index))
+    return sort_keys
+
+def sort_hostnames(hostnames):
+    '''
+    Sort host names in the order that compress_hostlist expands them.
+    '''
+    sort_keys = get_hostname_sort_keys(hostnames)
+    return sorted(hostnames, key=lambda hostname: sort_keys[hostname])
+
+def compress_hostlist(hostnames):
+    '''
+    Compress host names into a hostlist expression, for example node[0001-2000].
+
+    The expression expands to the host names in the order returned by sort_hostnames.
+    '''
+    sort_keys = get_hostname_sort_keys(set(hostnames))
+    terms = []
+    current_key = None
+    ranges = []
+    for hostname in sorted(sort_keys.keys(), key=lambda hostname: sort_keys[hostname]):
+        (prefix, width, index) = sort_keys[hostname]
+        if index == -1:
+            if current_key:
+                terms.append(_format_hostlist_term(current_key, ranges))
+                current_key = None
+            terms.append(hostname)
+            continue
+        if (prefix, width) != current_key:
+            if current_key:
+                terms.append(_format_hostlist_term(current_key, ranges))
+            current_key = (prefix, width)
+            ranges = []
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    if current_key:
+        terms.append(_format_hostlist_term(current_key, ranges))
+    return ','.join(terms)
+
+def _format_hostlist_term(key, ranges):
+    (prefix, width) = key
+    if len(ranges) == 1 and ranges[0][0] == ranges[0][1]:
+        return f"{prefix}{ranges[0][0]:0{width}d}"
+    range_strings = []
+    for (first, last) in ranges:
+        if first == last:
+            range_strings.append(f"{first:0{width}d}")
+        else:
+            range_strings.append(f"{first:0{width}d}-{last:0{width}d}")
+    return f"{prefix}[{','.join(range_strings)}]"
+
+def get_onprem_compute_node_settings(filename, partition):
+    '''
+    Convert an on-premises compute nodes slurm.conf file to CustomSlurmSettings.
+
+    The file is read one line at a time.
+    NodeName=DEFAULT and PartitionName=DEFAULT settings are applied to the lines that follow them so that they don't
+    leak into the rest of the cluster's configuration.
+    Nodes with the same settings are combined into a single NodeName entry with a hostlist expression and
+    their NodeAddr and NodeHostname values are listed in the same order.
+    A NodeSet named {partition}_nodes contains all of the nodes and a partition named {partition} is created
+    for it if the file doesn't already define one.
+
+    Returns:
+        list of CustomSlurmSettings dicts
+    '''
+    node_defaults = {}
+    partition_defaults = {}
+    # {settings: [(hostname, {address_key: address})]}
+    node_groups = {}
+    onprem_hostname_set = set()
+    number_of_node_lines = 0
+    partition_settings = []
+    other_settings = []
+    with open(filename, 'r') as fh:
+        for line in read_slurm_conf_lines(fh):
+            settings = parse_slurm_conf_line(line)
+            if not settings:
+                raise ValueError(f"Invalid line in {filename}: {line}")
+            (key, value) = next(iter(settings.items()))
+            del settings[key]
+            if key.lower() == 'nodename':
+                if value.lower() == 'default':
+                    node_defaults.update(settings)
+                    continue
+                number_of_node_lines += 1
+                node_settings = dict(node_defaults)
+                node_settings.update(settings)
+                hostnames = expand_hostlist(value)
+                addresses = {}
+                for address_key in NODE_ADDRESS_KEYS:
+                    if address_key not in node_settings:
+                        continue
+                    addresses[address_key] = expand_hostlist(node_settings.pop(address_key))
+                    if len(addresses[address_key]) != len(hostnames):
+                        raise ValueError(f"{address_key} must have the same number of entries as NodeName in {filename}: {line}")
+                group_key = tuple(sorted(node_settings.items()))
+                node_group = node_groups.setdefault(group_key, [])
+                for index, hostname in enumerate(hostnames):
+                    if hostname in onprem_hostname_set:
+                        raise ValueError(f"{hostname} is defined more than once in {filename}")
+                    onprem_hostname_set.add(hostname)
+                    node_group.append((hostname, {address_key: address_list[index] for address_key, address_list in addresses.items()}))
+            elif key.lower() == 'partitionname':
+                if value.lower() == 'default':
+                    partition_defaults.update(settings)
+                    continue
+                partition_dict = {'PartitionName': value}
+                partition_dict.update(partition_defaults)
+                partition_dict.update(settings)
+                partition_settings.append(partition_dict)
+            else:
+                other_settings.append({key: value, **settings})
+
+    custom_slurm_settings = []
+    onprem_hostnames = []
+    for group_key, nodes in node_groups.items():
+        node_addresses = dict(nodes)
+        hostnames = sort_hostnames(list(node_addresses.keys()))
+        nodes = [(hostname, node_addresses[hostname]) for hostname in hostnames]
+        onprem_hostnames.extend(hostnames)
+        node_dict = {'NodeName': compress_hostlist(hostnames)}
+        for address_key in NODE_ADDRESS_KEYS:
+            if not any(address_key in addresses for hostname, addresses in nodes):
+                continue
+            # Nodes without an address use their NodeName
+            address_list = [addresses.get(address_key, hostname) for hostname, addresses in nodes]
+            if address_list == hostnames:
+                continue
+            compressed_addresses = compress_hostlist(address_list)
+            if len(address_list) == len(set(address_list)) and sort_hostnames(address_list) == address_list:
+                node_dict[address_key] = compressed_addresses
+            else:
+                node_dict[address_key] = ','.join(address_list)
+        node_dict.update(group_key)
+        custom_slurm_settings.append(node_dict)
+    logger.info(f"Combined {len(onprem_hostnames)} on-premises compute nodes from {number_of_node_lines} NodeName lines into {len(node_groups)} NodeName entries")
+
+    if onprem_hostnames:
+        nodeset = f"{partition}_nodes"
+        custom_slurm_settings.append({'NodeSet': nodeset, 'Nodes': compress_hostlist(onprem_hostnames)})
+        for partition_dict in partition_settings:
+            # Compress partition node lists that only contain on-premises nodes
+            if 'Nodes' in partition_dict and partition_dict['Nodes'].upper() != 'ALL':
+                try:
+                    partition_hostnames = expand_hostlist(partition_dict['Nodes'])
+                except ValueError:
+                    continue
+                if set(partition_hostnames) <= onprem_hostname_set:
+                    partition_dict['Nodes'] = compress_hostlist(partition_hostnames)
+        if partition not in [partition_dict['PartitionName'] for partition_dict in partition_settings]:
+            partition_settings.append({'PartitionName': partition, 'Nodes': nodeset, 'Default': 'NO'})
+    custom_slurm_settings.extend(partition_settings)
+    custom_slurm_settings.extend(other_settings)
+    return custom_slurm_settings
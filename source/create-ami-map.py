@@ -23,16 +23,25 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 import argparse
 import boto3
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import io
 import json
 import logging
-from os import system
 from pprint import PrettyPrinter
+import urllib.request
 
 logger = logging.getLogger(__file__)
 
 pp = PrettyPrinter()
 
+# Max number of values in a describe_images filter
+DESCRIBE_IMAGES_MAX_IDS = 200
+
+# Max number of parameters in a get_parameters call
+GET_PARAMETERS_MAX_NAMES = 10
+
 distributions_dict = {
     'AlmaLinux': {
         'major_versions': ['8'],
@@ -78,7 +87,173 @@ distributions_dict = {
     },
 }
 
-def main(filename, region, distribution):
+def get_csv_amis(distribution, regions):
+    '''
+    Stream the distribution's AMI csv file and return the AMIs for the major versions that we support.
+
+    Returns:
+        {region: [(distribution_major_version, architecture, ami_id, name)]}
+    '''
+    csv_url = distributions_dict[distribution]['csv']
+    logger.info(f"Reading {distribution} AMIs from {csv_url}")
+    csv_amis = {}
+    with urllib.request.urlopen(csv_url, timeout=60) as response:
+        csv_reader = csv.reader(io.TextIOWrapper(response, encoding='utf-8'), dialect='excel')
+        for row in csv_reader:
+            (os, version, region, ami_id, architecture) = row
+            if region not in regions:
+                continue
+            distribution_major_version = version.split(r'.')[0]
+            if distribution_major_version not in distributions_dict[distribution]['major_versions']:
+                continue
+            name = f"{os} {version} {architecture}"
+            if architecture == 'aarch64':
+                architecture = 'arm64'
+            csv_amis.setdefault(region, []).append((distribution_major_version, architecture, ami_id, name))
+    return csv_amis
+
+def describe_image_ids(ec2_client, image_ids):
+    '''
+    Describe images in batches.
+
+    Uses an image-id filter instead of ImageIds so that a missing AMI doesn't fail the whole batch.
+
+    Returns:
+        {image_id: image_dict}
+    '''
+    images = {}
+    image_ids = sorted(set(image_ids))
+    for index in range(0, len(image_ids), DESCRIBE_IMAGES_MAX_IDS):
+        kwargs = {
+            'Filters': [{'Name': 'image-id', 'Values': image_ids[index:index + DESCRIBE_IMAGES_MAX_IDS]}],
+            'IncludeDeprecated': True
+        }
+        for page in ec2_client.get_paginator('describe_images').paginate(**kwargs):
+            for image_dict in page['Images']:
+                images[image_dict['ImageId']] = image_dict
+    return images
+
+def get_ssm_parameters(ssm_client, names):
+    '''
+    Get SSM parameter values in batches.
+
+    Returns:
+        {name: value}
+    '''
+    values = {}
+    names = sorted(set(names))
+    for index in range(0, len(names), GET_PARAMETERS_MAX_NAMES):
+        response = ssm_client.get_parameters(Names=names[index:index + GET_PARAMETERS_MAX_NAMES])
+        for parameter in response['Parameters']:
+            values[parameter['Name']] = parameter['Value']
+        for name in response.get('InvalidParameters', []):
+            logger.warning(f"{name} SSM parameter not found")
+    return values
+
+def get_region_ami_map(region, distributions, csv_amis):
+    '''
+    Get the AMI map for one region.
+
+    Each region gets its own session and clients so that regions can be processed in parallel.
+    '''
+    logger.debug(f"region: {region}")
+    session = boto3.session.Session(region_name=region)
+    client_config = Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+    ec2_client = session.client('ec2', config=client_config)
+    ssm_client = session.client('ssm', config=client_config)
+
+    region_ami_map = {}
+
+    # Get all of the image ids from the csv files and SSM parameters and describe them together.
+    ssm_parameter_names = []
+    for distribution in distributions:
+        for distribution_major_version in distributions_dict[distribution].get('ssm-parameters', {}):
+            for architecture, ssm_parameters in distributions_dict[distribution]['ssm-parameters'][distribution_major_version].items():
+                ssm_parameter_names += ssm_parameters
+    ssm_parameter_values = get_ssm_parameters(ssm_client, ssm_parameter_names) if ssm_parameter_names else {}
+    image_ids = list(ssm_parameter_values.values())
+    for distribution in csv_amis:
+        for (distribution_major_version, architecture, ami_id, name) in csv_amis[distribution].get(region, []):
+            image_ids.append(ami_id)
+    images = describe_image_ids(ec2_client, image_ids) if image_ids else {}
+
+    for distribution in distributions:
+        logger.debug(f"distribution: {distribution}")
+        region_ami_map[distribution] = {}
+        if 'csv' in distributions_dict[distribution]:
+            for (distribution_major_version, architecture, ami_id, name) in csv_amis[distribution].get(region, []):
+                # Make sure that AMI exists
+                if ami_id not in images:
+                    logger.warning(f"{ami_id} ({name}) not found in {region}")
+                    continue
+                image_dict = images[ami_id]
+                region_ami_map[distribution].setdefault(distribution_major_version, {})[architecture] = {
+                    'ImageId': ami_id,
+                    'Name': image_dict['Name'],
+                    'RootDeviceName': image_dict['RootDeviceName']
+                }
+            if not region_ami_map[distribution]:
+                del region_ami_map[distribution]
+            continue
+        for distribution_major_version in distributions_dict[distribution]['major_versions']:
+            logger.debug(f"distribution_major_version: {distribution_major_version}")
+            if 'ssm-parameters' in distributions_dict[distribution]:
+                for architecture in distributions_dict[distribution]['ssm-parameters'][distribution_major_version]:
+                    for ssm_parameter in distributions_dict[distribution]['ssm-parameters'][distribution_major_version][architecture]:
+                        image_id = ssm_parameter_values.get(ssm_parameter, None)
+                        if image_id not in images:
+                            logger.warning(f"{image_id} ({ssm_parameter}) not found in {region}")
+                            continue
+                        image_dict = images[image_id]
+                        region_ami_map[distribution].setdefault(distribution_major_version, {})[architecture] = {
+                            'ImageId': image_id,
+                            'Name': image_dict['Name'],
+                            'RootDeviceName': image_dict['RootDeviceName']
+                        }
+                continue
+            kwargs = {
+                'Owners': [distributions_dict[distribution]['owner']],
+                'Filters': [
+                    {'Name': 'state', 'Values': ['available']}
+                ]
+            }
+            if 'name_filter' in distributions_dict[distribution]:
+                name_filter = distributions_dict[distribution]['name_filter'].format(distribution_major_version=distribution_major_version)
+                logger.debug(f"name_filter: {name_filter}")
+                filter = {
+                    'Name': 'name',
+                    'Values': [name_filter]
+                }
+                kwargs['Filters'].append(filter)
+            if 'product_codes' in distributions_dict[distribution]:
+                product_codes = distributions_dict[distribution]['product_codes']
+                logger.debug(f'product_codes: {product_codes}')
+                filter = {
+                    'Name': 'product-code',
+                    'Values': product_codes
+                }
+                kwargs['Filters'].append(filter)
+            images_found = []
+            for page in ec2_client.get_paginator('describe_images').paginate(**kwargs):
+                images_found += page['Images']
+            if not images_found:
+                logger.warning(f"No images found in {region} for {distribution} {distribution_major_version}")
+                continue
+            logger.debug(f"Found {len(images_found)} images in {region} for {distribution} {distribution_major_version}")
+            version_ami_map = {}
+            for image in images_found:
+                if 'BETA' in image['Name']:
+                    continue
+                architecture = image['Architecture']
+                if architecture not in version_ami_map or image['Name'] > version_ami_map[architecture]['Name']:
+                    version_ami_map[architecture] = image
+            if version_ami_map:
+                region_ami_map[distribution][distribution_major_version] = version_ami_map
+        if not region_ami_map[distribution]:
+            del region_ami_map[distribution]
+    return region_ami_map
+
+def main(filename, region, distribution, jobs):
     ec2_client = boto3.client("ec2", region_name='us-east-1')
 
     # Get list of regions
@@ -93,125 +268,21 @@ def main(filename, region, distribution):
     if distribution:
         distributions = [distribution]
     else:
-        distributions = distributions_dict.keys()
-    ami_map = {}
+        distributions = list(distributions_dict.keys())
+
+    csv_amis = {}
     for distribution in distributions:
-        if 'csv' not in distributions_dict[distribution]:
-            continue
-        csv_filename = f"/tmp/{distribution}-aws-amis.csv"
-        system(f"rm -f {csv_filename}")
-        rc = system(f"wget {distributions_dict[distribution]['csv']} -o /dev/null -O {csv_filename}")
-        assert rc == 0
-        csv_reader_fh = open(csv_filename, 'r')
-        csv_reader = csv.reader(csv_reader_fh, dialect='excel')
-        while True:
-            try:
-                (os, version, region, ami_id, architecture) = next(csv_reader)
-                distribution_major_version = version.split(r'.')[0]
-                if distribution_major_version not in distributions_dict[distribution]['major_versions']:
-                    continue
-                name = f"{os} {version} {architecture}"
-                # Make sure that AMI exists
-                ec2_client = boto3.client('ec2', region_name=region)
-                try:
-                    image_dict = ec2_client.describe_images(ImageIds=[ami_id]).get('Images', None)[0]
-                except:
-                    logger.warning(f"{ami_id} ({name}) not found in {region}")
-                    continue
-                if region not in ami_map:
-                    ami_map[region] = {}
-                if distribution not in ami_map[region]:
-                    ami_map[region][distribution] = {}
-                if distribution_major_version not in ami_map[region][distribution]:
-                    ami_map[region][distribution][distribution_major_version] = {}
-                if architecture == 'aarch64':
-                    architecture = 'arm64'
-                ami_map[region][distribution][distribution_major_version][architecture] = {
-                    'ImageId': ami_id,
-                    'Name': image_dict['Name'],
-                    'RootDeviceName': image_dict['RootDeviceName']
-                }
-            except StopIteration:
-                break
-    for region in sorted(regions):
-        logger.debug(f"region: {region}")
-        if region not in ami_map:
-            ami_map[region] = {}
-        ec2_client = boto3.client('ec2', region_name=region)
-
-        for distribution in distributions:
-            if 'csv' in distributions_dict[distribution]:
-                continue
-            logger.debug(f"distribution: {distribution}")
-            ami_map[region][distribution] = {}
-            for distribution_major_version in distributions_dict[distribution]['major_versions']:
-                logger.debug(f"distribution_major_version: {distribution_major_version}")
-                if 'ssm-parameters' in distributions_dict[distribution]:
-                    ssm_client = boto3.client('ssm', region_name=region)
-                    image_id = None
-                    for architecture in distributions_dict[distribution]['ssm-parameters'][distribution_major_version]:
-                        for ssm_parameter in distributions_dict[distribution]['ssm-parameters'][distribution_major_version][architecture]:
-                            image_id = ssm_client.get_parameter(Name=ssm_parameter)['Parameter']['Value']
-                            try:
-                                image_dict = ec2_client.describe_images(ImageIds=[image_id]).get('Images', None)[0]
-                            except:
-                                logger.warning(f"{image_id} ({ssm_parameter}) not found in {region}")
-                                continue
-                            if distribution not in ami_map[region]:
-                                ami_map[region][distribution] = {}
-                            if distribution_major_version not in ami_map[region][distribution]:
-                                ami_map[region][distribution][distribution_major_version] = {}
-                            ami_map[region][distribution][distribution_major_version][architecture] = {
-                                'ImageId': image_id,
-                                'Name': image_dict['Name'],
-                                'RootDeviceName': image_dict['RootDeviceName']
-                            }
-                    continue
-                kwargs = {
-                    'Owners': [distributions_dict[distribution]['owner']],
-                    'Filters': [
-                        {'Name': 'state', 'Values': ['available']}
-                    ]
-                }
-                if 'name_filter' in distributions_dict[distribution]:
-                    name_filter = distributions_dict[distribution]['name_filter'].format(distribution_major_version=distribution_major_version)
-                    logger.debug(f"name_filter: {name_filter}")
-                    filter = {
-                        'Name': 'name',
-                        'Values': [name_filter]
-                    }
-                    kwargs['Filters'].append(filter)
-                if 'product_codes' in distributions_dict[distribution]:
-                    product_codes = distributions_dict[distribution]['product_codes']
-                    logger.debug(f'product_codes: {product_codes}')
-                    filter = {
-                        'Name': 'product-code',
-                        'Values': product_codes
-                    }
-                    kwargs['Filters'].append(filter)
-                images = ec2_client.describe_images(**kwargs).get('Images', None)
-                if not images:
-                    logger.warning(f"No images found in {region} for {distribution} {distribution_major_version}")
-                    continue
-                logger.debug(f"Found {len(images)} images:\n{json.dumps(images, indent=4)}")
-                ami_map[region][distribution][distribution_major_version] = {}
-                for image in images:
-                    if 'BETA' in image['Name']:
-                        continue
-                    architecture = image['Architecture']
-                    if architecture not in ami_map[region][distribution][distribution_major_version]:
-                        ami_map[region][distribution][distribution_major_version][architecture] = image
-                    else:
-                        if image['Name'] > ami_map[region][distribution][distribution_major_version][architecture]['Name']:
-                            ami_map[region][distribution][distribution_major_version][architecture] = image
-                if architecture not in ami_map[region][distribution][distribution_major_version]:
-                    del ami_map[region][distribution][distribution_major_version]
-            if not ami_map[region][distribution]:
-                del ami_map[region][distribution]
-        if not ami_map[region]:
-            del ami_map[region]
-
-    logger.debug(f"ami_map:\n{json.dumps(ami_map, indent=4)}")
+        if 'csv' in distributions_dict[distribution]:
+            csv_amis[distribution] = get_csv_amis(distribution, regions)
+
+    ami_map = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        region_ami_maps = executor.map(lambda region: get_region_ami_map(region, distributions, csv_amis), regions)
+        for region, region_ami_map in zip(regions, region_ami_maps):
+            if region_ami_map:
+                ami_map[region] = region_ami_map
+
+    logger.debug(f"ami_map:\n{json.dumps(ami_map, indent=4, default=str)}")
 
     fh = open(filename, 'w')
     print("AmiMap:", file=fh)
@@ -225,7 +296,6 @@ def main(filename, region, distribution):
                     image_id = ami_map[region][distribution][distribution_major_version][architecture]['ImageId']
                     name = ami_map[region][distribution][distribution_major_version][architecture]['Name']
                     root_device_name = ami_map[region][distribution][distribution_major_version][architecture]['RootDeviceName']
-                    architecture_key = f"{architecture}:"
                     print(f"        {architecture}:", file=fh)
                     print(f"          ImageId: {image_id} # {name}", file=fh)
                     print(f"          RootDeviceName: {root_device_name}", file=fh)
@@ -237,6 +307,7 @@ if __name__ == "__main__":
     parser.add_argument('-o', dest='filename', action='store', default='source/resources/config/ami_map.yml', help="output filename")
     parser.add_argument('--region', action='store', default='', help="Region. Use for debug. Default is all AWS regions.")
     parser.add_argument('--distribution', action='store', default='', help="Distribution. Use for debug.")
+    parser.add_argument('--jobs', '-j', type=int, default=16, help="Number of regions to process in parallel.")
     parser.add_argument('--debug', '-d', action='count', default=False, help="Enable debug messages")
     args = parser.parse_args()
 
@@ -248,4 +319,4 @@ if __name__ == "__main__":
     if args.debug:
         logger.setLevel(logging.DEBUG)
 
-    main(args.filename, args.region, args.distribution)
+    main(args.filename, args.region, args.distribution, args.jobs)
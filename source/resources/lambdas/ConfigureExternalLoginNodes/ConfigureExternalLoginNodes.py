@@ -17,13 +17,21 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 '''
-Call /opt/slurm/{{ClusterName}}/config/bin/on_head_node_updated.sh using ssm run command.
+Call /opt/slurm/{{ClusterName}}/config/bin/external_login_node_configure.sh on all external login nodes using ssm run command.
+
+The instances are configured as a fleet:
+* The login node security group is attached to the instances concurrently.
+* The instances are split into batches that are within the SSM limit on the number of instance ids per command.
+* MaxConcurrency and MaxErrors control how many instances run the command at once and when SSM stops sending it.
+* The status of each instance is tracked and a summary is logged and failures are published to the error SNS topic.
 '''
 import boto3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from textwrap import dedent
 import json
 import logging
 from os import environ as environ
+import time
 
 logger=logging.getLogger(__file__)
 logger_formatter = logging.Formatter('%(levelname)s: %(message)s')
@@ -33,6 +41,159 @@ logger.addHandler(logger_streamHandler)
 logger.setLevel(logging.INFO)
 logger.propagate = False
 
+# SSM SendCommand accepts at most 50 instance ids.
+SSM_MAX_INSTANCE_IDS = 50
+
+# Number of threads used to modify instance security groups.
+MAX_EC2_WORKERS = 16
+
+# How many instances in each command run at the same time and how many errors are allowed before SSM stops sending the command.
+SSM_MAX_CONCURRENCY = environ.get('SsmMaxConcurrency', '50')
+SSM_MAX_ERRORS = environ.get('SsmMaxErrors', '25%')
+
+SSM_IN_PROGRESS_STATUSES = ['Pending', 'InProgress', 'Delayed', 'Cancelling']
+
+def get_login_node_instances(ec2_client, external_login_nodes_config):
+    '''
+    Returns a dict indexed by instance id of the running instances that match any of the tag sets.
+
+    Each value has the instance's security group ids and the security group that should be attached to it.
+    '''
+    login_node_instances = {}
+    for external_login_node_config in external_login_nodes_config:
+        slurm_login_node_sg_id = external_login_node_config.get('SecurityGroupId', None)
+
+        tags_message = ''
+        describe_instances_kwargs = {
+            'Filters': [
+                {'Name': 'instance-state-name', 'Values': ['running']}
+            ]
+        }
+        for tag_dict in external_login_node_config['Tags']:
+            tag = tag_dict['Key']
+            values = tag_dict['Values']
+            tags_message += f"\n{tag}: {values}"
+            describe_instances_kwargs['Filters'].append(
+                {'Name': f"tag:{tag}", 'Values': values}
+            )
+        logger.info(f"Configure instances with the following tags as login nodes:{tags_message}")
+
+        describe_instances_paginator = ec2_client.get_paginator('describe_instances')
+        for response in describe_instances_paginator.paginate(**describe_instances_kwargs):
+            for reservation_info in response['Reservations']:
+                for instance_info in reservation_info['Instances']:
+                    instance_id = instance_info['InstanceId']
+                    if instance_info['State']['Name'] != 'running':
+                        logger.info(f"Skipping {instance_id} because state = {instance_info['State']['Name']}")
+                        continue
+                    if instance_id not in login_node_instances:
+                        login_node_instances[instance_id] = {
+                            'SecurityGroupIds': [security_group_dict['GroupId'] for security_group_dict in instance_info['SecurityGroups']],
+                            'RequiredSecurityGroupIds': []
+                        }
+                    if slurm_login_node_sg_id and slurm_login_node_sg_id not in login_node_instances[instance_id]['RequiredSecurityGroupIds']:
+                        login_node_instances[instance_id]['RequiredSecurityGroupIds'].append(slurm_login_node_sg_id)
+    return login_node_instances
+
+def attach_security_groups(ec2_client, login_node_instances):
+    '''
+    Attach the required security groups to the instances concurrently.
+
+    Returns a dict of instance ids that couldn't be modified and the error message.
+    '''
+    instances_to_modify = {}
+    for instance_id, instance_info in login_node_instances.items():
+        missing_security_group_ids = [security_group_id for security_group_id in instance_info['RequiredSecurityGroupIds'] if security_group_id not in instance_info['SecurityGroupIds']]
+        if missing_security_group_ids:
+            instances_to_modify[instance_id] = instance_info['SecurityGroupIds'] + missing_security_group_ids
+    logger.info(f"Attaching security groups to {len(instances_to_modify)} of {len(login_node_instances)} login nodes.")
+    if not instances_to_modify:
+        return {}
+
+    errors = {}
+    with ThreadPoolExecutor(max_workers=min(MAX_EC2_WORKERS, len(instances_to_modify))) as executor:
+        futures = {}
+        for instance_id, security_group_ids in instances_to_modify.items():
+            futures[executor.submit(ec2_client.modify_instance_attribute, InstanceId=instance_id, Groups=security_group_ids)] = instance_id
+        for future in as_completed(futures):
+            instance_id = futures[future]
+            try:
+                future.result()
+                logger.info(f"Attached security groups to {instance_id}: {instances_to_modify[instance_id]}")
+            except Exception as e:
+                logger.error(f"Couldn't attach security groups to {instance_id}: {e}")
+                errors[instance_id] = str(e)
+    return errors
+
+def send_commands(ssm_client, instance_ids, ssm_script, comment, timeout_seconds):
+    '''
+    Send the command to the instances in batches.
+
+    Returns a dict of command ids and the instance ids in each command.
+    '''
+    commands = {}
+    for index in range(0, len(instance_ids), SSM_MAX_INSTANCE_IDS):
+        batch_instance_ids = instance_ids[index:index + SSM_MAX_INSTANCE_IDS]
+        send_command_response = ssm_client.send_command(
+            DocumentName = 'AWS-RunShellScript',
+            InstanceIds = batch_instance_ids,
+            Parameters = {'commands': [ssm_script]},
+            Comment = comment,
+            TimeoutSeconds = timeout_seconds,
+            MaxConcurrency = SSM_MAX_CONCURRENCY,
+            MaxErrors = SSM_MAX_ERRORS
+        )
+        command_id = send_command_response['Command']['CommandId']
+        logger.info(f"Sent SSM command {command_id} to {len(batch_instance_ids)} instances")
+        commands[command_id] = batch_instance_ids
+    return commands
+
+def get_command_statuses(ssm_client, command_id):
+    statuses = {}
+    list_command_invocations_paginator = ssm_client.get_paginator('list_command_invocations')
+    for response in list_command_invocations_paginator.paginate(CommandId=command_id):
+        for command_invocation in response['CommandInvocations']:
+            statuses[command_invocation['InstanceId']] = command_invocation['Status']
+    return statuses
+
+def wait_for_commands(ssm_client, commands, context):
+    '''
+    Poll the commands until all of the instances complete or the lambda is about to time out.
+
+    Returns a dict of instance ids and their command status.
+    '''
+    instance_statuses = {}
+    pending_command_ids = list(commands.keys())
+    delay = 5
+    while pending_command_ids:
+        for command_id in list(pending_command_ids):
+            statuses = get_command_statuses(ssm_client, command_id)
+            for instance_id in commands[command_id]:
+                # Invocations aren't created for instances that weren't sent the command because MaxErrors was exceeded.
+                instance_statuses[instance_id] = statuses.get(instance_id, 'Pending')
+            if not [instance_id for instance_id in commands[command_id] if instance_statuses[instance_id] in SSM_IN_PROGRESS_STATUSES]:
+                pending_command_ids.remove(command_id)
+        if not pending_command_ids:
+            break
+        if context.get_remaining_time_in_millis() < (delay + 30) * 1000:
+            logger.warning("Stopped waiting for commands because the lambda is about to time out.")
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
+    return instance_statuses
+
+def get_summary(instance_statuses, security_group_errors):
+    status_counts = {}
+    for status in instance_statuses.values():
+        status_counts[status] = status_counts.get(status, 0) + 1
+    summary = f"{len(instance_statuses)} login nodes: " + ', '.join([f"{status}={count}" for status, count in sorted(status_counts.items())])
+    failed_instance_ids = sorted([instance_id for instance_id, status in instance_statuses.items() if status != 'Success'])
+    if failed_instance_ids:
+        summary += "\nNot configured:\n" + '\n'.join([f"    {instance_id}: {instance_statuses[instance_id]}" for instance_id in failed_instance_ids])
+    if security_group_errors:
+        summary += "\nSecurity group not attached:\n" + '\n'.join([f"    {instance_id}: {error}" for instance_id, error in sorted(security_group_errors.items())])
+    return summary, failed_instance_ids
+
 def lambda_handler(event, context):
     try:
         logger.info(f"event:\n{json.dumps(event, indent=4)}")
@@ -45,60 +206,16 @@ def lambda_handler(event, context):
 
         ec2_client = boto3.client('ec2', region_name=cluster_region)
 
-        login_node_instance_ids = []
-        for external_login_node_config in external_login_nodes_config:
-            slurm_login_node_sg_id = external_login_node_config.get('SecurityGroupId', None)
-
-            tags_message = ''
-            describe_instances_kwargs = {
-                'Filters': [
-                    {'Name': 'instance-state-name', 'Values': ['running']}
-                ]
-            }
-            for tag_dict in external_login_node_config['Tags']:
-                tag = tag_dict['Key']
-                values = tag_dict['Values']
-                tags_message += f"\n{tag}: {values}"
-                describe_instances_kwargs['Filters'].append(
-                    {'Name': f"tag:{tag}", 'Values': values}
-                )
-            logger.info(f"Configure instances with the following tags as login nodes:{tags_message}")
-
-            describe_instances_paginator = ec2_client.get_paginator('describe_instances')
-            describe_instances_iterator = describe_instances_paginator.paginate(**describe_instances_kwargs)
-            reservation_index = 0
-            for response in describe_instances_iterator:
-                for reservation_info in response['Reservations']:
-                    logger.info(f"reservation[{reservation_index}]:")
-                    reservation_index += 1
-                    instance_index = 0
-                    for instance_info in reservation_info['Instances']:
-                        logger.info(f"    instance[{instance_index}]:")
-                        instance_index += 1
-                        logger.info(f"        instance_id: {instance_info['InstanceId']}")
-                        if instance_info['State']['Name'] != 'running':
-                            logger.info(f"            Skipping because state = {instance_info['State']['Name']}")
-                            continue
-                        instance_id = instance_info['InstanceId']
-                        login_node_instance_ids.append(instance_id)
-                        security_group_ids = []
-                        for security_group_dict in instance_info['SecurityGroups']:
-                            security_group_ids.append(security_group_dict['GroupId'])
-                        if slurm_login_node_sg_id:
-                            if slurm_login_node_sg_id not in security_group_ids:
-                                # Attach the security group
-                                logger.info(f"Attaching {slurm_login_node_sg_id} to {instance_id}.")
-                                security_group_ids.append(slurm_login_node_sg_id)
-                                ec2_client.modify_instance_attribute(InstanceId=instance_id, Groups=security_group_ids)
-                            else:
-                                logger.info(f"{slurm_login_node_sg_id} already attached to {instance_id}")
-
+        login_node_instances = get_login_node_instances(ec2_client, external_login_nodes_config)
+        login_node_instance_ids = sorted(login_node_instances.keys())
         if login_node_instance_ids:
-            logger.info(f"Found {len(login_node_instance_ids)} login nodes. instance_ids:" + "\n".join(login_node_instance_ids))
+            logger.info(f"Found {len(login_node_instance_ids)} login nodes. instance_ids:\n" + "\n".join(login_node_instance_ids))
         else:
             logger.info("No running login nodes.")
             return
 
+        security_group_errors = attach_security_groups(ec2_client, login_node_instances)
+
         ssm_client = boto3.client('ssm', region_name=cluster_region)
 
         ssm_script = dedent(f"""
@@ -122,14 +239,37 @@ def lambda_handler(event, context):
 
         TIMEOUT_MINUTES = 90
         TIMEOUT_SECONDS = TIMEOUT_MINUTES * 60
-        send_command_response = ssm_client.send_command(
-            DocumentName = 'AWS-RunShellScript',
-            InstanceIds = login_node_instance_ids,
-            Parameters = {'commands': [ssm_script]},
-            Comment = f"Configure external login nodes for {cluster_name}",
-            TimeoutSeconds = TIMEOUT_SECONDS
-        )
-        logger.info(f"Sent SSM command {send_command_response['Command']['CommandId']}")
+        commands = send_commands(ssm_client, login_node_instance_ids, ssm_script, f"Configure external login nodes for {cluster_name}", TIMEOUT_SECONDS)
+
+        # If the state machine exists then let it wait for the commands and report failures.
+        state_machine_arn = environ.get('SsmCommandWaiterStateMachineArn', '')
+        if state_machine_arn:
+            sfn_client = boto3.client('stepfunctions', region_name=cluster_region)
+            for command_id, instance_ids in commands.items():
+                start_execution_response = sfn_client.start_execution(
+                    stateMachineArn = state_machine_arn,
+                    name = f"ConfigureExternalLoginNodes-{command_id}",
+                    input = json.dumps({
+                        'ClusterName': cluster_name,
+                        'Region': cluster_region,
+                        'CommandId': command_id,
+                        'InstanceIds': instance_ids,
+                        'Description': 'ConfigureExternalLoginNodes',
+                        # Give the instances a few minutes past the command timeout to report their status.
+                        'Deadline': int(time.time()) + TIMEOUT_SECONDS + 5 * 60
+                    })
+                )
+                logger.info(f"Started {start_execution_response['executionArn']} to wait for {command_id}")
+            if security_group_errors:
+                summary, failed_instance_ids = get_summary({}, security_group_errors)
+                raise RuntimeError(summary)
+            return
+
+        instance_statuses = wait_for_commands(ssm_client, commands, context)
+        summary, failed_instance_ids = get_summary(instance_statuses, security_group_errors)
+        logger.info(summary)
+        if failed_instance_ids or security_group_errors:
+            raise RuntimeError(summary)
 
     except Exception as e:
         logger.exception(str(e))
@@ -23,6 +23,7 @@ import boto3
 import json
 import logging
 from os import environ as environ
+import time
 
 logger=logging.getLogger(__file__)
 logger_formatter = logging.Formatter('%(levelname)s: %(message)s')
@@ -101,16 +102,36 @@ fi
 
 sudo $script
         """
+        TIMEOUT_SECONDS = 5 * 60
         send_command_response = ssm_client.send_command(
             DocumentName = 'AWS-RunShellScript',
             InstanceIds = [domain_joined_instance_id],
             Parameters = {'commands': [commands]},
             Comment = f"Configure users and groups for {cluster_name}",
-            TimeoutSeconds = 5 * 60 # 5 minutes
+            TimeoutSeconds = TIMEOUT_SECONDS
         )
         command_id = send_command_response['Command']['CommandId']
         logger.info(f"Sent SSM command {command_id}")
 
+        # If the state machine exists then let it wait for the command and report failures.
+        state_machine_arn = environ.get('SsmCommandWaiterStateMachineArn', '')
+        if state_machine_arn:
+            sfn_client = boto3.client('stepfunctions', region_name=cluster_region)
+            start_execution_response = sfn_client.start_execution(
+                stateMachineArn = state_machine_arn,
+                name = f"ConfigureUsersGroupsJson-{command_id}",
+                input = json.dumps({
+                    'ClusterName': cluster_name,
+                    'Region': cluster_region,
+                    'CommandId': command_id,
+                    'InstanceIds': [domain_joined_instance_id],
+                    'Description': 'ConfigureUsersGroupsJson',
+                    'Deadline': int(time.time()) + TIMEOUT_SECONDS + 5 * 60
+                })
+            )
+            logger.info(f"Started {start_execution_response['executionArn']} to wait for {command_id}")
+            return
+
         # Wait for SSM command to complete
         MAX_WAIT_TIME = 15 * 60
         DELAY = 10
@@ -20,17 +20,20 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 Create/update/delete ParallelCluster AMI build configuration files and store them in S3.
 
 Don't fail if can't create build-files so that cluster can successfully deploy.
+
+The parent AMIs for all of the distributions, versions, and architectures are looked up concurrently.
+The image metadata returned by the lookups is cached so that the root volume size doesn't need another describe_images call.
+Build files are only written if their content changed so that pipelines triggered by S3 changes don't run needlessly.
 '''
 import boto3
 import cfnresponse
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha512
 from jinja2 import Template as Template
 import json
 import logging
 from os import environ as environ
-import pcluster.lib as pc
-from pcluster.api.errors import BadRequestException, UpdateClusterBadRequestException
-from time import sleep
-import yaml
+from threading import Lock
 
 logger=logging.getLogger(__file__)
 logger_formatter = logging.Formatter('%(levelname)s: %(message)s')
@@ -42,6 +45,28 @@ logger.propagate = False
 
 ec2_client = boto3.client('ec2')
 
+MAX_WORKERS = 8
+
+# Image metadata indexed by image id.
+# Filled in by the describe_images calls that search for images so that the root volume size can be looked up without another call.
+image_cache = {}
+image_cache_lock = Lock()
+
+def describe_images_with_filters(filters):
+    response = ec2_client.describe_images(
+        Filters = filters
+    )
+    logger.debug(f"Images:\n{json.dumps(response['Images'], indent=4)}")
+    with image_cache_lock:
+        for image in response['Images']:
+            image_cache[image['ImageId']] = image
+    return response['Images']
+
+def get_latest_image_id(images):
+    if not images:
+        return None
+    return max(images, key=lambda image: image['CreationDate'])['ImageId']
+
 def get_image_builder_parent_image(distribution, version, architecture, parallelcluster_version):
     filters = [
         {'Name': 'architecture', 'Values': [architecture]},
@@ -62,15 +87,7 @@ def get_image_builder_parent_image(distribution, version, architecture, parallel
                 {'Name': 'name', 'Values': [f"aws-parallelcluster-{parallelcluster_version}-{distribution}{version}*"]},
             ],
         )
-    response = ec2_client.describe_images(
-        Filters = filters
-    )
-    logger.debug(f"Images:\n{json.dumps(response['Images'], indent=4)}")
-    images = sorted(response['Images'], key=lambda image: image['CreationDate'], reverse=True)
-    if not images:
-        return None
-    image_id = images[0]['ImageId']
-    return image_id
+    return get_latest_image_id(describe_images_with_filters(filters))
 
 def get_fpga_developer_image(distribution, version, architecture):
     valid_distributions = {
@@ -99,24 +116,68 @@ def get_fpga_developer_image(distribution, version, architecture):
             {'Name': 'name', 'Values': [name_filter]},
         ],
     )
-    response = ec2_client.describe_images(
-        Filters = filters
-    )
-    logger.debug(f"Images:\n{json.dumps(response['Images'], indent=4)}")
-    images = sorted(response['Images'], key=lambda image: image['CreationDate'], reverse=True)
-    if not images:
-        return None
-    image_id = images[0]['ImageId']
-    return image_id
+    return get_latest_image_id(describe_images_with_filters(filters))
 
 def get_ami_root_volume_size(image_id: str):
-    response = ec2_client.describe_images(
-        ImageIds = [image_id]
-    )
-    logger.debug(f"{json.dumps(response, indent=4)}")
-    root_volume_size = response['Images'][0]['BlockDeviceMappings'][0]['Ebs']['VolumeSize']
+    with image_cache_lock:
+        image = image_cache.get(image_id, None)
+    if not image:
+        response = ec2_client.describe_images(
+            ImageIds = [image_id]
+        )
+        logger.debug(f"{json.dumps(response, indent=4)}")
+        image = response['Images'][0]
+        with image_cache_lock:
+            image_cache[image_id] = image
+    root_volume_size = image['BlockDeviceMappings'][0]['Ebs']['VolumeSize']
     return root_volume_size
 
+def get_parent_images(distribution, version, architecture, parallelcluster_version):
+    '''
+    Get the parent images and root volume sizes for one distribution, version, and architecture.
+    '''
+    parent_images = {
+        'ParentImage': None,
+        'RootVolumeSize': None,
+        'FpgaParentImage': None,
+        'FpgaRootVolumeSize': None
+    }
+    parent_images['ParentImage'] = get_image_builder_parent_image(distribution, version, architecture, parallelcluster_version)
+    if not parent_images['ParentImage']:
+        return parent_images
+    parent_images['RootVolumeSize'] = int(get_ami_root_volume_size(parent_images['ParentImage'])) + 10
+    parent_images['FpgaParentImage'] = get_fpga_developer_image(distribution, version, architecture)
+    if parent_images['FpgaParentImage']:
+        parent_images['FpgaRootVolumeSize'] = int(get_ami_root_volume_size(parent_images['FpgaParentImage'])) + 10
+    return parent_images
+
+def put_object_if_changed(s3_client, bucket, key, content):
+    '''
+    Write the object only if its hash is different than the hash saved in the existing object's metadata.
+
+    Returns True if the object was written.
+    '''
+    content_hash = sha512(bytes(content, 'utf-8')).hexdigest()
+    try:
+        response = s3_client.head_object(
+            Bucket = bucket,
+            Key    = key
+        )
+        if response.get('Metadata', {}).get('sha512', None) == content_hash:
+            logger.info(f"s3://{bucket}/{key} unchanged")
+            return False
+    except Exception as e:
+        # Doesn't exist or can't be read so write it.
+        logger.debug(f"head_object s3://{bucket}/{key} failed: {e}")
+    s3_client.put_object(
+        Bucket   = bucket,
+        Key      = key,
+        Body     = content,
+        Metadata = {'sha512': content_hash}
+    )
+    logger.info(f"Wrote s3://{bucket}/{key}")
+    return True
+
 def lambda_handler(event, context):
     try:
         logger.info(f"event:\n{json.dumps(event, indent=4)}")
@@ -180,97 +241,64 @@ def lambda_handler(event, context):
             build_file_template_content = response['Body'].read().decode('utf-8')
             build_file_template = Template(build_file_template_content)
 
-        error_count = 0
-        error_messages = []
+        # Look up the parent images concurrently
+        builds = []
         for distribution in ami_builds:
             for version in ami_builds[distribution]:
                 for architecture in ami_builds[distribution][version]:
-                    if architecture == 'arm64':
-                        template_vars['InstanceType'] = 'c6g.2xlarge'
-                    else:
-                        template_vars['InstanceType'] = 'c6i.2xlarge'
-                    template_vars['ParentImage'] = get_image_builder_parent_image(distribution, version, architecture, parallelcluster_version)
-                    if not template_vars['ParentImage']:
-                        error_count += 1
-                        error_message = f"No parent AMI found for {distribution} {version} {architecture}"
-                        logger.error(error_message)
-                        error_messages.append(error_message)
-                        continue
-                    template_vars['RootVolumeSize'] = int(get_ami_root_volume_size(template_vars['ParentImage'])) + 10
-                    logger.info(f"{distribution}-{version}-{architecture} image id: {template_vars['ParentImage']} root volume size={template_vars['RootVolumeSize']}")
-
-                    # Base image without EDA packages
-                    template_vars['ImageName'] = f"parallelcluster-{parallelcluster_version_name}-{distribution}-{version}-{architecture}".replace('_', '-')
-                    logger.info(f"Creating build config file for {template_vars['ImageName']}")
-                    template_vars['ComponentS3Url'] = None
-                    build_file_s3_key = f"{assets_base_key}/config/build-files/{template_vars['ImageName']}.yml"
-                    if requestType == 'Delete':
-                        response = s3_client.delete_object(
-                            Bucket = assets_bucket,
-                            Key    = build_file_s3_key
-                        )
-                    else:
-                        build_file_content = build_file_template.render(**template_vars)
-                        s3_client.put_object(
-                            Bucket = assets_bucket,
-                            Key    = build_file_s3_key,
-                            Body   = build_file_content
-                        )
-
-                    # Image with rootless Docker installed
-                    template_vars['ImageName'] = f"parallelcluster-{parallelcluster_version_name}-docker-{distribution}-{version}-{architecture}".replace('_', '-')
-                    template_vars['ComponentS3Url'] = environ['InstallDockerScriptS3Url']
-                    build_file_s3_key = f"{assets_base_key}/config/build-files/{template_vars['ImageName']}.yml"
-                    if requestType == 'Delete':
-                        response = s3_client.delete_object(
-                            Bucket = assets_bucket,
-                            Key    = build_file_s3_key
-                        )
-                    else:
-                        build_file_content = build_file_template.render(**template_vars)
-                        s3_client.put_object(
-                            Bucket = assets_bucket,
-                            Key    = build_file_s3_key,
-                            Body   = build_file_content
-                        )
-
-                    # Image with EDA packages
-                    template_vars['ImageName'] = f"parallelcluster-{parallelcluster_version_name}-eda-{distribution}-{version}-{architecture}".replace('_', '-')
-                    template_vars['ComponentS3Url'] = environ['ConfigureEdaScriptS3Url']
-                    build_file_s3_key = f"{assets_base_key}/config/build-files/{template_vars['ImageName']}.yml"
-                    if requestType == 'Delete':
-                        response = s3_client.delete_object(
-                            Bucket = assets_bucket,
-                            Key    = build_file_s3_key
-                        )
-                    else:
-                        build_file_content = build_file_template.render(**template_vars)
-                        s3_client.put_object(
-                            Bucket = assets_bucket,
-                            Key    = build_file_s3_key,
-                            Body   = build_file_content
-                        )
-
-                    template_vars['ParentImage'] = get_fpga_developer_image(distribution, version, architecture)
-                    if not template_vars['ParentImage']:
-                        logger.info(f"No FPGA Developer AMI found for {distribution}{version} {architecture}")
-                        continue
-                    template_vars['ImageName'] = f"parallelcluster-{parallelcluster_version_name}-fpga-{distribution}-{version}-{architecture}".replace('_', '-')
-                    template_vars['RootVolumeSize'] = int(get_ami_root_volume_size(template_vars['ParentImage'])) + 10
-                    logger.info(f"{distribution}-{version}-{architecture} fpga developer image id: {template_vars['ParentImage']} root volume size={template_vars['RootVolumeSize']}")
-                    build_file_s3_key = f"{assets_base_key}/config/build-files/{template_vars['ImageName']}.yml"
-                    if requestType == 'Delete':
-                        response = s3_client.delete_object(
-                            Bucket = assets_bucket,
-                            Key    = build_file_s3_key
-                        )
-                    else:
-                        build_file_content = build_file_template.render(**template_vars)
-                        s3_client.put_object(
-                            Bucket = assets_bucket,
-                            Key    = build_file_s3_key,
-                            Body   = build_file_content
-                        )
+                    builds.append((distribution, version, architecture))
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = [executor.submit(get_parent_images, distribution, version, architecture, parallelcluster_version) for (distribution, version, architecture) in builds]
+            parent_images_list = [future.result() for future in futures]
+
+        error_count = 0
+        error_messages = []
+        build_files = {}
+        for (distribution, version, architecture), parent_images in zip(builds, parent_images_list):
+            if architecture == 'arm64':
+                template_vars['InstanceType'] = 'c6g.2xlarge'
+            else:
+                template_vars['InstanceType'] = 'c6i.2xlarge'
+            template_vars['ParentImage'] = parent_images['ParentImage']
+            if not template_vars['ParentImage']:
+                error_count += 1
+                error_message = f"No parent AMI found for {distribution} {version} {architecture}"
+                logger.error(error_message)
+                error_messages.append(error_message)
+                continue
+            template_vars['RootVolumeSize'] = parent_images['RootVolumeSize']
+            logger.info(f"{distribution}-{version}-{architecture} image id: {template_vars['ParentImage']} root volume size={template_vars['RootVolumeSize']}")
+
+            # Base image without EDA packages
+            template_vars['ImageName'] = f"parallelcluster-{parallelcluster_version_name}-{distribution}-{version}-{architecture}".replace('_', '-')
+            logger.info(f"Creating build config file for {template_vars['ImageName']}")
+            template_vars['ComponentS3Url'] = None
+            build_files[f"{assets_base_key}/config/build-files/{template_vars['ImageName']}.yml"] = build_file_template.render(**template_vars)
+
+            # Image with rootless Docker installed
+            template_vars['ImageName'] = f"parallelcluster-{parallelcluster_version_name}-docker-{distribution}-{version}-{architecture}".replace('_', '-')
+            template_vars['ComponentS3Url'] = environ['InstallDockerScriptS3Url']
+            build_files[f"{assets_base_key}/config/build-files/{template_vars['ImageName']}.yml"] = build_file_template.render(**template_vars)
+
+            # Image with EDA packages
+            template_vars['ImageName'] = f"parallelcluster-{parallelcluster_version_name}-eda-{distribution}-{version}-{architecture}".replace('_', '-')
+            template_vars['ComponentS3Url'] = environ['ConfigureEdaScriptS3Url']
+            build_files[f"{assets_base_key}/config/build-files/{template_vars['ImageName']}.yml"] = build_file_template.render(**template_vars)
+
+            template_vars['ParentImage'] = parent_images['FpgaParentImage']
+            if not template_vars['ParentImage']:
+                logger.info(f"No FPGA Developer AMI found for {distribution}{version} {architecture}")
+                continue
+            template_vars['ImageName'] = f"parallelcluster-{parallelcluster_version_name}-fpga-{distribution}-{version}-{architecture}".replace('_', '-')
+            template_vars['RootVolumeSize'] = parent_images['FpgaRootVolumeSize']
+            logger.info(f"{distribution}-{version}-{architecture} fpga developer image id: {template_vars['ParentImage']} root volume size={template_vars['RootVolumeSize']}")
+            build_files[f"{assets_base_key}/config/build-files/{template_vars['ImageName']}.yml"] = build_file_template.render(**template_vars)
+
+        # Only write the build files that changed
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = [executor.submit(put_object_if_changed, s3_client, assets_bucket, build_file_s3_key, build_file_content) for build_file_s3_key, build_file_content in build_files.items()]
+            number_written = len([future for future in futures if future.result()])
+        logger.info(f"Wrote {number_written} of {len(build_files)} build files. {len(build_files) - number_written} were unchanged.")
 
         if error_count:
             message = f"Errors occurred when creating build config files."
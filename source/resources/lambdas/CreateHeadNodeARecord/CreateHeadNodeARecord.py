@@ -20,6 +20,12 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 Create an A record for the ParallelCluster head node.
 
 This should be called by on_head_node_started.sh.
+The SNS message can be json with the HeadNodeInstanceId so that the head node can be described directly instead of searched for.
+Compute nodes can also publish to the topic so the message is only a hint.
+The instance is checked to be the cluster's running head node and its IP address is always read from EC2.
+
+The hosted zone id is cached for the life of the lambda container and the A record is looked up directly by name.
+The record is written with UPSERT so that it is idempotent and also corrects the record if the head node is replaced.
 
 Note: The hosted zone name has a global name space and isn't guaranteed to be unique.
 Account could have clusters with the same name in different VPCs and different regions.
@@ -37,6 +43,110 @@ logger.addHandler(logger_streamHandler)
 logger.setLevel(logging.INFO)
 logger.propagate = False
 
+# Hosted zone ids indexed by (hosted zone name, vpc id, region).
+# Persists across invocations while the lambda container is warm.
+hosted_zone_id_cache = {}
+
+def get_hosted_zone_id(route53_client, hosted_zone_name, vpc_id, region):
+    cache_key = (hosted_zone_name, vpc_id, region)
+    if cache_key in hosted_zone_id_cache:
+        logger.info(f"{hosted_zone_name} hosted zone id: {hosted_zone_id_cache[cache_key]} (cached)")
+        return hosted_zone_id_cache[cache_key]
+
+    hosted_zone_id = None
+    kwargs = {
+        'VPCId': vpc_id,
+        'VPCRegion': region
+    }
+    done = False
+    while not hosted_zone_id and not done:
+        response = route53_client.list_hosted_zones_by_vpc(**kwargs)
+        for hosted_zone_summary in response['HostedZoneSummaries']:
+            if hosted_zone_summary['Name'] == hosted_zone_name:
+                hosted_zone_id = hosted_zone_summary['HostedZoneId']
+                logger.info(f"{hosted_zone_name} hosted zone id: {hosted_zone_id}")
+                break
+        if response.get('NextToken', None):
+            kwargs['NextToken'] = response['NextToken']
+        else:
+            done = True
+    if not hosted_zone_id:
+        raise ValueError(f"No private hosted zone named {hosted_zone_name} found.")
+    hosted_zone_id_cache[cache_key] = hosted_zone_id
+    return hosted_zone_id
+
+def get_a_record_ip_addresses(route53_client, hosted_zone_id, record_name):
+    '''
+    Look up the A record directly instead of listing all of the records in the zone.
+
+    Returns the list of IP addresses in the record or None if it doesn't exist.
+    '''
+    response = route53_client.list_resource_record_sets(
+        HostedZoneId = hosted_zone_id,
+        StartRecordName = record_name,
+        StartRecordType = 'A',
+        MaxItems = '1'
+    )
+    for resource_record_set_info in response['ResourceRecordSets']:
+        if resource_record_set_info['Name'] == record_name and resource_record_set_info['Type'] == 'A':
+            return [resource_record['Value'] for resource_record in resource_record_set_info.get('ResourceRecords', [])]
+    return None
+
+def get_head_node_instance_id_from_message(event):
+    '''
+    Get the head node's instance id from the SNS message if it was sent.
+    '''
+    try:
+        message = json.loads(event['Records'][0]['Sns']['Message'])
+        return message.get('HeadNodeInstanceId', None)
+    except Exception:
+        return None
+
+def is_running_head_node(instance_dict, cluster_name):
+    tags = {tag['Key']: tag['Value'] for tag in instance_dict.get('Tags', [])}
+    return (
+        tags.get('parallelcluster:cluster-name', None) == cluster_name and
+        tags.get('parallelcluster:node-type', None) == 'HeadNode' and
+        instance_dict.get('State', {}).get('Name', None) == 'running'
+    )
+
+def get_head_node_from_instance_id(ec2_client, cluster_name, instance_id):
+    '''
+    Describe the instance and return its id and private IP address if it is the cluster's running head node.
+
+    Returns (None, None) if it isn't.
+    '''
+    try:
+        reservations = ec2_client.describe_instances(InstanceIds=[instance_id])['Reservations']
+    except ec2_client.exceptions.ClientError as e:
+        logger.warning(f"Couldn't describe {instance_id}: {e}")
+        return None, None
+    for reservation_dict in reservations:
+        for instance_dict in reservation_dict['Instances']:
+            if is_running_head_node(instance_dict, cluster_name) and instance_dict.get('PrivateIpAddress', None):
+                return instance_dict['InstanceId'], instance_dict['PrivateIpAddress']
+    logger.warning(f"{instance_id} isn't the running head node of {cluster_name}")
+    return None, None
+
+def get_head_node_from_ec2(ec2_client, cluster_name):
+    head_node_ip_address = None
+    head_node_instance_id = None
+    describe_instances_paginator = ec2_client.get_paginator('describe_instances')
+    describe_instances_kwargs = {
+        'Filters': [
+            {'Name': 'tag:parallelcluster:cluster-name', 'Values': [cluster_name]},
+            {'Name': 'tag:parallelcluster:node-type', 'Values': ['HeadNode']},
+            {'Name': 'instance-state-name', 'Values': ['running']}
+        ]
+    }
+    for describe_instances_response in describe_instances_paginator.paginate(**describe_instances_kwargs):
+        for reservation_dict in describe_instances_response['Reservations']:
+            for instance_dict in reservation_dict['Instances']:
+                head_node_ip_address = instance_dict.get('PrivateIpAddress', None)
+                if head_node_ip_address:
+                    head_node_instance_id = instance_dict['InstanceId']
+    return head_node_instance_id, head_node_ip_address
+
 def lambda_handler(event, context):
     try:
         logger.info(f"event:\n{json.dumps(event, indent=4)}")
@@ -51,68 +161,44 @@ def lambda_handler(event, context):
 
         # Get the ParallelCluster hosted zone
         hosted_zone_name = f"{cluster_name}.pcluster."
-        hosted_zone_id = None
-        kwargs = {
-            'VPCId': vpc_id,
-            'VPCRegion': cluster_region
-        }
-        done = False
-        while not hosted_zone_id and not done:
-            response = route53_client.list_hosted_zones_by_vpc(**kwargs)
-            for hosted_zone_summary in response['HostedZoneSummaries']:
-                if hosted_zone_summary['Name'] == hosted_zone_name:
-                    hosted_zone_id = hosted_zone_summary['HostedZoneId']
-                    logger.info(f"{hosted_zone_name} hosted zone id: {hosted_zone_id}")
-                    break
-            if response.get('NextToken', None):
-                kwargs['NextToken'] = response['NextToken']
-            else:
-                done = True
-        if not hosted_zone_id:
-            raise ValueError(f"No private hosted zone named {hosted_zone_name} found.")
-
-        # Check to see if the A record already exists
-        list_resource_record_sets_paginator = route53_client.get_paginator('list_resource_record_sets')
-        list_resource_record_sets_iterator = list_resource_record_sets_paginator.paginate(HostedZoneId=hosted_zone_id)
-        head_node_a_record_name = f"head_node.{hosted_zone_name}"
-        for response in list_resource_record_sets_iterator:
-            for resource_record_set_info in response['ResourceRecordSets']:
-                if resource_record_set_info['Type'] != 'A':
-                    continue
-                if resource_record_set_info['Name'] == head_node_a_record_name:
-                    logger.info(f"{head_node_a_record_name} A record already exists")
-                    return
+        hosted_zone_id = get_hosted_zone_id(route53_client, hosted_zone_name, vpc_id, cluster_region)
 
-        logger.info(f"Creating {head_node_a_record_name} A record.")
-
-        head_node_ip_address = None
-        head_node_instance_id = None
         ec2_client = boto3.client('ec2', region_name=cluster_region)
-        describe_instances_paginator = ec2_client.get_paginator('describe_instances')
-        describe_instances_kwargs = {
-            'Filters': [
-                {'Name': 'tag:parallelcluster:cluster-name', 'Values': [cluster_name]},
-                {'Name': 'tag:parallelcluster:node-type', 'Values': ['HeadNode']},
-                {'Name': 'instance-state-name', 'Values': ['running']}
-            ]
-        }
-        for describe_instances_response in describe_instances_paginator.paginate(**describe_instances_kwargs):
-            for reservation_dict in describe_instances_response['Reservations']:
-                for instance_dict in reservation_dict['Instances']:
-                    head_node_ip_address = instance_dict.get('PrivateIpAddress', None)
-                    if head_node_ip_address:
-                        head_node_instance_id = instance_dict['InstanceId']
+        head_node_ip_address = None
+        head_node_instance_id = get_head_node_instance_id_from_message(event)
+        if head_node_instance_id:
+            head_node_instance_id, head_node_ip_address = get_head_node_from_instance_id(ec2_client, cluster_name, head_node_instance_id)
+        if not head_node_ip_address:
+            head_node_instance_id, head_node_ip_address = get_head_node_from_ec2(ec2_client, cluster_name)
         if not head_node_ip_address:
             raise ValueError(f"No head node private IP address found for {cluster_name}")
         logger.info(f"head node instance id: {head_node_instance_id}")
         logger.info(f"head node ip address: {head_node_ip_address}")
 
+        # Check to see if the A record already exists
+        head_node_a_record_name = f"head_node.{hosted_zone_name}"
+        try:
+            ip_addresses = get_a_record_ip_addresses(route53_client, hosted_zone_id, head_node_a_record_name)
+        except route53_client.exceptions.NoSuchHostedZone:
+            # The cached zone was deleted. For example, the cluster was deleted and recreated.
+            logger.info(f"{hosted_zone_id} doesn't exist anymore. Looking up {hosted_zone_name} again.")
+            hosted_zone_id_cache.clear()
+            hosted_zone_id = get_hosted_zone_id(route53_client, hosted_zone_name, vpc_id, cluster_region)
+            ip_addresses = get_a_record_ip_addresses(route53_client, hosted_zone_id, head_node_a_record_name)
+        if ip_addresses == [str(head_node_ip_address)]:
+            logger.info(f"{head_node_a_record_name} A record already exists")
+            return
+        if ip_addresses:
+            logger.info(f"Updating {head_node_a_record_name} A record from {ip_addresses}.")
+        else:
+            logger.info(f"Creating {head_node_a_record_name} A record.")
+
         route53_client.change_resource_record_sets(
             HostedZoneId = hosted_zone_id,
             ChangeBatch = {
                 'Changes': [
                     {
-                        'Action': 'CREATE',
+                        'Action': 'UPSERT',
                         'ResourceRecordSet': {
                             'Name': head_node_a_record_name,
                             'Type': 'A',
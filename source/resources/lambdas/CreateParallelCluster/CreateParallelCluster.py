@@ -25,9 +25,8 @@ from jinja2 import Template as Template
 import json
 import logging
 from os import environ as environ
-import pcluster.lib as pc
-from pcluster.api.errors import BadRequestException, UpdateClusterBadRequestException
 from time import sleep
+import urllib.request
 import yaml
 
 logger=logging.getLogger(__file__)
@@ -38,7 +37,39 @@ logger.addHandler(logger_streamHandler)
 logger.setLevel(logging.INFO)
 logger.propagate = False
 
+# Use the C implementation if it is available because it is much faster.
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+class PclusterNotImported(Exception):
+    '''
+    Placeholder for the pcluster exception classes until pcluster.lib has been imported.
+
+    Nothing raises it so except clauses that reference the pcluster exceptions are valid before the import.
+    '''
+    pass
+
+pc = None
+BadRequestException = PclusterNotImported
+UpdateClusterBadRequestException = PclusterNotImported
+
+def import_pcluster():
+    '''
+    Import pcluster.lib the first time that it is needed.
+
+    pcluster.lib imports most of the ParallelCluster cli so it is slow to load.
+    Deferring it keeps it off of the cold start path for requests that don't call ParallelCluster,
+    for example deleting a cluster that doesn't exist.
+    '''
+    global pc, BadRequestException, UpdateClusterBadRequestException
+    if pc:
+        return
+    logger.info("Importing pcluster.lib")
+    import pcluster.lib
+    from pcluster.api.errors import BadRequestException, UpdateClusterBadRequestException
+    pc = pcluster.lib
+
 def get_clusters(cluster_region):
+    import_pcluster()
     clusters = []
     list_clusters_kwargs = {'region': cluster_region}
     while list_clusters_kwargs:
@@ -51,7 +82,7 @@ def get_clusters(cluster_region):
             clusters.append(cluster)
     return clusters
 
-def get_cluster_status(cluster_name, cluster_region):
+def get_cluster_status_from_list(cluster_name, cluster_region):
     logger.info("Listing clusters to get cluster status")
     cluster_status = None
     for cluster_dict in get_clusters(cluster_region):
@@ -64,6 +95,83 @@ def get_cluster_status(cluster_name, cluster_region):
         break
     return cluster_status
 
+# Same mapping that ParallelCluster uses to get the cluster status from the cluster's stack status
+CLOUDFORMATION_TO_CLUSTER_STATUS = {
+    'CREATE_IN_PROGRESS': 'CREATE_IN_PROGRESS',
+    'CREATE_FAILED': 'CREATE_FAILED',
+    'CREATE_COMPLETE': 'CREATE_COMPLETE',
+    'ROLLBACK_IN_PROGRESS': 'CREATE_FAILED',
+    'ROLLBACK_FAILED': 'CREATE_FAILED',
+    'ROLLBACK_COMPLETE': 'CREATE_FAILED',
+    'DELETE_IN_PROGRESS': 'DELETE_IN_PROGRESS',
+    'DELETE_FAILED': 'DELETE_FAILED',
+    'UPDATE_IN_PROGRESS': 'UPDATE_IN_PROGRESS',
+    'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS': 'UPDATE_IN_PROGRESS',
+    'UPDATE_COMPLETE': 'UPDATE_COMPLETE',
+    'UPDATE_ROLLBACK_IN_PROGRESS': 'UPDATE_FAILED',
+    'UPDATE_ROLLBACK_FAILED': 'UPDATE_FAILED',
+    'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS': 'UPDATE_FAILED',
+    'UPDATE_ROLLBACK_COMPLETE': 'UPDATE_FAILED',
+}
+
+def get_cluster_status(cluster_name, cluster_region):
+    '''
+    Get the status of the cluster or None if it doesn't exist.
+
+    The cluster's CloudFormation stack has the same name as the cluster so the status is looked up directly
+    from the stack without importing pcluster.lib.
+    Only lists all of the clusters in the region if the stack lookup fails for some other reason than the stack not existing.
+    '''
+    logger.info(f"Describing {cluster_name} stack to get cluster status")
+    cfn_client = boto3.client('cloudformation', region_name=cluster_region)
+    try:
+        stack_dict = cfn_client.describe_stacks(StackName=cluster_name)['Stacks'][0]
+    except cfn_client.exceptions.ClientError as e:
+        if 'does not exist' in str(e):
+            logger.info(f"{cluster_name} doesn't exist")
+            return None
+        logger.warning(f"describe_stacks failed so falling back to listing clusters: {e}")
+        return get_cluster_status_from_list(cluster_name, cluster_region)
+    cluster_cloudformation_status = stack_dict['StackStatus']
+    if cluster_cloudformation_status == 'DELETE_COMPLETE':
+        logger.info(f"{cluster_name} doesn't exist")
+        return None
+    cluster_status = CLOUDFORMATION_TO_CLUSTER_STATUS.get(cluster_cloudformation_status, cluster_cloudformation_status)
+    logger.info(f"{cluster_name} exists. Status={cluster_status} and cloudformation status={cluster_cloudformation_status}")
+    return cluster_status
+
+def get_deployed_cluster_config(cluster_name, cluster_region):
+    '''
+    Get the config that the cluster was last created or updated with or None if it can't be read.
+    '''
+    import_pcluster()
+    try:
+        cluster_dict = pc.describe_cluster(
+            cluster_name = cluster_name,
+            region = cluster_region
+        )
+        config_url = cluster_dict['clusterConfiguration']['url']
+        with urllib.request.urlopen(config_url, timeout=30) as fh:
+            return yaml.load(fh.read().decode('utf-8'), Loader=YamlLoader)
+    except Exception as e:
+        logger.warning(f"Couldn't get the deployed config of {cluster_name}: {e}")
+        return None
+
+def config_unchanged(cluster_name, cluster_region, cluster_status, parallel_cluster_config):
+    '''
+    Check if the cluster is stable and already has the config so that update_cluster can be skipped.
+
+    Only used when a Create request is changed to an Update because the cluster already exists.
+    The ParallelClusterConfigHash property only changes when the config changes so a real Update always has a new config.
+    '''
+    if cluster_status not in ['CREATE_COMPLETE', 'UPDATE_COMPLETE']:
+        return False
+    deployed_cluster_config = get_deployed_cluster_config(cluster_name, cluster_region)
+    if deployed_cluster_config == parallel_cluster_config:
+        logger.info(f"{cluster_name} is already deployed with the same config.")
+        return True
+    return False
+
 def lambda_handler(event, context):
     try:
         logger.info(f"event:\n{json.dumps(event, indent=4)}")
@@ -127,10 +235,11 @@ def lambda_handler(event, context):
             Key = yaml_key
         )['Body'].read().decode('utf-8')
 
-        parallel_cluster_config = yaml.load(parallel_cluster_config_yaml, Loader=yaml.FullLoader)
+        parallel_cluster_config = yaml.load(parallel_cluster_config_yaml, Loader=YamlLoader)
         logger.info(f"HeadNode config:\n{json.dumps(parallel_cluster_config['HeadNode'], indent=4)}")
 
         if requestType == "Create":
+            import_pcluster()
             logger.info(f"Creating {cluster_name}")
             try:
                 response = pc.create_cluster(
@@ -158,7 +267,10 @@ def lambda_handler(event, context):
                     Message = message
                 )
                 logger.info(f"Published error to {environ['ErrorSnsTopicArn']}")
+        elif requestType == "Update" and event['RequestType'] == 'Create' and config_unchanged(cluster_name, cluster_region, cluster_status, parallel_cluster_config):
+            logger.info(f"Config is unchanged so skipping update of {cluster_name}")
         elif requestType == "Update":
+            import_pcluster()
             logger.info("Checking compute fleet status.")
             compute_fleet_status = pc.describe_compute_fleet(
                 cluster_name = cluster_name,
@@ -243,6 +355,7 @@ def lambda_handler(event, context):
                     logger.exception("ParallelCluster Update failed.")
 
         elif requestType == 'Delete':
+            import_pcluster()
             logger.info(f"Deleting {cluster_name}")
             try:
                 pc.delete_cluster(
@@ -18,17 +18,17 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 '''
 Create/update/delete ParallelCluster cluster config file and save to S3 as json and yaml.
+
+The sha512 hash of the rendered config is saved in the S3 object's metadata and returned as ConfigYamlHash.
+If the hash didn't change then the config isn't written again.
 '''
 import boto3
 import cfnresponse
 from hashlib import sha512
-from jinja2 import Template as Template
+from jinja2 import Environment, meta
 import json
 import logging
 from os import environ as environ
-import pcluster.lib as pc
-from pcluster.api.errors import BadRequestException, UpdateClusterBadRequestException
-from time import sleep
 import yaml
 
 logger=logging.getLogger(__file__)
@@ -39,6 +39,23 @@ logger.addHandler(logger_streamHandler)
 logger.setLevel(logging.INFO)
 logger.propagate = False
 
+# Use the C implementation if it is available because it is much faster.
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def get_stored_hash(s3_client, bucket, key):
+    '''
+    Get the hash saved in the metadata of the S3 object or None if it doesn't exist.
+    '''
+    try:
+        response = s3_client.head_object(
+            Bucket = bucket,
+            Key = key
+        )
+    except Exception as e:
+        logger.info(f"Couldn't get metadata for s3://{bucket}/{key}: {e}")
+        return None
+    return response.get('Metadata', {}).get('sha512', None)
+
 def lambda_handler(event, context):
     try:
         logger.info(f"event:\n{json.dumps(event, indent=4)}")
@@ -91,31 +108,41 @@ def lambda_handler(event, context):
             except:
                 pass
         else: # Create or Update
-            logger.info(f"Deleting Parallel Cluster yaml config template from {yaml_template_s3_url}")
-            parallel_cluster_config_yaml_template = Template(
-                s3_client.get_object(
-                    Bucket = environ['ParallelClusterConfigS3Bucket'],
-                    Key = yaml_template_key
-                )['Body'].read().decode('utf-8'))
+            logger.info(f"Getting Parallel Cluster yaml config template from {yaml_template_s3_url}")
+            parallel_cluster_config_yaml_template_content = s3_client.get_object(
+                Bucket = environ['ParallelClusterConfigS3Bucket'],
+                Key = yaml_template_key
+            )['Body'].read().decode('utf-8')
+            jinja_environment = Environment()
+            parallel_cluster_config_yaml_template = jinja_environment.from_string(parallel_cluster_config_yaml_template_content)
 
+            # Only pass the environment variables that the template uses.
+            template_var_names = meta.find_undeclared_variables(jinja_environment.parse(parallel_cluster_config_yaml_template_content))
             template_vars = {}
-            for template_var in environ:
-                template_vars[template_var] = environ[template_var]
+            for template_var in sorted(template_var_names):
+                if template_var in environ:
+                    template_vars[template_var] = environ[template_var]
             logger.info(f"template_vars:\n{json.dumps(template_vars, indent=4, sort_keys=True)}")
             parallel_cluster_config_yaml = parallel_cluster_config_yaml_template.render(**template_vars)
 
             parallel_cluster_config_hash.update(bytes(parallel_cluster_config_yaml, 'utf-8'))
             logger.info(f"Config hash: {parallel_cluster_config_hash.hexdigest()}")
 
-            parallel_cluster_config = yaml.load(parallel_cluster_config_yaml, Loader=yaml.FullLoader)
+            # Make sure that the rendered config is valid yaml
+            parallel_cluster_config = yaml.load(parallel_cluster_config_yaml, Loader=YamlLoader)
             logger.info(f"HeadNode config:\n{json.dumps(parallel_cluster_config['HeadNode'], indent=4)}")
 
-            logger.info(f"Saving Parallel Cluster yaml config in {yaml_s3_url}")
-            s3_client.put_object(
-                Bucket = environ['ParallelClusterConfigS3Bucket'],
-                Key = yaml_key,
-                Body = parallel_cluster_config_yaml
-            )
+            stored_hash = get_stored_hash(s3_client, environ['ParallelClusterConfigS3Bucket'], yaml_key)
+            if stored_hash == parallel_cluster_config_hash.hexdigest():
+                logger.info(f"Parallel Cluster yaml config in {yaml_s3_url} is unchanged")
+            else:
+                logger.info(f"Saving Parallel Cluster yaml config in {yaml_s3_url}")
+                s3_client.put_object(
+                    Bucket = environ['ParallelClusterConfigS3Bucket'],
+                    Key = yaml_key,
+                    Body = parallel_cluster_config_yaml,
+                    Metadata = {'sha512': parallel_cluster_config_hash.hexdigest()}
+                )
 
     except Exception as e:
         logger.exception(str(e))
@@ -0,0 +1,196 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+'''
+Check the status of an SSM RunShellScript command that was sent by another lambda.
+
+Called by the SsmCommandWaiter state machine so that the lambda that sent the command doesn't have to block until it completes.
+While the command is still running the lambda raises CommandInProgress and the state machine waits and checks again.
+When the command completes, or the deadline passes, the result is reported.
+The deadline is passed in by the lambda that sent the command so that long running commands can be waited for longer than short ones.
+If the state machine fails for any other reason, for example the lambda is throttled, then the failure is reported.
+If the command was sent on behalf of a CloudFormation custom resource then the custom resource is completed with the command output in the reason so that it shows up in the stack events.
+Otherwise failures are published to the error SNS topic.
+
+Input:
+    ClusterName
+    Region
+    CommandId
+    InstanceIds
+    Description: Used in log messages and notifications.
+    CfnEvent: Optional. The custom resource event to respond to.
+    PhysicalResourceId: Optional. Physical resource id to use in the custom resource response.
+    FailOnCommandError: Optional. If true then the custom resource fails if the command fails. Default: False
+    Deadline: Time, in seconds since the epoch, to stop waiting for the command and report it as timed out.
+        Must be before the state machine timeout and, for custom resources, before the 1 hour CloudFormation timeout.
+    Error: Added by the state machine if the check failed. {'Error': str, 'Cause': str}
+'''
+import boto3
+import cfnresponse
+import json
+import logging
+from os import environ as environ
+import time
+
+logger=logging.getLogger(__file__)
+logger_formatter = logging.Formatter('%(levelname)s: %(message)s')
+logger_streamHandler = logging.StreamHandler()
+logger_streamHandler.setFormatter(logger_formatter)
+logger.addHandler(logger_streamHandler)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+IN_PROGRESS_STATUSES = ['Pending', 'InProgress', 'Delayed', 'Cancelling']
+
+# The whole custom resource response must be less than 4096 bytes.
+MAX_REASON_LENGTH = 3000
+
+class CommandInProgress(Exception):
+    '''
+    Raised while the command is still running.
+
+    The state machine waits and checks again on this error name so don't rename it.
+    '''
+    pass
+
+def get_command_invocations(ssm_client, command_id):
+    '''
+    Returns a dict of the command invocations indexed by instance id.
+    '''
+    command_invocations = {}
+    list_command_invocations_paginator = ssm_client.get_paginator('list_command_invocations')
+    for response in list_command_invocations_paginator.paginate(CommandId=command_id, Details=True):
+        for command_invocation in response['CommandInvocations']:
+            command_invocations[command_invocation['InstanceId']] = command_invocation
+    return command_invocations
+
+def get_command_invocation_output(command_invocation):
+    output = ''
+    for command_plugin in command_invocation.get('CommandPlugins', []):
+        output += command_plugin.get('Output', '')
+    return output
+
+def get_summary(description, instance_ids, command_invocations, timed_out):
+    status_counts = {}
+    for instance_id in instance_ids:
+        status = command_invocations.get(instance_id, {}).get('Status', 'NotStarted')
+        status_counts[status] = status_counts.get(status, 0) + 1
+    summary = f"{description}: " + ', '.join([f"{status}={count}" for status, count in sorted(status_counts.items())])
+    if timed_out:
+        summary = f"Timed out waiting for command. {summary}"
+
+    # Show the output of a failed instance if there is one because that is the most useful.
+    output_instance_id = None
+    for instance_id in instance_ids:
+        if command_invocations.get(instance_id, {}).get('Status', None) not in [None, 'Success']:
+            output_instance_id = instance_id
+            break
+    if not output_instance_id and instance_ids and instance_ids[0] in command_invocations:
+        output_instance_id = instance_ids[0]
+    if output_instance_id:
+        output = get_command_invocation_output(command_invocations[output_instance_id])
+        summary += f"\n{output_instance_id} output:\n"
+        max_output_length = MAX_REASON_LENGTH - len(summary)
+        if len(output) > max_output_length:
+            # Keep the end of the output because that is where errors are.
+            output = '...' + output[-(max_output_length - 3):]
+        summary += output
+    return summary
+
+def lambda_handler(event, context):
+    try:
+        logger.info(f"event:\n{json.dumps(event, indent=4)}")
+
+        cluster_name = event['ClusterName']
+        cluster_region = event['Region']
+        command_id = event['CommandId']
+        instance_ids = event['InstanceIds']
+        description = event.get('Description', f"SSM command {command_id}")
+        cfn_event = event.get('CfnEvent', None)
+        physical_resource_id = event.get('PhysicalResourceId', cluster_name)
+        fail_on_command_error = event.get('FailOnCommandError', False)
+        deadline = event['Deadline']
+        error = event.get('Error', None)
+
+        if error:
+            summary = f"{description}: SsmCommandWaiter failed. {error.get('Error', '')}: {error.get('Cause', '')}"[0:MAX_REASON_LENGTH]
+            logger.error(summary)
+            if cfn_event:
+                cfnresponse.send(cfn_event, context, cfnresponse.FAILED, {'CommandId': command_id}, physicalResourceId=physical_resource_id, reason=summary)
+            if environ.get('ErrorSnsTopicArn', ''):
+                sns_client = boto3.client('sns')
+                sns_client.publish(
+                    TopicArn = environ['ErrorSnsTopicArn'],
+                    Subject = f"{cluster_name} {description} failed"[0:99],
+                    Message = summary
+                )
+                logger.info(f"Published error to {environ['ErrorSnsTopicArn']}")
+            return
+
+        ssm_client = boto3.client('ssm', region_name=cluster_region)
+        command_invocations = get_command_invocations(ssm_client, command_id)
+
+        timed_out = False
+        # Invocations may not have been created yet right after the command was sent.
+        for instance_id in instance_ids:
+            status = command_invocations.get(instance_id, {}).get('Status', 'Pending')
+            if status in IN_PROGRESS_STATUSES:
+                logger.info(f"{description}: {instance_id} status={status}")
+                if time.time() < deadline:
+                    raise CommandInProgress(f"{description}: {instance_id} status={status}")
+                timed_out = True
+                break
+
+        summary = get_summary(description, instance_ids, command_invocations, timed_out)
+        logger.info(summary)
+        failed_instance_ids = [instance_id for instance_id in instance_ids if command_invocations.get(instance_id, {}).get('Status', None) != 'Success']
+        if failed_instance_ids:
+            logger.error(f"{description} didn't succeed on {len(failed_instance_ids)} of {len(instance_ids)} instances: {failed_instance_ids}")
+
+        if cfn_event:
+            if failed_instance_ids and fail_on_command_error:
+                response_status = cfnresponse.FAILED
+            else:
+                response_status = cfnresponse.SUCCESS
+            cfnresponse.send(cfn_event, context, response_status, {'CommandId': command_id}, physicalResourceId=physical_resource_id, reason=summary)
+
+        if failed_instance_ids and environ.get('ErrorSnsTopicArn', ''):
+            sns_client = boto3.client('sns')
+            sns_client.publish(
+                TopicArn = environ['ErrorSnsTopicArn'],
+                Subject = f"{cluster_name} {description} failed"[0:99],
+                Message = summary
+            )
+            logger.info(f"Published error to {environ['ErrorSnsTopicArn']}")
+
+    except CommandInProgress:
+        raise
+
+    except Exception as e:
+        logger.exception(str(e))
+        if event.get('CfnEvent', None):
+            cfnresponse.send(event['CfnEvent'], context, cfnresponse.FAILED, {'error': str(e)}, physicalResourceId=event.get('PhysicalResourceId', None), reason=str(e)[0:MAX_REASON_LENGTH])
+        if environ.get('ErrorSnsTopicArn', ''):
+            sns_client = boto3.client('sns')
+            sns_client.publish(
+                TopicArn = environ['ErrorSnsTopicArn'],
+                Subject = f"{event.get('ClusterName', '')} SsmCommandWaiter failed",
+                Message = str(e)
+            )
+            logger.info(f"Published error to {environ['ErrorSnsTopicArn']}")
+        raise
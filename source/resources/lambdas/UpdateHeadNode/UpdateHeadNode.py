@@ -29,6 +29,7 @@ import json
 import logging
 from os import environ as environ
 from textwrap import dedent
+import time
 
 logger=logging.getLogger(__file__)
 logger_formatter = logging.Formatter('%(levelname)s: %(message)s')
@@ -128,7 +129,7 @@ if ! [ -e $script ]; then
     exit 0
 fi
 
-sudo $script
+sudo $script --changed-roles-only
         """
         send_command_response = ssm_client.send_command(
             DocumentName = 'AWS-RunShellScript',
@@ -141,6 +142,30 @@ sudo $script
 
         # If I wait then the stack creation or update won't finish until the command completes.
         # I like the idea that the stack waits for the update to complete.
+        # If the state machine exists then it waits for the command and completes the custom resource so that this lambda doesn't have to block.
+        state_machine_arn = environ.get('SsmCommandWaiterStateMachineArn', '')
+        if state_machine_arn:
+            sfn_client = boto3.client('stepfunctions', region_name=cluster_region)
+            start_execution_response = sfn_client.start_execution(
+                stateMachineArn = state_machine_arn,
+                name = f"UpdateHeadNode-{command_id}",
+                input = json.dumps({
+                    'ClusterName': cluster_name,
+                    'Region': cluster_region,
+                    'CommandId': command_id,
+                    'InstanceIds': [head_node_instance_id],
+                    'Description': 'UpdateHeadNode',
+                    'CfnEvent': event,
+                    'PhysicalResourceId': cluster_name,
+                    # I want the custom resource to be successful whether script passes or not.
+                    'FailOnCommandError': False,
+                    # Report the result before the 1 hour CloudFormation custom resource timeout.
+                    'Deadline': int(time.time()) + 45 * 60
+                })
+            )
+            logger.info(f"Started {start_execution_response['executionArn']} to wait for {command_id} and complete the custom resource.")
+            return
+
         MAX_WAIT_TIME = 15 * 60
         DELAY = 5
         MAX_ATTEMPTS = int(MAX_WAIT_TIME / DELAY)
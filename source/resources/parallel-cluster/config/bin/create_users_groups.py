@@ -19,11 +19,16 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import argparse
 import grp
+import hashlib
 import json
 import logging
+import os
 import pprint
+import pwd
+import random
 import re
 import subprocess
+from time import sleep
 
 logger = logging.getLogger(__file__)
 logger_formatter = logging.Formatter('%(levelname)s:%(asctime)s: %(message)s')
@@ -51,9 +56,118 @@ RESERVED_GROUPS = [
     'nfsnobody',
     ]
 
+AGENT_SERVICE_NAME = 'slurm_users_groups_sync'
+
+AGENT_SERVICE_FILE = f"/etc/systemd/system/{AGENT_SERVICE_NAME}.service"
+
+def get_file_stat(filename):
+    '''
+    Get the generation of the file from a stat so that we can tell if it changed without reading it.
+
+    A stat is cheap over NFS so this can be checked frequently from a large number of nodes.
+    '''
+    st = os.stat(filename)
+    return {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'ino': st.st_ino}
+
+def get_file_hash(filename):
+    with open(filename, 'rb') as fh:
+        return hashlib.sha512(fh.read()).hexdigest()
+
+def read_state(state_file):
+    if not state_file or not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def write_state(state_file, state):
+    if not state_file:
+        return
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    with open(f"{state_file}.new", 'w') as fh:
+        json.dump(state, fh)
+    os.replace(f"{state_file}.new", state_file)
+
+def sync(filename, state_file=None):
+    '''
+    Create the users and groups if the json file changed since the last time they were created.
+
+    The file's stat is checked first and then its hash so that the file is only read when it changed
+    and the users and groups are only created when its contents changed.
+
+    Returns:
+        bool: True if the users and groups were created.
+    '''
+    state = read_state(state_file)
+    file_stat = get_file_stat(filename)
+    if state.get('stat') == file_stat:
+        logger.debug(f"{filename} hasn't changed")
+        return False
+    file_hash = get_file_hash(filename)
+    if state.get('sha512') != file_hash:
+        main(filename)
+    write_state(state_file, {'stat': file_stat, 'sha512': file_hash})
+    return state.get('sha512') != file_hash
+
+def watch(filename, state_file, interval, jitter):
+    '''
+    Check for changes to the json file forever.
+
+    Each check is delayed by a random jitter so that a fleet of nodes doesn't check the file on the NFS server at the same time.
+    '''
+    logger.info(f"Watching {filename} every {interval}s with up to {jitter}s of jitter")
+    while True:
+        sleep(interval + random.uniform(0, jitter)) # nosec
+        try:
+            if sync(filename, state_file):
+                logger.info(f"Created users and groups from updated {filename}")
+        except FileNotFoundError:
+            logger.warning(f"{filename} doesn't exist")
+        except Exception:
+            logger.exception(f"Error syncing users and groups from {filename}")
+
+def install_agent(filename, state_file, interval, jitter):
+    '''
+    Install a systemd service that runs this script with --watch and remove the old cron job.
+    '''
+    service = f"""[Unit]
+Description=Sync users and groups from {filename}
+After=network-online.target remote-fs.target
+
+[Service]
+Type=simple
+ExecStart={os.path.realpath(__file__)} -i {filename} --state-file {state_file} --watch --interval {interval} --jitter {jitter}
+Restart=always
+RestartSec=60
+Nice=10
+
+[Install]
+WantedBy=multi-user.target
+"""
+    old_service = None
+    if os.path.exists(AGENT_SERVICE_FILE):
+        with open(AGENT_SERVICE_FILE, 'r') as fh:
+            old_service = fh.read()
+    if service != old_service:
+        with open(AGENT_SERVICE_FILE, 'w') as fh:
+            fh.write(service)
+        subprocess.check_call(['systemctl', 'daemon-reload'])
+        subprocess.check_call(['systemctl', 'enable', AGENT_SERVICE_NAME])
+        subprocess.check_call(['systemctl', 'restart', AGENT_SERVICE_NAME])
+        logger.info(f"Installed {AGENT_SERVICE_NAME} service")
+    else:
+        subprocess.check_call(['systemctl', 'enable', '--now', AGENT_SERVICE_NAME])
+    if os.path.exists('/etc/cron.d/slurm_users_groups'):
+        os.remove('/etc/cron.d/slurm_users_groups')
+
 def main(filename):
     with open(filename, 'r') as fh:
         config = json.load(fh)
+    # Check the local user and group databases first so that we only fork useradd and groupadd for missing entries.
+    existing_groups = {group.gr_name for group in grp.getgrall()}
+    existing_users = {user.pw_name for user in pwd.getpwall()}
     invalid_gids = []
     logger.debug(f"Creating {len(config['gids'])} groups:")
     for gid in config['gids'].keys():
@@ -62,6 +176,9 @@ def main(filename):
             logger.debug(f"Skipping privileged group {group_name}({gid})")
             invalid_gids.append(gid)
             continue
+        if group_name in existing_groups:
+            logger.debug(f"    group {gid}({group_name}) already exists")
+            continue
         logger.debug(f"Creating group {gid}({group_name})")
         try:
             subprocess.check_output(['/usr/sbin/groupadd', '-g', gid, group_name], stderr=subprocess.STDOUT)
@@ -82,6 +199,9 @@ def main(filename):
         if int(uid) < MIN_UID or user in RESERVED_USERS:
             logger.debug(f"Skipping privileged user {uid}({user})")
             continue
+        if user in existing_users:
+            logger.debug(f"    user {uid}({user}) already exists")
+            continue
         logger.debug(f"Creating user {uid}({user})")
         gid = config['users'][user]['gid']
         logger.debug(f"    gid: {gid}")
@@ -114,10 +234,26 @@ def main(filename):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Create users/groups using info from a json file")
     parser.add_argument('-i', dest='filename', action='store', required=True, help="input filename")
+    parser.add_argument('--state-file', action='store', default=None, help="File that records the version of the input file that was last applied. If it hasn't changed then nothing is done.")
+    parser.add_argument('--watch', action='store_true', default=False, help="Keep running and sync the users and groups when the input file changes.")
+    parser.add_argument('--interval', type=int, default=60, help="Seconds between checks in --watch mode")
+    parser.add_argument('--jitter', type=int, default=60, help="Maximum random seconds added to each interval in --watch mode")
+    parser.add_argument('--install-agent', action='store_true', default=False, help="Install a systemd service that runs with --watch and remove the cron job.")
     parser.add_argument('--debug', '-d', action='count', default=False, help="Enable debug messages")
     args = parser.parse_args()
 
     if args.debug:
         logger.setLevel(logging.DEBUG)
 
-    main(args.filename)
+    if (args.watch or args.install_agent) and not args.state_file:
+        parser.error("--state-file is required with --watch and --install-agent")
+
+    if args.state_file:
+        sync(args.filename, args.state_file)
+    else:
+        main(args.filename)
+
+    if args.install_agent:
+        install_agent(os.path.realpath(args.filename), os.path.realpath(args.state_file), args.interval, args.jitter)
+    if args.watch:
+        watch(args.filename, args.state_file, args.interval, args.jitter)
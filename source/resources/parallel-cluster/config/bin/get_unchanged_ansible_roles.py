@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+'''
+Compare the asset hashes that were last applied with the new asset hashes and print the ansible roles that didn't change.
+
+The output is a json list that can be passed to ansible-playbook as the skip_roles variable.
+If any of the files that all of the roles depend on changed, then no roles are skipped.
+Roles that apply package updates from external repos are never skipped because their asset hashes can't detect new packages.
+'''
+
+import argparse
+import json
+import logging
+from os import path
+import sys
+
+logger = logging.getLogger(__file__)
+logger_formatter = logging.Formatter('%(levelname)s:%(asctime)s: %(message)s')
+logger_streamHandler = logging.StreamHandler()
+logger_streamHandler.setFormatter(logger_formatter)
+logger.addHandler(logger_streamHandler)
+logger.setLevel(logging.INFO)
+
+ALWAYS_RUN_ROLES = ['bug_fixes', 'security_updates']
+
+def get_unchanged_roles(old_asset_hashes, new_asset_hashes, global_files):
+    for global_file in global_files:
+        old_hash = old_asset_hashes.get('Files', {}).get(global_file, None)
+        new_hash = new_asset_hashes.get('Files', {}).get(global_file, None)
+        if old_hash != new_hash:
+            logger.info(f"{global_file} changed so running all roles.")
+            return []
+
+    unchanged_roles = []
+    changed_roles = []
+    for role, new_hash in sorted(new_asset_hashes.get('Roles', {}).items()):
+        if role in ALWAYS_RUN_ROLES:
+            changed_roles.append(role)
+        elif old_asset_hashes.get('Roles', {}).get(role, None) == new_hash:
+            unchanged_roles.append(role)
+        else:
+            changed_roles.append(role)
+    logger.info(f"Roles to run:    {', '.join(changed_roles)}")
+    logger.info(f"Unchanged roles: {', '.join(unchanged_roles)}")
+    return unchanged_roles
+
+def main(old_filename, new_filename, global_files):
+    if not path.exists(old_filename):
+        logger.info(f"{old_filename} doesn't exist so running all roles.")
+        unchanged_roles = []
+    else:
+        with open(old_filename, 'r') as fh:
+            old_asset_hashes = json.load(fh)
+        with open(new_filename, 'r') as fh:
+            new_asset_hashes = json.load(fh)
+        unchanged_roles = get_unchanged_roles(old_asset_hashes, new_asset_hashes, global_files)
+    print(json.dumps(unchanged_roles))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Print ansible roles whose asset hashes didn't change")
+    parser.add_argument('--old', dest='old_filename', action='store', required=True, help="asset hashes that were last applied")
+    parser.add_argument('--new', dest='new_filename', action='store', required=True, help="new asset hashes")
+    parser.add_argument('--global-file', dest='global_files', action='append', default=None, help="File that all roles depend on. Can be repeated. Default: playbooks and the head node ansible vars")
+    parser.add_argument('--debug', '-d', action='count', default=False, help="Enable debug messages")
+    args = parser.parse_args()
+
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    if not args.global_files:
+        args.global_files = ['playbooks', 'config/ansible/ansible_head_node_vars.yml']
+
+    try:
+        main(args.old_filename, args.new_filename, args.global_files)
+    except Exception as e:
+        # Fail safe by running all of the roles.
+        logger.exception(f"Couldn't compare asset hashes so running all roles: {e}")
+        print(json.dumps([]))
+        sys.exit(0)
@@ -14,6 +14,7 @@ echo "$(date): Started ${script_name}"
 assets_bucket={{assets_bucket}}
 assets_base_key={{assets_base_key}}
 export AWS_DEFAULT_REGION={{Region}}
+ClusterName={{ClusterName}}
 ErrorSnsTopicArn={{ErrorSnsTopicArn}}
 HomeMountSrc={{HomeMountSrc}}
 playbooks_s3_url={{playbooks_s3_url}}
@@ -35,55 +36,162 @@ trap on_exit EXIT
 config_dir=/opt/slurm/config
 config_bin_dir=$config_dir/bin
 
-if [ -e $config_bin_dir/on_compute_node_configured_custom_prolog.sh ]; then
-    $config_bin_dir/on_compute_node_configured_custom_prolog.sh
-fi
+# Each step is timed and written as a JSON line to $step_log.
+# The durations are also published as CloudWatch metrics when the script finishes.
+script_start=$(date +%s.%N)
+step_log_dir=/var/log/aws-eda-slurm-cluster
+step_log=$step_log_dir/${script_name%.sh}.jsonl
+mkdir -p $step_log_dir
+step_durations=$(mktemp)
+
+# Steps that are idempotent record the hash of their inputs in the manifest.
+# If the AMI was created from an instance that already ran a step with the same inputs then the step is skipped.
+ami_manifest=/etc/aws-eda-slurm-cluster/ami-manifest
+mkdir -p $(dirname $ami_manifest)
+
+function run_step {
+    # Usage: run_step step_name command [args...]
+    local step=$1
+    shift
+    local start=$(date +%s.%N)
+    local rc=0
+    "$@" || rc=$?
+    local end=$(date +%s.%N)
+    local duration=$(awk "BEGIN {printf \"%.3f\", $end - $start}")
+    echo "$(date): ${step} finished in ${duration}s with rc=$rc"
+    (
+        flock 9
+        echo "{\"timestamp\": \"$(date -u +%Y-%m-%dT%H:%M:%S.%3NZ)\", \"script\": \"$script_name\", \"step\": \"$step\", \"duration\": $duration, \"rc\": $rc}" >> $step_log
+        echo "$step $duration" >> $step_durations
+    ) 9> $step_log.lock
+    return $rc
+}
 
-if ! [ -z $HomeMountSrc ]; then
+function manifest_matches {
+    # Usage: manifest_matches step_name hash
+    [ -e $ami_manifest ] && grep -q -x "$1 $2" $ami_manifest
+}
+
+function manifest_record {
+    # Usage: manifest_record step_name hash
+    (
+        flock 9
+        touch $ami_manifest
+        (grep -v "^$1 " $ami_manifest; echo "$1 $2") > $ami_manifest.new
+        mv -f $ami_manifest.new $ami_manifest
+    ) 9> $ami_manifest.lock
+}
+
+function publish_metrics {
+    local now=$(date +%s.%N)
+    local total=$(awk "BEGIN {printf \"%.3f\", $now - $script_start}")
+    # Time since the instance booted so that we can track how long it takes for a node to be ready for jobs.
+    local uptime=$(cut -d ' ' -f 1 /proc/uptime)
+    local metric_data=$(mktemp)
+    (
+        echo "["
+        echo "  {\"MetricName\": \"ComputeNodeConfiguredSeconds\", \"Unit\": \"Seconds\", \"Value\": $total, \"Dimensions\": [{\"Name\": \"ClusterName\", \"Value\": \"$ClusterName\"}]},"
+        while read step duration; do
+            echo "  {\"MetricName\": \"ComputeNodeConfiguredStepSeconds\", \"Unit\": \"Seconds\", \"Value\": $duration, \"Dimensions\": [{\"Name\": \"ClusterName\", \"Value\": \"$ClusterName\"}, {\"Name\": \"Step\", \"Value\": \"$step\"}]},"
+        done < $step_durations
+        echo "  {\"MetricName\": \"ComputeNodeBootToConfiguredSeconds\", \"Unit\": \"Seconds\", \"Value\": $uptime, \"Dimensions\": [{\"Name\": \"ClusterName\", \"Value\": \"$ClusterName\"}]}"
+        echo "]"
+    ) > $metric_data
+    echo "{\"timestamp\": \"$(date -u +%Y-%m-%dT%H:%M:%S.%3NZ)\", \"script\": \"$script_name\", \"step\": \"total\", \"duration\": $total, \"uptime\": $uptime}" >> $step_log
+    aws cloudwatch put-metric-data --namespace SLURM --metric-data file://$metric_data || echo "Couldn't publish CloudWatch metrics"
+    rm -f $metric_data $step_durations
+}
+
+function update_script {
+    # Make sure we're running the latest version
+    dest_script="$config_bin_dir/${script_name}"
+    mkdir -p $config_bin_dir
+    aws s3 cp s3://$assets_bucket/$assets_base_key/config/bin/${script_name} $dest_script.new
+    chmod 0700 $dest_script.new
+    if ! [ -e $dest_script ] || ! diff -q $dest_script $dest_script.new; then
+        mv -f $dest_script.new $dest_script
+        return 1
+    fi
+    rm $dest_script.new
+    return 0
+}
+
+function mount_home {
     umount /home
     mount $HomeMountSrc /home
-fi
+}
 
-if ! diff -q $config_dir/munge.key /etc/munge/munge.key; then
-    echo "Updating /etc/munge/munge.key"
-    /usr/bin/cp /etc/munge/munge.key /etc/munge/munge.key.back$(date '+%Y-%m-%dT%H:%M:%S')
-    /usr/bin/cp $config_dir/munge.key /etc/munge/munge.key
-    systemctl restart munge
-    systemctl restart slurmd
-fi
+function update_munge_key {
+    if ! diff -q $config_dir/munge.key /etc/munge/munge.key; then
+        echo "Updating /etc/munge/munge.key"
+        /usr/bin/cp /etc/munge/munge.key /etc/munge/munge.key.back$(date '+%Y-%m-%dT%H:%M:%S')
+        /usr/bin/cp $config_dir/munge.key /etc/munge/munge.key
+        systemctl restart munge
+        systemctl restart slurmd
+    fi
+}
 
-# Make sure we're running the latest version
-dest_script="$config_bin_dir/${script_name}"
-mkdir -p $config_bin_dir
-aws s3 cp s3://$assets_bucket/$assets_base_key/config/bin/${script_name} $dest_script.new
-chmod 0700 $dest_script.new
-if ! [ -e $dest_script ] || ! diff -q $dest_script $dest_script.new; then
-    mv -f $dest_script.new $dest_script
-    exec $dest_script
-else
-    rm $dest_script.new
-fi
+function create_users_groups {
+    if ! [[ -e $config_dir/users_groups.json ]]; then
+        return 0
+    fi
+    # Create the users and groups now so that the node doesn't take jobs before they exist.
+    # Then start the agent that keeps them in sync when users_groups.json changes.
+    # The state file is in /etc so that it is baked into AMIs along with the users and groups.
+    echo "Creating users and groups"
+    $config_bin_dir/create_users_groups.py -i $config_dir/users_groups.json --state-file /etc/aws-eda-slurm-cluster/users_groups.state --install-agent
+}
 
-export PATH=/usr/sbin:$PATH
+function copy_subuid_subgid {
+    for file in subuid subgid; do
+        if [[ -e $config_dir/$file ]] && ! cmp -s $config_dir/$file /etc/$file; then
+            cp $config_dir/$file /etc/$file
+        fi
+    done
+}
 
-echo "Creating users and groups"
-if [[ -e $config_dir/users_groups.json ]]; then
-    $config_bin_dir/create_users_groups.py -i $config_dir/users_groups.json
-fi
+function enable_ena_express {
+    TOKEN=$(curl -s -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 21600")
+    mac=$(curl -s -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/network/interfaces/macs/)
+    eni_id=$(curl -s -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/network/interfaces/macs/${mac}interface-id/)
+    # Only needs to be done once per ENI, for example if the node is rebooted.
+    if manifest_matches ena_express $eni_id; then
+        return 0
+    fi
+    aws ec2 modify-network-interface-attribute --network-interface-id ${eni_id} --ena-srd-specification 'EnaSrdEnabled=true,EnaSrdUdpSpecification={EnaSrdUdpEnabled=true}' && manifest_record ena_express $eni_id
+}
 
-if [[ -e $config_dir/subuid ]]; then
-    cp $config_dir/subuid /etc/subuid
+# Update this script before anything else so that the steps aren't run twice when it changes.
+if ! run_step update_script update_script; then
+    exec $dest_script
 fi
 
-if [[ -e $config_dir/subgid ]]; then
-    cp $config_dir/subgid /etc/subgid
+if [ -e $config_bin_dir/on_compute_node_configured_custom_prolog.sh ]; then
+    run_step custom_prolog $config_bin_dir/on_compute_node_configured_custom_prolog.sh
 fi
 
-# Enable ENA Express
-TOKEN=$(curl -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 21600")
-mac=$(curl -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/network/interfaces/macs/)
-eni_id=$(curl -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/network/interfaces/macs/${mac}interface-id/)
-aws ec2 modify-network-interface-attribute --network-interface-id ${eni_id} --ena-srd-specification 'EnaSrdEnabled=true,EnaSrdUdpSpecification={EnaSrdUdpEnabled=true}'
+export PATH=/usr/sbin:$PATH
+
+# The following steps are mostly independent of each other so run them in parallel.
+# useradd is called with --no-create-home so creating users doesn't depend on /home.
+step_pids=()
+if ! [ -z $HomeMountSrc ]; then
+    run_step mount_home mount_home &
+    step_pids+=($!)
+fi
+run_step update_munge_key update_munge_key &
+step_pids+=($!)
+# useradd rewrites /etc/subuid and /etc/subgid so copy them after the users are created.
+{
+    run_step create_users_groups create_users_groups
+    run_step copy_subuid_subgid copy_subuid_subgid
+} &
+step_pids+=($!)
+run_step enable_ena_express enable_ena_express &
+step_pids+=($!)
+for pid in ${step_pids[@]}; do
+    wait $pid
+done
 
 # ansible_compute_node_vars_yml_s3_url="s3://$assets_bucket/$assets_base_key/config/ansible/ansible_compute_node_vars.yml"
 
@@ -101,9 +209,12 @@ aws ec2 modify-network-interface-attribute --network-interface-id ${eni_id} --en
 # popd
 
 if [ -e $config_bin_dir/on_compute_node_configured_custom_epilog.sh ]; then
-    $config_bin_dir/on_compute_node_configured_custom_epilog.sh
+    run_step custom_epilog $config_bin_dir/on_compute_node_configured_custom_epilog.sh
 fi
 
+# Publish the metrics in the background so they aren't on the critical path.
+publish_metrics &
+
 echo "$(date): Finished ${script_name}"
 
 exit 0
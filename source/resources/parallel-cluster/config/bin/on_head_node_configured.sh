@@ -77,11 +77,22 @@ if ! [ -z $MungeKeySecretId ]; then
 fi
 /usr/bin/cp -f /etc/munge/munge.key $config_dir/munge.key
 
+# Hashes of the assets that were last applied are saved so that updates can skip roles that didn't change.
+asset_hashes_json=$config_dir/asset_hashes.json
+aws s3 cp s3://$assets_bucket/$assets_base_key/config/asset_hashes.json $asset_hashes_json.new
+skip_roles='[]'
+if [[ ":$ONLY_RUN_CHANGED_ROLES" == ":1" ]]; then
+    skip_roles=$($config_bin_dir/get_unchanged_ansible_roles.py --old $asset_hashes_json --new $asset_hashes_json.new)
+fi
+echo "Skipping unchanged ansible roles: $skip_roles"
+
 pushd $PLAYBOOKS_PATH
 ansible-playbook $PLAYBOOKS_PATH/ParallelClusterHeadNode.yml \
     -i inventories/local.yml \
-    -e @$ANSIBLE_PATH/ansible_head_node_vars.yml
+    -e @$ANSIBLE_PATH/ansible_head_node_vars.yml \
+    -e "{\"skip_roles\": $skip_roles}"
 popd
+mv -f $asset_hashes_json.new $asset_hashes_json
 
 # Notify SNS topic that triggers configuration of cluster manager and external login nodes
 ConfigureUsersGroupsJsonSnsTopicArnParameter={{ConfigureUsersGroupsJsonSnsTopicArnParameter}}
@@ -50,7 +50,10 @@ fi
 # Notify SNS topic that triggers creation of DNS A record for head node.
 CreateHeadNodeARecordSnsTopicArnParameter={{CreateHeadNodeARecordSnsTopicArnParameter}}
 CreateHeadNodeARecordSnsTopicArn=$(aws ssm get-parameter --name $CreateHeadNodeARecordSnsTopicArnParameter --query 'Parameter.Value' --output text)
-aws sns publish --topic-arn $CreateHeadNodeARecordSnsTopicArn --message '{{ClusterName}} started'
+# Send the head node's instance id so that the lambda can describe it directly instead of searching for it.
+TOKEN=$(curl -s -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 300" || true)
+head_node_instance_id=$(curl -s -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/instance-id || true)
+aws sns publish --topic-arn $CreateHeadNodeARecordSnsTopicArn --message "{\"Message\": \"{{ClusterName}} started\", \"HeadNodeInstanceId\": \"$head_node_instance_id\"}"
 
 ansible_head_node_vars_yml_s3_url="s3://$assets_bucket/$assets_base_key/config/ansible/ansible_head_node_vars.yml"
 ansible_compute_node_vars_yml_s3_url="s3://$assets_bucket/$assets_base_key/config/ansible/ansible_compute_node_vars.yml"
@@ -70,6 +73,7 @@ config_scripts=(\
     create_users_groups_json_configure.sh \
     create_users_groups_json_deconfigure.sh \
     create_users_groups.py \
+    get_unchanged_ansible_roles.py \
     install-rootless-docker.sh \
     on_head_node_start.sh \
     on_head_node_configured.sh \
@@ -90,6 +94,9 @@ done
 mkdir -p $config_dir/build-files
 aws s3 cp --recursive s3://$assets_bucket/$assets_base_key/config/build-files $config_dir/build-files
 
+# Instance type shapes and prices used by the job cost accounting
+aws s3 cp s3://$assets_bucket/$assets_base_key/config/instance_type_info.json $config_dir/instance_type_info.json
+
 if ! [ -e $config_dir/users_groups.json ]; then
     aws s3 cp $users_groups_json_s3_url $config_dir/users_groups.json
     $config_bin_dir/create_users_groups.py -i $config_dir/users_groups.json
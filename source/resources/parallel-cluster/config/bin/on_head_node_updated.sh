@@ -16,6 +16,14 @@ assets_bucket={{assets_bucket}}
 assets_base_key={{assets_base_key}}
 ErrorSnsTopicArn={{ErrorSnsTopicArn}}
 
+# --changed-roles-only: Only run the ansible roles whose assets changed since they were last applied.
+# Passed by the UpdateHeadNode lambda when the assets changed without a ParallelCluster update.
+for arg in "$@"; do
+    if [[ $arg == '--changed-roles-only' ]]; then
+        export ONLY_RUN_CHANGED_ROLES=1
+    fi
+done
+
 # Notify user of errors
 function on_exit {
     rc=$?
@@ -40,7 +48,7 @@ aws s3 cp s3://$assets_bucket/$assets_base_key/config/bin/${script_name} $dest_s
 chmod 0700 $dest_script.new
 if ! [ -e $dest_script ] || ! diff -q $dest_script $dest_script.new; then
     mv -f $dest_script.new $dest_script
-    exec $dest_script
+    exec $dest_script "$@"
 else
     rm $dest_script.new
 fi
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+Create/update the Slurm remote license resources in slurmdbd from the Licenses config.
+
+All of the resources are listed with a single sacctmgr command and compared to the configured licenses.
+Licenses that need the same change are updated with a single sacctmgr command.
+
+If a license has a StatusScript then it can be run to get the current usage of the license server.
+The scripts are run concurrently and can print the following lines:
+
+    Total=<number of licenses on the license server>
+    Used=<number of licenses in use on the license server>
+
+Total replaces the configured Count and Used is saved in the resource's LastConsumed
+so that slurmctld doesn't schedule jobs that need licenses that are being used outside of Slurm.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import logging.handlers
+import os
+import re
+import shlex
+# Subprocess not being used to execute user supplied data
+import subprocess # nosec
+
+logger = logging.getLogger(__file__)
+
+STATUS_LINE_RE = re.compile(r'^\s*(?P<key>total|used)\s*[=:]\s*(?P<value>\d+)\s*$', re.IGNORECASE)
+
+def get_license_server(license_config):
+    '''
+    Get the Slurm server name of a license.
+
+    Using '@' for the port separator instead of ':' because sbatch doesn't work if ':' is in the server name.
+    '''
+    if 'Server' not in license_config:
+        return 'slurmdb'
+    server = license_config['Server']
+    if 'Port' in license_config:
+        server += f"@{license_config['Port']}"
+    return server
+
+class SlurmLicenseManager:
+
+    RESOURCE_FIELDS = ['Name', 'Server', 'ServerType', 'Count', 'LastConsumed', 'Cluster', 'Allowed']
+
+    def __init__(self, licenses_filename, cluster_name, max_workers=8, status_timeout=60, dry_run=False):
+        logger.info("")
+        logger.info("Creating/updating Slurm licenses")
+        logger.info(f"Licenses filename: {licenses_filename}")
+
+        with open(licenses_filename, 'r') as fh:
+            self.licenses = json.load(fh)
+        self.cluster_name = cluster_name
+        self.max_workers = max_workers
+        self.status_timeout = status_timeout
+        self.dry_run = dry_run
+
+        self.SLURM_ROOT = os.environ['SLURM_ROOT']
+        self.sacctmgr = self.SLURM_ROOT + '/bin/sacctmgr'
+
+        logger.debug(f"Configured licenses:\n{json.dumps(self.licenses, indent=4, sort_keys=True)}")
+
+    def get_slurm_licenses(self):
+        '''
+        Get all of the license resources from slurmdbd.
+
+        Returns:
+            {(name, server): {'ServerType': str, 'Count': int, 'LastConsumed': int, 'Clusters': {cluster: percent_allowed}}}
+        '''
+        cmd = [self.sacctmgr, '--noheader', '--parsable2', 'show', 'resource', 'withclusters', f"format={','.join(self.RESOURCE_FIELDS)}"]
+        try:
+            lines = subprocess.check_output(cmd, stderr=subprocess.STDOUT, encoding='UTF-8').split('\n') # nosec
+        except subprocess.CalledProcessError as e:
+            logger.exception(f"Couldn't list resources.\ncommand: {e.cmd}\noutput:\n{e.output}")
+            raise
+        slurm_licenses = {}
+        for line in lines:
+            if len(line) == 0: continue
+            logger.debug(line)
+            fields = dict(zip(self.RESOURCE_FIELDS, line.split('|')))
+            key = (fields['Name'], fields['Server'])
+            if key not in slurm_licenses:
+                slurm_licenses[key] = {
+                    'ServerType': fields['ServerType'],
+                    'Count': int(fields['Count'] or 0),
+                    'LastConsumed': int(fields['LastConsumed'] or 0),
+                    'Clusters': {}
+                }
+            if fields['Cluster']:
+                slurm_licenses[key]['Clusters'][fields['Cluster']] = int(fields['Allowed'] or 0)
+        return slurm_licenses
+
+    def run_status_script(self, license_name):
+        '''
+        Run a license's StatusScript.
+
+        Returns:
+            {'Total': int, 'Used': int} with only the values that the script printed.
+        '''
+        license_config = self.licenses[license_name]
+        env = dict(os.environ)
+        env['LICENSE_NAME'] = license_name
+        env['LICENSE_SERVER'] = license_config.get('Server', '')
+        env['LICENSE_PORT'] = str(license_config.get('Port', ''))
+        env['LICENSE_SERVER_TYPE'] = license_config.get('ServerType', '')
+        cmd = shlex.split(license_config['StatusScript'])
+        try:
+            output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='UTF-8', env=env, timeout=self.status_timeout).stdout # nosec
+        except subprocess.CalledProcessError as e:
+            logger.error(f"{license_name} StatusScript failed.\ncommand: {e.cmd}\noutput:\n{e.output}\n{e.stderr}")
+            return {}
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error(f"{license_name} StatusScript failed: {e}")
+            return {}
+        status = {}
+        for line in output.split('\n'):
+            match = STATUS_LINE_RE.match(line)
+            if match:
+                status[match.group('key').capitalize()] = int(match.group('value'))
+        logger.debug(f"{license_name} status: {status}")
+        return status
+
+    def get_license_status(self):
+        '''
+        Run the StatusScripts of all of the licenses concurrently.
+
+        Returns:
+            {license_name: {'Total': int, 'Used': int}}
+        '''
+        license_names = sorted([license_name for license_name, license_config in self.licenses.items() if license_config.get('StatusScript', None)])
+        if not license_names:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(license_names))) as executor:
+            return dict(zip(license_names, executor.map(self.run_status_script, license_names)))
+
+    def get_commands(self, slurm_licenses, license_status={}):
+        '''
+        Get the sacctmgr commands that make slurmdbd match the configured licenses.
+
+        Licenses that need the same change are combined into a single command.
+
+        Returns:
+            [[sacctmgr args], ...]
+        '''
+        adds = {}
+        add_clusters = {}
+        modifies = {}
+        modify_clusters = {}
+        configured_keys = set()
+        for license_name in sorted(self.licenses.keys()):
+            license_config = self.licenses[license_name]
+            server = get_license_server(license_config)
+            server_type = license_config.get('ServerType', '')
+            status = license_status.get(license_name, {})
+            count = status.get('Total', license_config['Count'])
+            key = (license_name, server)
+            configured_keys.add(key)
+            if key not in slurm_licenses:
+                logger.info(f"{license_name}@{server} license not in slurmdbd so add it")
+                adds.setdefault((server, server_type, count), []).append(license_name)
+                if 'Used' in status:
+                    modifies.setdefault((server, (('lastconsumed', status['Used']),)), []).append(license_name)
+                continue
+            slurm_license = slurm_licenses[key]
+            set_items = []
+            if slurm_license['Count'] != count:
+                logger.info(f"Update {license_name}@{server} count from {slurm_license['Count']} to {count}")
+                set_items.append(('count', count))
+            if server_type and slurm_license['ServerType'] != server_type:
+                logger.info(f"Update {license_name}@{server} servertype from {slurm_license['ServerType']} to {server_type}")
+                set_items.append(('servertype', server_type))
+            if 'Used' in status and slurm_license['LastConsumed'] != status['Used']:
+                logger.debug(f"Update {license_name}@{server} lastconsumed from {slurm_license['LastConsumed']} to {status['Used']}")
+                set_items.append(('lastconsumed', status['Used']))
+            if set_items:
+                modifies.setdefault((server, tuple(set_items)), []).append(license_name)
+            if self.cluster_name not in slurm_license['Clusters']:
+                logger.info(f"Add {self.cluster_name} cluster to {license_name}@{server}")
+                add_clusters.setdefault(server, []).append(license_name)
+            elif slurm_license['Clusters'][self.cluster_name] != 100:
+                logger.info(f"Update {license_name}@{server} percentallowed from {slurm_license['Clusters'][self.cluster_name]} to 100")
+                modify_clusters.setdefault(server, []).append(license_name)
+
+        deletes = {}
+        for (license_name, server), slurm_license in sorted(slurm_licenses.items()):
+            if (license_name, server) in configured_keys:
+                continue
+            if self.cluster_name not in slurm_license['Clusters']:
+                continue
+            logger.info(f"{license_name}@{server} license not configured so delete it")
+            deletes.setdefault(server, []).append(license_name)
+
+        commands = []
+        for (server, server_type, count), license_names in sorted(adds.items()):
+            cmd = ['add', 'resource', 'type=License', f"name={','.join(license_names)}", f"server={server}"]
+            if server_type:
+                cmd.append(f"servertype={server_type}")
+            cmd += [f"count={count}", f"cluster={self.cluster_name}", 'percentallowed=100']
+            commands.append(cmd)
+        for server, license_names in sorted(add_clusters.items()):
+            commands.append(['add', 'resource', f"name={','.join(license_names)}", f"server={server}", f"cluster={self.cluster_name}", 'percentallowed=100'])
+        for (server, set_items), license_names in sorted(modifies.items()):
+            commands.append(['modify', 'resource', f"name={','.join(license_names)}", f"server={server}", 'set'] + [f"{name}={value}" for name, value in set_items])
+        for server, license_names in sorted(modify_clusters.items()):
+            commands.append(['modify', 'resource', f"name={','.join(license_names)}", f"server={server}", f"cluster={self.cluster_name}", 'set', 'percentallowed=100'])
+        for server, license_names in sorted(deletes.items()):
+            commands.append(['delete', 'resource', f"name={','.join(license_names)}", f"server={server}"])
+        return commands
+
+    def run_commands(self, commands):
+        '''
+        Returns:
+            Number of commands that failed
+        '''
+        number_of_errors = 0
+        for command in commands:
+            cmd = [self.sacctmgr, '-i'] + command
+            logger.info(' '.join(cmd))
+            if self.dry_run:
+                continue
+            try:
+                subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8') # nosec
+            except subprocess.CalledProcessError as e:
+                logger.error(f"sacctmgr failed.\ncommand: {e.cmd}\noutput:\n{e.output}")
+                number_of_errors += 1
+        return number_of_errors
+
+    def update_slurm(self, license_status={}):
+        slurm_licenses = self.get_slurm_licenses()
+        commands = self.get_commands(slurm_licenses, license_status)
+        if not commands:
+            logger.info("Slurm licenses are up to date")
+        return self.run_commands(commands)
+
+if __name__ == '__main__':
+    logger_formatter = logging.Formatter('%(levelname)s:%(asctime)s: %(message)s')
+    logger_rotatingFileHandler = logging.handlers.RotatingFileHandler(filename='/var/log/slurm/create_slurm_licenses.log', mode='a', maxBytes=1000000, backupCount=10)
+    logger_rotatingFileHandler.setFormatter(logger_formatter)
+    logger.addHandler(logger_rotatingFileHandler)
+    logger.setLevel(logging.INFO)
+
+    try:
+        parser = argparse.ArgumentParser("Create/update slurm licenses")
+        parser.add_argument('--licenses', dest='licenses', action='store', required=True, help="licenses json filename")
+        parser.add_argument('--cluster', dest='cluster', action='store', required=True, help="Slurm cluster name")
+        parser.add_argument('--status', action='store_true', default=False, help="Run the StatusScripts to update the counts and usage")
+        parser.add_argument('--max-workers', action='store', type=int, default=8, help="Maximum number of StatusScripts to run at a time. Default: %(default)s")
+        parser.add_argument('--status-timeout', action='store', type=int, default=60, help="StatusScript timeout in seconds. Default: %(default)s")
+        parser.add_argument('--dry-run', action='store_true', default=False, help="Show the sacctmgr commands without running them")
+        parser.add_argument('--debug', '-d', action='count', default=False, help="Enable debug messages")
+        args = parser.parse_args()
+
+        if args.debug or args.dry_run:
+            logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(logger_formatter)
+            logger.addHandler(stream_handler)
+
+        app = SlurmLicenseManager(args.licenses, args.cluster, args.max_workers, args.status_timeout, args.dry_run)
+        license_status = {}
+        if args.status:
+            license_status = app.get_license_status()
+        number_of_errors = app.update_slurm(license_status)
+    except:
+        logging.exception(f"Unhandled exception in {__file__}")
+        raise
+    if number_of_errors:
+        exit(1)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+Poll the license servers and keep the Slurm license usage up to date.
+
+Every interval all of the license servers are polled concurrently.
+Licenses with a StatusScript are polled with the script.
+Other licenses with a flexlm ServerType are polled with a single lmstat command per license server
+and the output is parsed as it is read so that lmstat can be stopped as soon as all of the server's licenses have been found.
+The license name must match the FlexLM feature name.
+
+The results are cached so that a license server that fails to respond doesn't reset the usage until the cache expires.
+The licenses are then reconciled with slurmdbd using create_slurm_licenses.py which batches the sacctmgr updates.
+
+The poll and update times are written to a Prometheus text file and optionally published to CloudWatch.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import logging.handlers
+import os
+import re
+import shlex
+import signal
+# Subprocess not being used to execute user supplied data
+import subprocess # nosec
+from threading import Timer
+from time import sleep, time
+
+from create_slurm_licenses import SlurmLicenseManager, logger as license_manager_logger
+
+logger = logging.getLogger(__file__)
+
+LMSTAT_USERS_RE = re.compile(r'^Users of (?P<feature>[^:\s]+):\s+\(Total of (?P<total>\d+) licenses? issued;\s+Total of (?P<used>\d+) licenses? in use\)')
+
+class LicenseServerPoller:
+
+    def __init__(self, license_manager, lmstat_cmd, interval, cache_ttl, poll_timeout, metrics_filename, cloudwatch_namespace):
+        self.license_manager = license_manager
+        self.lmstat_cmd = shlex.split(lmstat_cmd)
+        self.interval = interval
+        self.cache_ttl = cache_ttl
+        self.poll_timeout = poll_timeout
+        self.metrics_filename = metrics_filename
+        self.cloudwatch_namespace = cloudwatch_namespace
+        self.cloudwatch_client = None
+
+        # {license_name: (time, {'Total': int, 'Used': int})}
+        self.cache = {}
+
+        # Group the licenses by how they are polled
+        self.status_script_licenses = []
+        self.lmstat_servers = {}
+        for license_name, license_config in sorted(self.license_manager.licenses.items()):
+            if license_config.get('StatusScript', None):
+                self.status_script_licenses.append(license_name)
+            elif license_config.get('ServerType', '').lower() == 'flexlm' and 'Server' in license_config:
+                if 'Port' in license_config:
+                    lmstat_server = f"{license_config['Port']}@{license_config['Server']}"
+                else:
+                    lmstat_server = license_config['Server']
+                self.lmstat_servers.setdefault(lmstat_server, []).append(license_name)
+        logger.info(f"Polling {len(self.lmstat_servers)} FlexLM license servers and {len(self.status_script_licenses)} StatusScripts every {self.interval} seconds")
+
+    def run_lmstat(self, lmstat_server):
+        '''
+        Get the usage of all of the licenses on a FlexLM license server.
+
+        Returns:
+            {license_name: {'Total': int, 'Used': int}}
+        '''
+        license_names = set(self.lmstat_servers[lmstat_server])
+        status = {}
+        cmd = self.lmstat_cmd + ['-a', '-c', lmstat_server]
+        logger.debug(' '.join(cmd))
+        # Start lmstat in its own process group so that it and any children can be killed.
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='UTF-8', errors='replace', start_new_session=True) as lmstat_process: # nosec
+            # Kill lmstat if the license server hangs
+            timer = Timer(self.poll_timeout, self.kill_process_group, [lmstat_process])
+            timer.start()
+            try:
+                for line in lmstat_process.stdout:
+                    match = LMSTAT_USERS_RE.match(line)
+                    if match and match.group('feature') in license_names:
+                        status[match.group('feature')] = {'Total': int(match.group('total')), 'Used': int(match.group('used'))}
+                        if len(status) == len(license_names):
+                            break
+            finally:
+                timer.cancel()
+                self.kill_process_group(lmstat_process)
+        for license_name in sorted(license_names - set(status.keys())):
+            logger.warning(f"{license_name} not found on {lmstat_server}")
+        return status
+
+    def kill_process_group(self, process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def poll_server(self, poll_target):
+        '''
+        Returns:
+            (poll_target, {license_name: {'Total': int, 'Used': int}}, seconds)
+        '''
+        (poll_type, name) = poll_target
+        start_time = time()
+        try:
+            if poll_type == 'lmstat':
+                status = self.run_lmstat(name)
+            else:
+                status = {name: self.license_manager.run_status_script(name)}
+        except Exception as e:
+            logger.error(f"Couldn't poll {name}: {e}")
+            status = {}
+        return (poll_target, status, time() - start_time)
+
+    def poll(self):
+        '''
+        Poll all of the license servers concurrently.
+
+        Returns:
+            (license_status, poll_metrics)
+        '''
+        poll_targets = [('lmstat', lmstat_server) for lmstat_server in sorted(self.lmstat_servers.keys())]
+        poll_targets += [('script', license_name) for license_name in self.status_script_licenses]
+        poll_metrics = []
+        if poll_targets:
+            with ThreadPoolExecutor(max_workers=min(self.license_manager.max_workers, len(poll_targets))) as executor:
+                for (poll_type, name), status, seconds in executor.map(self.poll_server, poll_targets):
+                    logger.debug(f"Polled {name} in {seconds:.3f} seconds: {status}")
+                    now = time()
+                    for license_name, license_status in status.items():
+                        if license_status:
+                            self.cache[license_name] = (now, license_status)
+                    poll_metrics.append((poll_type, name, seconds, len([s for s in status.values() if s])))
+
+        license_status = {}
+        now = time()
+        for license_name, (poll_time, status) in list(self.cache.items()):
+            if now - poll_time > self.cache_ttl:
+                logger.warning(f"Dropping {license_name} usage that is {int(now - poll_time)} seconds old")
+                del self.cache[license_name]
+                continue
+            license_status[license_name] = status
+        return (license_status, poll_metrics)
+
+    def run_once(self):
+        (license_status, poll_metrics) = self.poll()
+        for license_name, status in sorted(license_status.items()):
+            # The usage is all that FlexLM reports about Slurm. The configured Count stays the number that Slurm can use.
+            if license_name not in self.status_script_licenses:
+                license_status[license_name] = {'Used': status['Used']}
+        start_time = time()
+        number_of_errors = self.license_manager.update_slurm(license_status)
+        update_seconds = time() - start_time
+        logger.debug(f"Updated slurmdbd in {update_seconds:.3f} seconds with {number_of_errors} errors")
+        self.write_metrics(license_status, poll_metrics, update_seconds, number_of_errors)
+
+    def write_metrics(self, license_status, poll_metrics, update_seconds, number_of_errors):
+        lines = [
+            '# HELP slurm_license_poll_seconds Time to poll a license server',
+            '# TYPE slurm_license_poll_seconds gauge',
+        ]
+        for poll_type, name, seconds, number_of_licenses in poll_metrics:
+            lines.append(f'slurm_license_poll_seconds{{type="{poll_type}",server="{name}"}} {seconds:.3f}')
+        lines += [
+            '# HELP slurm_license_poll_licenses Number of licenses found by the last poll of a license server',
+            '# TYPE slurm_license_poll_licenses gauge',
+        ]
+        for poll_type, name, seconds, number_of_licenses in poll_metrics:
+            lines.append(f'slurm_license_poll_licenses{{type="{poll_type}",server="{name}"}} {number_of_licenses}')
+        lines += [
+            '# HELP slurm_license_used Number of licenses in use on the license server',
+            '# TYPE slurm_license_used gauge',
+        ]
+        for license_name, status in sorted(license_status.items()):
+            if 'Used' in status:
+                lines.append(f'slurm_license_used{{license="{license_name}"}} {status["Used"]}')
+        lines += [
+            '# HELP slurm_license_update_seconds Time to update the licenses in slurmdbd',
+            '# TYPE slurm_license_update_seconds gauge',
+            f'slurm_license_update_seconds {update_seconds:.3f}',
+            '# HELP slurm_license_update_errors Number of sacctmgr commands that failed',
+            '# TYPE slurm_license_update_errors gauge',
+            f'slurm_license_update_errors {number_of_errors}',
+        ]
+        if self.metrics_filename:
+            with open(self.metrics_filename + '.new', 'w') as fh:
+                fh.write('\n'.join(lines) + '\n')
+            os.replace(self.metrics_filename + '.new', self.metrics_filename)
+
+        if not self.cloudwatch_namespace:
+            return
+        metric_data = [
+            {'MetricName': 'LicenseUpdateSeconds', 'Value': update_seconds, 'Unit': 'Seconds'},
+            {'MetricName': 'LicenseUpdateErrors', 'Value': number_of_errors, 'Unit': 'Count'},
+        ]
+        for poll_type, name, seconds, number_of_licenses in poll_metrics:
+            metric_data.append({'MetricName': 'LicensePollSeconds', 'Dimensions': [{'Name': 'Server', 'Value': name}], 'Value': seconds, 'Unit': 'Seconds'})
+        for license_name, status in sorted(license_status.items()):
+            if 'Used' not in status: continue
+            metric_data.append({'MetricName': 'LicensesUsed', 'Dimensions': [{'Name': 'License', 'Value': license_name}], 'Value': status['Used'], 'Unit': 'Count'})
+        try:
+            if not self.cloudwatch_client:
+                import boto3
+                self.cloudwatch_client = boto3.client('cloudwatch')
+            for index in range(0, len(metric_data), 1000):
+                self.cloudwatch_client.put_metric_data(Namespace=self.cloudwatch_namespace, MetricData=metric_data[index:index + 1000])
+        except Exception as e:
+            logger.error(f"Couldn't publish metrics to CloudWatch: {e}")
+
+    def run(self):
+        while True:
+            start_time = time()
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("License poll failed")
+            sleep(max(0, self.interval - (time() - start_time)))
+
+if __name__ == '__main__':
+    logger_formatter = logging.Formatter('%(levelname)s:%(asctime)s: %(message)s')
+    logger_rotatingFileHandler = logging.handlers.RotatingFileHandler(filename='/var/log/slurm/poll_license_servers.log', mode='a', maxBytes=1000000, backupCount=10)
+    logger_rotatingFileHandler.setFormatter(logger_formatter)
+    for log in [logger, license_manager_logger]:
+        log.addHandler(logger_rotatingFileHandler)
+        log.setLevel(logging.INFO)
+
+    try:
+        parser = argparse.ArgumentParser("Poll license servers and update the Slurm license usage")
+        parser.add_argument('--licenses', dest='licenses', action='store', required=True, help="licenses json filename")
+        parser.add_argument('--cluster', dest='cluster', action='store', required=True, help="Slurm cluster name")
+        parser.add_argument('--lmstat', action='store', default='lmutil lmstat', help="FlexLM lmstat command. Default: %(default)s")
+        parser.add_argument('--interval', action='store', type=int, default=60, help="Seconds between polls. Default: %(default)s")
+        parser.add_argument('--cache-ttl', action='store', type=int, default=300, help="Seconds to use the last usage of a license server that can't be polled. Default: %(default)s")
+        parser.add_argument('--max-workers', action='store', type=int, default=8, help="Maximum number of license servers to poll at a time. Default: %(default)s")
+        parser.add_argument('--poll-timeout', action='store', type=int, default=30, help="License server poll timeout in seconds. Default: %(default)s")
+        parser.add_argument('--metrics-file', action='store', default=None, help="Prometheus text file to write the metrics to")
+        parser.add_argument('--cloudwatch-namespace', action='store', default=None, help="CloudWatch namespace to publish the metrics to")
+        parser.add_argument('--once', action='store_true', default=False, help="Poll once and exit")
+        parser.add_argument('--debug', '-d', action='count', default=False, help="Enable debug messages")
+        args = parser.parse_args()
+
+        if args.debug:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(logger_formatter)
+            for log in [logger, license_manager_logger]:
+                log.setLevel(logging.DEBUG)
+                log.addHandler(stream_handler)
+
+        license_manager = SlurmLicenseManager(args.licenses, args.cluster, args.max_workers, args.poll_timeout)
+        app = LicenseServerPoller(license_manager, args.lmstat, args.interval, args.cache_ttl, args.poll_timeout, args.metrics_file, args.cloudwatch_namespace)
+        if args.once:
+            app.run_once()
+        else:
+            app.run()
+    except:
+        logging.exception(f"Unhandled exception in {__file__}")
+        raise
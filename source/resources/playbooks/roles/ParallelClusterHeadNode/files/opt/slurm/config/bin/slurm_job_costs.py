@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+Estimate the EC2 cost of completed Slurm jobs.
+
+sacct output is streamed one job at a time so memory use doesn't grow with the number of jobs.
+Each job is charged for the share of its nodes that it allocated, using the larger of its CPU and memory fractions,
+and the node price comes from the instance type catalog that is uploaded with the cluster configuration.
+The per job costs are written in batches to a parquet file, or to a gzipped csv file if pyarrow isn't installed,
+and the per account, user, and partition totals are written to a json file.
+"""
+
+import argparse
+import csv
+from datetime import datetime, timedelta
+from functools import lru_cache
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import re
+# Subprocess not being used to execute user supplied data
+import subprocess # nosec
+
+logger = logging.getLogger(__file__)
+
+# ParallelCluster node names are {queue}-{st|dy}-{compute_resource}-{index}
+NODE_NAME_RE = re.compile(r'^(?P<queue>.+)-(st|dy)-(?P<compute_resource>.+)$')
+# The compute resources created by this cluster are named {od|sp}-{mem_gb}-gb-{cores}-cores
+COMPUTE_RESOURCE_RE = re.compile(r'-(?P<mem_gb>\d+)-gb-(?P<cores>\d+)-cores$')
+
+MEMORY_UNITS_MiB = {
+    'K': 1 / 1024,
+    'M': 1,
+    'G': 1024,
+    'T': 1024 * 1024,
+}
+
+SACCT_FIELDS = ['JobIDRaw', 'User', 'Account', 'Partition', 'NodeList', 'AllocCPUS', 'AllocTRES', 'ElapsedRaw', 'Start', 'End', 'State']
+
+JOB_COST_FIELDS = [
+    'JobId',
+    'User',
+    'Account',
+    'Partition',
+    'State',
+    'Start',
+    'End',
+    'ElapsedSeconds',
+    'AllocCPUs',
+    'AllocMemMiB',
+    'Nodes',
+    'NodeHours',
+    'InstanceTypes',
+    'PurchaseOption',
+    'Share',
+    'Cost',
+]
+
+def split_hostlist(hostlist):
+    '''
+    Split a Slurm hostlist expression into its comma separated terms.
+
+    Commas inside of [] are part of a range and aren't separators.
+    '''
+    terms = []
+    depth = 0
+    start = 0
+    for index, c in enumerate(hostlist):
+        if c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            terms.append(hostlist[start:index])
+            start = index + 1
+    terms.append(hostlist[start:])
+    return [term for term in terms if term]
+
+@lru_cache(maxsize=4096)
+def get_hostlist_counts(hostlist):
+    '''
+    Count the nodes in a hostlist expression by node name prefix without expanding the hostlist.
+
+    Returns:
+        {prefix: number_of_nodes}
+    '''
+    counts = {}
+    if hostlist in ['', 'None assigned']:
+        return counts
+    for term in split_hostlist(hostlist):
+        if '[' in term:
+            prefix = term[0:term.index('[')]
+            number_of_nodes = 0
+            for node_range in term[term.index('[') + 1:term.rindex(']')].split(','):
+                if '-' in node_range:
+                    (first, last) = node_range.split('-', 1)
+                    number_of_nodes += int(last) - int(first) + 1
+                else:
+                    number_of_nodes += 1
+        else:
+            prefix = term.rstrip('0123456789')
+            number_of_nodes = 1
+        prefix = prefix.rstrip('-')
+        counts[prefix] = counts.get(prefix, 0) + number_of_nodes
+    return counts
+
+def get_queue_name(purchase_option_prefix, instance_type):
+    '''
+    Queue name that the cluster stack creates for an instance type and purchase option.
+    '''
+    queue_name = f"{purchase_option_prefix}-{instance_type}"
+    queue_name = queue_name.replace('.', '-')
+    queue_name = queue_name.replace('large', 'l')
+    queue_name = queue_name.replace('medium', 'm')
+    return queue_name
+
+def parse_memory_mib(value):
+    '''
+    Convert a Slurm memory value like 4000M or 16G to MiB.
+    '''
+    if not value:
+        return 0
+    units = value[-1].upper()
+    if units in MEMORY_UNITS_MiB:
+        return float(value[:-1]) * MEMORY_UNITS_MiB[units]
+    return float(value)
+
+class SlurmJobCosts:
+
+    def __init__(self, instance_type_info_filename, output_dir, state_filename, start, end, on_demand_pricing, spot_pricing, batch_size, update_state=True):
+        self.SLURM_ROOT = os.environ['SLURM_ROOT']
+        self.sacct = self.SLURM_ROOT + '/bin/sacct'
+
+        self.output_dir = output_dir
+        self.state_filename = state_filename
+        self.update_state = update_state
+        self.on_demand_pricing = on_demand_pricing
+        self.spot_pricing = spot_pricing
+        self.batch_size = batch_size
+
+        with open(instance_type_info_filename, 'r') as fh:
+            instance_type_and_family_info = json.load(fh)
+        if len(instance_type_and_family_info) != 1:
+            raise ValueError(f"{instance_type_info_filename} must contain exactly 1 region: {sorted(instance_type_and_family_info.keys())}")
+        self.region = list(instance_type_and_family_info.keys())[0]
+        self.instance_types_info = instance_type_and_family_info[self.region]['instance_types']
+
+        # Map queue names back to instance types and purchase options
+        self.queues = {}
+        for instance_type in self.instance_types_info:
+            for purchase_option_prefix, purchase_option in [('od', 'ONDEMAND'), ('sp', 'SPOT')]:
+                self.queues[get_queue_name(purchase_option_prefix, instance_type)] = (instance_type, purchase_option)
+
+        self.state = self.read_state()
+        now = datetime.now().replace(microsecond=0)
+        if end:
+            self.end = end
+        else:
+            self.end = now.isoformat()
+        if start:
+            self.start = start
+        elif self.state.get('End', None):
+            self.start = self.state['End']
+        else:
+            self.start = (now - timedelta(days=1)).isoformat()
+        logger.info(f"Job costs for jobs that ended after {self.start} and by {self.end}")
+
+        self.rollups = {
+            'Account': {},
+            'User': {},
+            'Partition': {},
+        }
+        self.number_of_jobs = 0
+        self.number_of_unpriced_jobs = 0
+
+    def read_state(self):
+        if not os.path.exists(self.state_filename):
+            return {}
+        try:
+            with open(self.state_filename, 'r') as fh:
+                return json.load(fh)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Couldn't read {self.state_filename}: {e}")
+            return {}
+
+    def write_state(self):
+        self.state['End'] = self.end
+        with open(self.state_filename + '.new', 'w') as fh:
+            json.dump(self.state, fh, indent=4, sort_keys=True)
+        os.replace(self.state_filename + '.new', self.state_filename)
+
+    @lru_cache(maxsize=1024)
+    def get_node_info(self, prefix):
+        '''
+        Get the instance type, purchase option, and allocatable resources for a node name prefix.
+
+        Returns:
+            (instance_type, purchase_option, cpus, mem_mib, hourly_price)
+            The tuple is all None if the node wasn't created by this cluster.
+        '''
+        match = NODE_NAME_RE.match(prefix)
+        if not match:
+            logger.debug(f"{prefix} isn't a ParallelCluster node name")
+            return (None, None, None, None, None)
+        queue = match.group('queue')
+        if queue not in self.queues:
+            logger.warning(f"No instance type for {queue} queue")
+            return (None, None, None, None, None)
+        (instance_type, purchase_option) = self.queues[queue]
+        instance_type_info = self.instance_types_info[instance_type]
+        match = COMPUTE_RESOURCE_RE.search(match.group('compute_resource'))
+        if match:
+            cpus = int(match.group('cores'))
+            mem_mib = int(match.group('mem_gb')) * 1024
+        else:
+            cpus = instance_type_info['DefaultVCpus']
+            mem_mib = instance_type_info['MemoryInMiB']
+        return (instance_type, purchase_option, cpus, mem_mib, self.get_hourly_price(instance_type, purchase_option))
+
+    def get_hourly_price(self, instance_type, purchase_option):
+        pricing = self.instance_types_info[instance_type].get('pricing', {})
+        if purchase_option == 'SPOT':
+            price = pricing.get('spot', {}).get(self.spot_pricing, None)
+            if price is None:
+                logger.warning(f"No {self.spot_pricing} spot price for {instance_type}. Using max.")
+                price = pricing.get('spot', {}).get('max', None)
+            return price
+        if self.on_demand_pricing == 'OnDemand':
+            return pricing.get('OnDemand', None)
+        (price_type, term) = self.on_demand_pricing.split(':', 1)
+        price = pricing.get(price_type, {}).get(term, None)
+        if price is None:
+            logger.warning(f"No {self.on_demand_pricing} price for {instance_type}. Using OnDemand.")
+            price = pricing.get('OnDemand', None)
+        return price
+
+    def get_jobs(self):
+        '''
+        Stream completed jobs from sacct.
+
+        Yields a dict for each job allocation.
+        '''
+        cmd = [
+            self.sacct, '--allusers', '--noheader', '--parsable2', '--allocations',
+            '--starttime', self.start, '--endtime', self.end,
+            '--format', ','.join(SACCT_FIELDS)
+        ]
+        logger.debug(f"{' '.join(cmd)}")
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, encoding='UTF-8') as sacct_process: # nosec
+            for line in sacct_process.stdout:
+                fields = line.rstrip('\n').split('|')
+                if len(fields) != len(SACCT_FIELDS):
+                    logger.warning(f"Unexpected sacct output: {line}")
+                    continue
+                job = dict(zip(SACCT_FIELDS, fields))
+                # sacct returns jobs that were running at any time in the window so skip jobs that haven't ended or that ended in an earlier window.
+                if job['End'] in ['Unknown', 'None'] or job['End'] <= self.start or job['End'] > self.end:
+                    continue
+                yield job
+        if sacct_process.returncode:
+            raise subprocess.CalledProcessError(sacct_process.returncode, cmd)
+
+    def get_job_cost(self, job):
+        tres = {}
+        for tres_value in job['AllocTRES'].split(','):
+            if '=' in tres_value:
+                (name, value) = tres_value.split('=', 1)
+                tres[name] = value
+        alloc_cpus = int(job['AllocCPUS'] or 0)
+        alloc_mem_mib = parse_memory_mib(tres.get('mem', ''))
+        elapsed_seconds = int(job['ElapsedRaw'] or 0)
+        elapsed_hours = elapsed_seconds / 3600
+
+        nodes = 0
+        total_cpus = 0
+        total_mem_mib = 0
+        hourly_cost = 0
+        instance_types = set()
+        purchase_options = set()
+        priced = True
+        for prefix, number_of_nodes in get_hostlist_counts(job['NodeList']).items():
+            (instance_type, purchase_option, cpus, mem_mib, hourly_price) = self.get_node_info(prefix)
+            nodes += number_of_nodes
+            if not instance_type:
+                priced = False
+                continue
+            instance_types.add(instance_type)
+            purchase_options.add(purchase_option)
+            total_cpus += cpus * number_of_nodes
+            total_mem_mib += mem_mib * number_of_nodes
+            if hourly_price is None:
+                priced = False
+            else:
+                hourly_cost += hourly_price * number_of_nodes
+
+        # Assume that the job's resources are spread evenly across its nodes.
+        # The job effectively uses the whole node if it allocated all of either the CPUs or the memory.
+        share = 0
+        if total_cpus:
+            share = alloc_cpus / total_cpus
+        if total_mem_mib:
+            share = max(share, alloc_mem_mib / total_mem_mib)
+        share = min(1.0, share)
+        cost = None
+        if priced and nodes:
+            cost = share * hourly_cost * elapsed_hours
+
+        return {
+            'JobId': job['JobIDRaw'],
+            'User': job['User'],
+            'Account': job['Account'],
+            'Partition': job['Partition'],
+            'State': job['State'].split(' ')[0],
+            'Start': job['Start'],
+            'End': job['End'],
+            'ElapsedSeconds': elapsed_seconds,
+            'AllocCPUs': alloc_cpus,
+            'AllocMemMiB': int(alloc_mem_mib),
+            'Nodes': nodes,
+            'NodeHours': nodes * elapsed_hours,
+            'InstanceTypes': ','.join(sorted(instance_types)),
+            'PurchaseOption': ','.join(sorted(purchase_options)),
+            'Share': share,
+            'Cost': cost,
+        }
+
+    def update_rollups(self, job_cost):
+        for rollup_field, rollup in self.rollups.items():
+            key = job_cost[rollup_field] or 'None'
+            if key not in rollup:
+                rollup[key] = {
+                    'Jobs': 0,
+                    'UnpricedJobs': 0,
+                    'NodeHours': 0.0,
+                    'Cost': 0.0,
+                }
+            rollup[key]['Jobs'] += 1
+            rollup[key]['NodeHours'] += job_cost['NodeHours']
+            if job_cost['Cost'] is None:
+                rollup[key]['UnpricedJobs'] += 1
+            else:
+                rollup[key]['Cost'] += job_cost['Cost']
+
+    def run(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        basename = f"job_costs-{self.end.replace(':', '')}"
+        writer = JobCostWriter(os.path.join(self.output_dir, basename))
+        batch = []
+        try:
+            for job in self.get_jobs():
+                job_cost = self.get_job_cost(job)
+                self.number_of_jobs += 1
+                if job_cost['Cost'] is None:
+                    self.number_of_unpriced_jobs += 1
+                self.update_rollups(job_cost)
+                batch.append(job_cost)
+                if len(batch) >= self.batch_size:
+                    writer.write(batch)
+                    batch = []
+            if batch:
+                writer.write(batch)
+        finally:
+            writer.close()
+
+        rollups_filename = os.path.join(self.output_dir, f"{basename}-rollups.json")
+        with open(rollups_filename, 'w') as fh:
+            json.dump(
+                {
+                    'Region': self.region,
+                    'Start': self.start,
+                    'End': self.end,
+                    'Jobs': self.number_of_jobs,
+                    'UnpricedJobs': self.number_of_unpriced_jobs,
+                    'OnDemandPricing': self.on_demand_pricing,
+                    'SpotPricing': self.spot_pricing,
+                    'Rollups': self.rollups
+                },
+                fh, indent=4, sort_keys=True)
+        logger.info(f"Wrote costs for {self.number_of_jobs} jobs to {writer.filename} and {rollups_filename}")
+        if self.number_of_unpriced_jobs:
+            logger.warning(f"{self.number_of_unpriced_jobs} jobs couldn't be priced")
+        if self.update_state:
+            self.write_state()
+        else:
+            logger.info(f"Not updating {self.state_filename}")
+
+class JobCostWriter:
+    '''
+    Write job costs in batches to a parquet file, or a gzipped csv file if pyarrow isn't installed.
+
+    Nothing is written until the first batch so that windows without jobs don't leave empty files.
+    '''
+    def __init__(self, basename):
+        self.basename = basename
+        try:
+            import pyarrow
+            import pyarrow.parquet
+            self.pa = pyarrow
+            self.pq = pyarrow.parquet
+            self.filename = basename + '.parquet'
+        except ImportError:
+            logger.debug("pyarrow isn't installed so writing csv")
+            self.pa = None
+            self.filename = basename + '.csv.gz'
+        self.writer = None
+        self.fh = None
+
+    def write(self, job_costs):
+        if self.pa:
+            if not self.writer:
+                schema = self.pa.schema([
+                    ('JobId', self.pa.string()),
+                    ('User', self.pa.string()),
+                    ('Account', self.pa.string()),
+                    ('Partition', self.pa.string()),
+                    ('State', self.pa.string()),
+                    ('Start', self.pa.string()),
+                    ('End', self.pa.string()),
+                    ('ElapsedSeconds', self.pa.int64()),
+                    ('AllocCPUs', self.pa.int64()),
+                    ('AllocMemMiB', self.pa.int64()),
+                    ('Nodes', self.pa.int64()),
+                    ('NodeHours', self.pa.float64()),
+                    ('InstanceTypes', self.pa.string()),
+                    ('PurchaseOption', self.pa.string()),
+                    ('Share', self.pa.float64()),
+                    ('Cost', self.pa.float64()),
+                ])
+                self.writer = self.pq.ParquetWriter(self.filename, schema)
+            table = self.pa.Table.from_pylist(job_costs, schema=self.writer.schema)
+            self.writer.write_table(table)
+        else:
+            if not self.writer:
+                self.fh = gzip.open(self.filename, 'wt', newline='')
+                self.writer = csv.DictWriter(self.fh, fieldnames=JOB_COST_FIELDS)
+                self.writer.writeheader()
+            self.writer.writerows(job_costs)
+
+    def close(self):
+        if self.pa and self.writer:
+            self.writer.close()
+        if self.fh:
+            self.fh.close()
+
+if __name__ == '__main__':
+    logger_formatter = logging.Formatter('%(levelname)s:%(asctime)s: %(message)s')
+    logger_rotatingFileHandler = logging.handlers.RotatingFileHandler(filename='/var/log/slurm/slurm_job_costs.log', mode='a', maxBytes=1000000, backupCount=10)
+    logger_rotatingFileHandler.setFormatter(logger_formatter)
+    logger.addHandler(logger_rotatingFileHandler)
+    logger.setLevel(logging.INFO)
+
+    try:
+        parser = argparse.ArgumentParser("Estimate the cost of completed Slurm jobs")
+        parser.add_argument('--instance-type-info', action='store', required=True, help="Instance type info json file")
+        parser.add_argument('--output-dir', action='store', required=True, help="Directory where job costs and rollups are written")
+        parser.add_argument('--state-file', action='store', default=None, help="File that saves the end of the last window. Default: OUTPUT_DIR/.state.json. The default file is only updated when the default window and pricing are used.")
+        parser.add_argument('--start', action='store', default=None, help="Start of the window. Default: end of the last window or 1 day ago")
+        parser.add_argument('--end', action='store', default=None, help="End of the window. Default: now")
+        parser.add_argument('--on-demand-pricing', action='store', default='OnDemand', help="Price for on-demand nodes. OnDemand or Reserved|EC2SavingsPlan|ComputeSavingsPlan:term. Default: %(default)s")
+        parser.add_argument('--spot-pricing', action='store', default='max', help="Price for spot nodes. max, min, or an availability zone. Default: %(default)s")
+        parser.add_argument('--batch-size', action='store', type=int, default=10000, help="Number of jobs written at a time. Default: %(default)s")
+        parser.add_argument('--debug', '-d', action='count', default=False, help="Enable debug messages")
+        args = parser.parse_args()
+
+        if args.debug:
+            logger.setLevel(logging.DEBUG)
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(logger_formatter)
+            logger.addHandler(stream_handler)
+
+        if args.on_demand_pricing != 'OnDemand' and ':' not in args.on_demand_pricing:
+            parser.error(f"Invalid --on-demand-pricing: {args.on_demand_pricing}")
+
+        state_file = args.state_file
+        if state_file:
+            update_state = True
+        else:
+            state_file = os.path.join(args.output_dir, '.state.json')
+            # Manual runs with a different window or pricing must not move the scheduled run's window.
+            update_state = (
+                not args.start and not args.end and
+                args.on_demand_pricing == parser.get_default('on_demand_pricing') and
+                args.spot_pricing == parser.get_default('spot_pricing'))
+
+        app = SlurmJobCosts(args.instance_type_info, args.output_dir, state_file, args.start, args.end, args.on_demand_pricing, args.spot_pricing, args.batch_size, update_state)
+        app.run()
+    except:
+        logging.exception(f"Unhandled exception in {__file__}")
+        raise
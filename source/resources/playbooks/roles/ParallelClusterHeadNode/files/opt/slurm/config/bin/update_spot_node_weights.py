@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+Update the weights of the spot nodes using the current spot prices.
+
+The cluster stack sets the node weights from the spot prices when the cluster is deployed.
+This gets the current spot prices for all of the spot instance types with one paginated query
+and updates the weights of the nodes in the sp-* queues so that Slurm keeps preferring the cheapest instance types.
+A price only replaces the one that was last applied if it changed by more than a threshold and
+the last change is older than a minimum hold time so that weights don't churn with small price changes.
+Nodes that need the same weight are updated with a single scontrol command.
+Slurm doesn't save weights changed with scontrol so they are reapplied after slurmctld restarts or reconfigures.
+"""
+
+import argparse
+from datetime import datetime, timezone
+import json
+import logging
+import logging.handlers
+import os
+# Subprocess not being used to execute user supplied data
+import subprocess # nosec
+from time import time
+
+from slurm_job_costs import get_queue_name, split_hostlist
+
+logger = logging.getLogger(__file__)
+
+# Must match the weights that the cluster stack configures
+STATIC_NODE_WEIGHT_MULTIPLIER = 1000
+DYNAMIC_NODE_WEIGHT_MULTIPLIER = 10000
+
+# Limit the length of scontrol command lines
+MAX_HOSTLISTS_PER_UPDATE = 100
+
+class SpotNodeWeights:
+
+    def __init__(self, instance_type_info_filename, state_filename, spot_pricing, availability_zones, threshold, min_hold_time, dry_run):
+        self.SLURM_ROOT = os.environ['SLURM_ROOT']
+        self.scontrol = self.SLURM_ROOT + '/bin/scontrol'
+        self.sinfo = self.SLURM_ROOT + '/bin/sinfo'
+
+        self.state_filename = state_filename
+        self.spot_pricing = spot_pricing
+        self.availability_zones = availability_zones
+        self.threshold = threshold
+        self.min_hold_time = min_hold_time
+        self.dry_run = dry_run
+
+        with open(instance_type_info_filename, 'r') as fh:
+            instance_type_and_family_info = json.load(fh)
+        if len(instance_type_and_family_info) != 1:
+            raise ValueError(f"{instance_type_info_filename} must contain exactly 1 region: {sorted(instance_type_and_family_info.keys())}")
+        self.region = list(instance_type_and_family_info.keys())[0]
+        self.instance_types_info = instance_type_and_family_info[self.region]['instance_types']
+
+        self.spot_queues = {}
+        for instance_type in self.instance_types_info:
+            self.spot_queues[get_queue_name('sp', instance_type)] = instance_type
+
+        self.state = self.read_state()
+        self.state['instance_types'] = self.state.get('instance_types', {})
+
+    def read_state(self):
+        if not os.path.exists(self.state_filename):
+            return {}
+        try:
+            with open(self.state_filename, 'r') as fh:
+                return json.load(fh)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Couldn't read {self.state_filename}: {e}")
+            return {}
+
+    def write_state(self):
+        with open(self.state_filename + '.new', 'w') as fh:
+            json.dump(self.state, fh, indent=4, sort_keys=True)
+        os.replace(self.state_filename + '.new', self.state_filename)
+
+    def get_spot_prices(self, instance_types):
+        '''
+        Get the current spot prices of the instance types in all of the region's availability zones.
+
+        Returns:
+            {instance_type: {az: price}}
+        '''
+        import boto3
+        ec2_client = boto3.client('ec2', region_name=self.region)
+        spot_prices = {}
+        paginator = ec2_client.get_paginator('describe_spot_price_history')
+        # With only a StartTime the query returns the price that is in effect in each availability zone.
+        for response in paginator.paginate(InstanceTypes=sorted(instance_types), ProductDescriptions=['Linux/UNIX'], StartTime=datetime.now(timezone.utc)):
+            for spot_price in response['SpotPriceHistory']:
+                instance_type = spot_price['InstanceType']
+                az = spot_price['AvailabilityZone']
+                if self.availability_zones and az not in self.availability_zones:
+                    continue
+                spot_prices.setdefault(instance_type, {})
+                # Keep the most recent price if there is more than one
+                if az in spot_prices[instance_type] and spot_prices[instance_type][az][1] >= spot_price['Timestamp']:
+                    continue
+                spot_prices[instance_type][az] = (float(spot_price['SpotPrice']), spot_price['Timestamp'])
+        return {instance_type: {az: price for az, (price, timestamp) in az_prices.items()} for instance_type, az_prices in spot_prices.items()}
+
+    def get_price(self, az_prices):
+        prices = list(az_prices.values())
+        if self.spot_pricing == 'min':
+            return min(prices)
+        elif self.spot_pricing == 'average':
+            return sum(prices) / len(prices)
+        return max(prices)
+
+    def update_applied_prices(self, spot_prices):
+        '''
+        Update the applied price of each instance type if the price changed enough and the last change is old enough.
+        '''
+        now = time()
+        for instance_type in sorted(self.spot_queues.values()):
+            applied = self.state['instance_types'].get(instance_type, None)
+            if not applied:
+                # Start with the price that the stack used to configure the weights.
+                catalog_price = self.instance_types_info[instance_type].get('pricing', {}).get('spot', {}).get('max', None)
+                if catalog_price is None:
+                    continue
+                applied = {'Price': catalog_price, 'Time': 0}
+                self.state['instance_types'][instance_type] = applied
+            if instance_type not in spot_prices:
+                logger.debug(f"No current spot price for {instance_type}")
+                continue
+            price = self.get_price(spot_prices[instance_type])
+            if applied['Price']:
+                change = abs(price - applied['Price']) / applied['Price']
+            else:
+                change = 1.0 if price else 0.0
+            if change < self.threshold:
+                logger.debug(f"{instance_type} price {price} is within {self.threshold:.0%} of {applied['Price']}")
+                continue
+            if now - applied['Time'] < self.min_hold_time:
+                logger.info(f"{instance_type} price changed from {applied['Price']} to {price} but last change was {int(now - applied['Time'])} seconds ago")
+                continue
+            logger.info(f"{instance_type} price changed from {applied['Price']} to {price}")
+            applied['Price'] = price
+            applied['Time'] = now
+
+    def get_node_weight_updates(self):
+        '''
+        Compare the weights of the spot nodes to the weights of the applied prices.
+
+        Returns:
+            {weight: [hostlist, ...]}
+        '''
+        updates = {}
+        cmd = [self.sinfo, '--noheader', '--format=%R|%N|%w']
+        for line in subprocess.check_output(cmd, encoding='UTF-8').split('\n'): # nosec
+            if not line: continue
+            (partition, hostlist, weight) = line.split('|')
+            if partition not in self.spot_queues:
+                continue
+            instance_type = self.spot_queues[partition]
+            if instance_type not in self.state['instance_types']:
+                continue
+            price = self.state['instance_types'][instance_type]['Price']
+            for hostlist_term in split_hostlist(hostlist):
+                if '-st-' in hostlist_term:
+                    exp_weight = int(price * STATIC_NODE_WEIGHT_MULTIPLIER)
+                else:
+                    exp_weight = int(price * DYNAMIC_NODE_WEIGHT_MULTIPLIER)
+                if int(weight) == exp_weight:
+                    continue
+                logger.debug(f"{hostlist_term} weight {weight} -> {exp_weight}")
+                updates.setdefault(exp_weight, set()).add(hostlist_term)
+        return {weight: sorted(hostlists) for weight, hostlists in updates.items()}
+
+    def update_node_weights(self, updates):
+        for weight, hostlists in sorted(updates.items()):
+            for index in range(0, len(hostlists), MAX_HOSTLISTS_PER_UPDATE):
+                nodes = ','.join(hostlists[index:index + MAX_HOSTLISTS_PER_UPDATE])
+                cmd = [self.scontrol, 'update', f'NodeName={nodes}', f'Weight={weight}']
+                logger.info(f"{' '.join(cmd)}")
+                if self.dry_run:
+                    continue
+                try:
+                    subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8') # nosec
+                except subprocess.CalledProcessError as e:
+                    logger.error(f"Couldn't update weight of {nodes}.\ncommand: {e.cmd}\noutput:\n{e.output}")
+
+    def run(self):
+        if not self.spot_queues:
+            logger.info("No spot instance types")
+            return
+        try:
+            spot_prices = self.get_spot_prices(self.spot_queues.values())
+        except Exception as e:
+            # Still reapply the last prices in case slurmctld reset the weights.
+            logger.error(f"Couldn't get spot prices: {e}")
+            spot_prices = {}
+        self.update_applied_prices(spot_prices)
+        updates = self.get_node_weight_updates()
+        if updates:
+            self.update_node_weights(updates)
+        else:
+            logger.debug("Spot node weights are up to date")
+        if not self.dry_run:
+            self.write_state()
+
+if __name__ == '__main__':
+    logger_formatter = logging.Formatter('%(levelname)s:%(asctime)s: %(message)s')
+    logger_rotatingFileHandler = logging.handlers.RotatingFileHandler(filename='/var/log/slurm/update_spot_node_weights.log', mode='a', maxBytes=1000000, backupCount=10)
+    logger_rotatingFileHandler.setFormatter(logger_formatter)
+    logger.addHandler(logger_rotatingFileHandler)
+    logger.setLevel(logging.INFO)
+
+    try:
+        parser = argparse.ArgumentParser("Update spot node weights using the current spot prices")
+        parser.add_argument('--instance-type-info', action='store', required=True, help="Instance type info json file")
+        parser.add_argument('--state-file', action='store', required=True, help="File that saves the applied spot prices")
+        parser.add_argument('--spot-pricing', action='store', choices=['max', 'min', 'average'], default='max', help="How to combine the prices of the availability zones. Default: %(default)s")
+        parser.add_argument('--availability-zone', dest='availability_zones', action='append', default=[], help="Only use prices from this availability zone. Can be repeated. Default: all")
+        parser.add_argument('--threshold', action='store', type=float, default=0.1, help="Minimum fractional price change that changes the weights. Default: %(default)s")
+        parser.add_argument('--min-hold-time', action='store', type=int, default=3600, help="Minimum number of seconds between weight changes of an instance type. Default: %(default)s")
+        parser.add_argument('--dry-run', action='store_true', default=False, help="Show the weight changes without making them")
+        parser.add_argument('--debug', '-d', action='count', default=False, help="Enable debug messages")
+        args = parser.parse_args()
+
+        if args.debug or args.dry_run:
+            logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(logger_formatter)
+            logger.addHandler(stream_handler)
+
+        app = SpotNodeWeights(args.instance_type_info, args.state_file, args.spot_pricing, args.availability_zones, args.threshold, args.min_hold_time, args.dry_run)
+        app.run()
+    except:
+        logging.exception(f"Unhandled exception in {__file__}")
+        raise
@@ -18,20 +18,29 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from ems_client import EmsClient, EmsPlan
 from io import BytesIO
 import json
 import logging
 import logging.handlers
-import requests
-from time import sleep
 import yaml
 
 logger = logging.getLogger(__file__)
 
+# Max number of images and profiles to configure in parallel
+MAX_WORKERS = 8
+
+# Fields that the EMS adds to profiles that can't be sent back
+PROFILE_READ_ONLY_FIELDS = ['Arbiter', 'MeteringList', 'Manufacturer', 'Status']
+
+# Profile that new profiles are created from
+TEMPLATE_PROFILE_NAME = 'az1'
+
 class ConfigureXio:
 
-    def __init__(self):
+    def __init__(self, dry_run=False):
         logger.info("Configuring Exostellar Infrastructure Optimizer")
 
         with open('/opt/slurm/config/ansible/ansible_head_node_vars.yml', 'r') as fh:
@@ -42,96 +51,196 @@ class ConfigureXio:
         logger.info(f"Xio config:\n{json.dumps(self.xio_config, indent=4)}")
 
         self.ems_url = f"http://{self.xio_config['ManagementServerIp']}:5000"
+        self.ems_client = EmsClient(self.ems_url, max_connections=MAX_WORKERS)
+
+        self.env_name = self.ansible_head_node_vars['cluster_name']
 
         self.num_errors = 0
 
-        self.configure_vm_images()
+        actual_state = self.get_actual_state()
 
-        self.configure_profiles()
+        plan = self.get_plan(actual_state)
+        logger.info(f"Plan:\n{plan}")
 
-        self.configure_environment()
+        if dry_run:
+            logger.info("Dry run so not applying the plan.")
+        else:
+            self.apply_plan(plan)
 
         if self.num_errors:
             logger.error(f"Failed with {self.num_errors} errors")
             exit(1)
 
-    def configure_vm_images(self):
+    def get_actual_state(self):
+        '''
+        Get all of the images, profiles, and the environment from the EMS in parallel.
+
+        Returns:
+            {kind: {name: object}}
+            The object is None if it doesn't exist.
+            Objects that couldn't be read are left out so that they don't get changed.
+        '''
+        paths = {}
         for image_config in self.xio_config.get('Images', []):
-            image_name = image_config['ImageName']
-            image_id = image_config['ImageId']
-            response = requests.get(f"{self.ems_url}/v1/image/{image_name}", verify=False)
-            if response.status_code == 200:
-                image_info = json.loads(response.content.decode('utf8'))
-                logger.info(f"Image {image_name} already exists:\n{json.dumps(image_info, indent=4)}")
-                if image_info['ImageId'] == image_id:
-                    continue
-                logger.info(f"New ImageId ({image_id} for {image_name} so creating image with new AMI.)")
-            else:
-                logger.info(f"Image {image_name} doesn't exist so creating it.")
-
-            image_json = {
-                "Description": "",
-                "ImageId": image_id,
-                "ImageName": image_name,
-                "UserData": "",
-                "User": "",
-                "UserKeyPem": ""
-            }
-            headers = {'Content-type': 'application/json'}
-            response = requests.post(f"{self.ems_url}/v1/xcompute/parse", data=json.dumps(image_json), headers=headers)
+            paths[('image', image_config['ImageName'])] = f"/v1/image/{image_config['ImageName']}"
+        paths[('profile', TEMPLATE_PROFILE_NAME)] = f"/v1/profile/{TEMPLATE_PROFILE_NAME}"
+        for profile_config in self.xio_config['Profiles']:
+            paths[('profile', profile_config['ProfileName'])] = f"/v1/profile/{profile_config['ProfileName']}"
+        paths[('env', self.env_name)] = f"/v1/env/{self.env_name}"
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            responses = dict(zip(paths.keys(), executor.map(self.ems_client.get, paths.values())))
+
+        actual_state = {'image': {}, 'profile': {}, 'env': {}}
+        for (kind, name), response in responses.items():
+            content = response.content.decode('utf8')
+            logger.debug(f"{kind} {name}: code={response.status_code} content={content}")
             if response.status_code != 200:
+                if kind == 'profile' and response.status_code != 404:
+                    self.num_errors += 1
+                    logger.error(f"Failed to get {name} profile. code={response.status_code} content={content}")
+                    continue
+                logger.info(f"{name} {kind} doesn't exist. code={response.status_code}")
+                actual_state[kind][name] = None
+                continue
+            try:
+                actual_state[kind][name] = json.loads(content)
+            except Exception as e:
+                # Need the id from an existing object or we can't update it so this is an error.
                 self.num_errors += 1
-                logger.error(f"Error creating {image_name}. code={response.status_code} content:\n{response.content.decode('utf-i')}")
+                logger.error(f"Invalid {kind} {name} configuration returned by server:\n{content}")
+        return actual_state
+
+    def get_plan(self, actual_state):
+        '''
+        Compare the desired state from the config to the actual state.
+
+        Returns:
+            EmsPlan
+        '''
+        plan = EmsPlan()
+
+        for image_config in self.xio_config.get('Images', []):
+            image_name = image_config['ImageName']
+            if image_name not in actual_state['image']:
                 continue
-            job_id = json.loads(response.content.decode('utf-8'))['JobId']
-            logger.info(f"Waiting for image {image_name}")
-            while True:
-                response = requests.get(f"{self.ems_url}/v1/image/{image_name}")
-                if response.status_code == 200:
-                    logger.info(f"Image {image_name} successfully created:\n{json.dumps(response.content.decode('utf-8'), indent=4)}")
-                    break
-                elif response.status_code == 400:
-                    logger.error(f"Creation of image {image_name} failed:\n{json.dumps(response.content.decode('utf-8'))}")
-                    break
-                sleep(10)
-
-    def configure_profiles(self):
-        template_profile_config = self.get_template_profile_config()
+            image_info = actual_state['image'][image_name]
+            # An image can't be updated. A new image is created from the new AMI.
+            plan.add(
+                'image', image_name,
+                None if image_info is None else {'ImageId': image_info['ImageId']},
+                {'ImageId': image_config['ImageId']}
+            )
+
+        template_profile_config = self.get_template_profile_config(actual_state['profile'].get(TEMPLATE_PROFILE_NAME, None))
         if not template_profile_config:
             self.num_errors += 1
             logger.error(f"Failed to get template profile.")
-            exit(1)
-
-        for profile_config in self.xio_config['Profiles']:
-            self.configure_profile(profile_config, template_profile_config)
+        else:
+            for profile_config in self.xio_config['Profiles']:
+                profile_name = profile_config['ProfileName']
+                if profile_name not in actual_state['profile']:
+                    continue
+                current_profile = actual_state['profile'][profile_name]
+                if current_profile is not None:
+                    current_profile = deepcopy(current_profile)
+                    for field in PROFILE_READ_ONLY_FIELDS:
+                        current_profile.pop(field, None)
+                profile = self.get_desired_profile(profile_name, profile_config, template_profile_config, current_profile)
+                plan.add('profile', profile_name, current_profile, profile)
+
+        if self.env_name in actual_state['env']:
+            current_env = actual_state['env'][self.env_name]
+            plan.add('env', self.env_name, current_env, self.get_desired_environment(current_env))
+
+        return plan
+
+    def apply_plan(self, plan):
+        '''
+        Images and profiles don't depend on each other so apply them in parallel.
+        The environment references them so it is applied last.
+        '''
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = []
+            for change in plan.get_changes('image'):
+                futures.append(executor.submit(self.apply_image_change, change))
+            for change in plan.get_changes('profile'):
+                futures.append(executor.submit(self.apply_change, change, '/v1/profile'))
+            for future in futures:
+                try:
+                    if not future.result():
+                        self.num_errors += 1
+                except Exception as e:
+                    logger.exception(f"Unhandled exception: {e}")
+                    self.num_errors += 1
 
-    def get_template_profile_config(self):
-        profile_name = 'az1'
-        logger.info(f"Checking if  profile {profile_name} exists.")
-        response = requests.get(f"{self.ems_url}/v1/profile/{profile_name}", verify=False)
-        if response.status_code != 200:
-            if response.status_code == 404:
-                logger.error(f"{profile_name} profile doesn't exist. code={response.status_code} content:\n{response.content.decode('utf8')}")
-            else:
+        for change in plan.get_changes('env'):
+            if not self.apply_change(change, '/v1/env'):
                 self.num_errors += 1
-                logger.error(f"Unknown error getting {profile_name} profile. code={response.status_code} content:\n{response.content.decode('utf8')}")
-                return None
-            self.num_errors += 1
-            return None
 
-        template_profile_config = None
-        logger.info(f"Getting profile {profile_name} to use as a template for new profiles.")
-        response = requests.get(f"{self.ems_url}/v1/profile/{profile_name}", verify=False)
+    def apply_image_change(self, change):
+        '''
+        Returns:
+            True if successful
+        '''
+        image_name = change.name
+        image_json = {
+            "Description": "",
+            "ImageId": change.desired['ImageId'],
+            "ImageName": image_name,
+            "UserData": "",
+            "User": "",
+            "UserKeyPem": ""
+        }
+        logger.info(f"Creating image {image_name} from {change.desired['ImageId']}")
+        response = self.ems_client.post("/v1/xcompute/parse", image_json)
         if response.status_code != 200:
-            logger.error(f"Failed to get {profile_name} profile. code={response.status_code} content={response.content.decode('utf8')}")
-            self.num_errors += 1
+            logger.error(f"Error creating {image_name}. code={response.status_code} content:\n{response.content.decode('utf-8')}")
+            return False
+        job_id = json.loads(response.content.decode('utf-8'))['JobId']
+        logger.info(f"Waiting for image {image_name}. JobId={job_id}")
+        response = self.ems_client.wait_for_image(image_name)
+        if response is None:
+            logger.error(f"Timed out waiting for image {image_name}. JobId={job_id}")
+            return False
+        if response.status_code != 200:
+            logger.error(f"Creation of image {image_name} failed:\n{json.dumps(response.content.decode('utf-8'))}")
+            return False
+        logger.info(f"Image {image_name} successfully created:\n{json.dumps(response.content.decode('utf-8'), indent=4)}")
+        return True
+
+    def apply_change(self, change, path):
+        '''
+        Create or update a profile or environment.
+
+        Returns:
+            True if successful
+        '''
+        if change.action == 'update':
+            logger.info(f"Updating {change.kind} {change.name}")
+            response = self.ems_client.put(path, change.desired)
+        else:
+            logger.info(f"Creating {change.kind} {change.name}")
+            response = self.ems_client.post(path, change.desired)
+        if response.status_code == 200:
+            logger.info(f"Succeeded: {response.content.decode('utf8')}")
+            return True
+        logger.error(f"{change.kind} {change.name} {change.action} failed with code=={response.status_code}\n{response.content.decode('utf8')}")
+        return False
+
+    def get_template_profile_config(self, template_profile_config):
+        profile_name = TEMPLATE_PROFILE_NAME
+        if not template_profile_config:
+            logger.error(f"{profile_name} profile doesn't exist.")
             return None
 
-        template_profile_config = json.loads(response.content.decode('utf8'))
+        template_profile_config = deepcopy(template_profile_config)
         logger.info(f"{profile_name} profile:\n{json.dumps(template_profile_config, indent=4)}")
 
         # Remove the Id which is unique to each
         template_profile_config.pop('Id', None)
+        for field in PROFILE_READ_ONLY_FIELDS:
+            template_profile_config.pop(field, None)
         if 'InstanceType' in self.xio_config.get('Controllers', {}):
             if template_profile_config['Controller']['InstanceType'] != self.xio_config['Controllers']['InstanceType']:
                 logger.info(f"Changing default Controller InstanceType from {template_profile_config['Controller']['InstanceType']} to {self.xio_config['Controllers']['InstanceType']}")
@@ -156,31 +265,15 @@ class ConfigureXio:
 
         return template_profile_config
 
-    def configure_profile(self, profile_config, template_profile_config):
-        profile_name = profile_config['ProfileName']
-        logger.info(f"Configuring {profile_name} profile")
-        profile_exists = False
-        response = requests.get(f"{self.ems_url}/v1/profile/{profile_name}", verify=False)
-        logger.debug(f"response:\n{response}")
-        if response.status_code == 404:
-            logger.info(f"{profile_name} profile doesn't exist so creating it.")
-            profile = deepcopy(template_profile_config)
-        elif response.status_code != 200:
-            self.num_errors += 1
-            logger.error(f"Failed to get {profile_name} profile. code={response.status_code} content={response.content.decode('utf8')}")
+    def get_desired_profile(self, profile_name, profile_config, template_profile_config, current_profile):
+        '''
+        Update the current profile or a copy of the template with the profile's config.
+        '''
+        profile_exists = current_profile is not None
+        if profile_exists:
+            profile = deepcopy(current_profile)
         else:
-            logger.info(f"{profile_name} profile exists so updating it.")
-            profile_exists = True
-            try:
-                profile = json.loads(response.content.decode('utf8'))
-            except Exception as e:
-                logger.error(f"Invalid json config returned by server: {response.content.decode('utf8')}")
-                self.num_errors += 1
-                return
-        profile.pop('Arbiter', None)
-        profile.pop('MeteringList', None)
-        profile.pop('Manufacturer', None)
-        profile.pop('Status', None)
+            profile = deepcopy(template_profile_config)
 
         if profile_exists:
             # Check fields against the template
@@ -232,57 +325,15 @@ class ConfigureXio:
                 'Value': name_tag
             })
         profile['Xspot']['EnableHyperthreading'] = profile_config['EnableHyperthreading']
-        logger.info(f"{profile_name} profile config:\n{json.dumps(profile, indent=4)}")
-
-        headers = {'Content-type': 'application/json'}
-        if profile_exists:
-            logger.info(f"Updating profile {profile_name}")
-            response = requests.put(f"{self.ems_url}/v1/profile", data=json.dumps(profile), headers=headers)
-        else:
-            logger.info(f"Creating profile {profile_name}")
-            response = requests.post(f"{self.ems_url}/v1/profile", data=json.dumps(profile), headers=headers)
-        if response.status_code == 200:
-            logger.info(f"Succeeded: {response.content.decode('utf8')}")
-        else:
-            logger.error(f"{profile_name} update failed with code=={response.status_code}\n{response.content.decode('utf8')}")
-            self.num_errors += 1
+        logger.debug(f"{profile_name} profile config:\n{json.dumps(profile, indent=4)}")
+        return profile
 
-    def configure_environment(self):
-        env_name = self.ansible_head_node_vars['cluster_name']
-        logger.info(f"Getting {env_name} environment.")
-        env_exists = False
-        response = requests.get(f"{self.ems_url}/v1/env/{env_name}", verify=False)
-        if response.status_code != 200:
-            logger.info(f"{env_name} environment doesn't exist. code={response.status_code} content={response.content.decode('utf8')}")
-            env = {}
-        else:
-            logger.info(f"{env_name} environment exists. code={response.status_code} content={response.content.decode('utf8')}")
-            env_exists = True
-            try:
-                env = json.loads(response.content.decode('utf8'))
-            except Exception as e:
-                # Need the id from the existing environment or we can't update it so this is an error.
-                self.num_errors += 1
-                logger.error(f"Invalid environment configuration returned by server:\n{response.content.decode('utf8')}")
-                return
-
-        if not env:
-            logger.info(f"Getting 'slurm' environment to use as a template for new environment.")
-            response = requests.get(f"{self.ems_url}/v1/env/slurm", verify=False)
-            if response.status_code != 200:
-                self.num_errors += 1
-                logger.error(f"Failed to get 'slurm' environment. code={response.status_code} content={response.content.decode('utf8')}")
-                return
-            else:
-                logger.debug(f"response:\n{response}")
-                logger.debug(f"response content:\n{response.content.decode('utf8')}")
-                try:
-                    template_env = json.loads(response.content.decode('utf8'))
-                    logger.debug(f"template_env:\n{json.dumps(template_env, indent=4)}")
-                except Exception as e:
-                    self.num_errors += 1
-                    logger.error(f"Invalid environment configuration returned by server:\n{response.content.decode('utf8')}")
-                    return
+    def get_desired_environment(self, current_env):
+        '''
+        Update the current environment with the pools from the config.
+        '''
+        env_name = self.env_name
+        env = deepcopy(current_env) if current_env is not None else {}
 
         env['EnvName'] = env_name
         env['Type'] = 'slurm'
@@ -307,22 +358,8 @@ class ConfigureXio:
             'ConfPath': f"/opt/slurm/etc",
             'PartitionName': self.xio_config['PartitionName']
         }
-        logger.info(f"{env_name} application environment:\n{json.dumps(env, indent=4)}")
-
-        headers = {'Content-type': 'application/json'}
-        if env_exists:
-            logger.info(f"Updating environment {env_name}")
-            response = requests.put(f"{self.ems_url}/v1/env", data=json.dumps(env), headers=headers)
-        else:
-            logger.info(f"Creating environment {env_name}")
-            response = requests.post(f"{self.ems_url}/v1/env", data=json.dumps(env), headers=headers)
-        if response.status_code == 200:
-            logger.info(f"Succeeded: {response.content.decode('utf8')}")
-        else:
-            self.num_errors += 1
-            logger.error(f"{env_name} environment update failed with code=={response.status_code}\n{response.content.decode('utf8')}")
-
-        return
+        logger.debug(f"{env_name} application environment:\n{json.dumps(env, indent=4)}")
+        return env
 
 if __name__ == '__main__':
     logger_formatter = logging.Formatter('%(levelname)s: %(message)s')
@@ -335,13 +372,14 @@ if __name__ == '__main__':
 
     try:
         parser = argparse.ArgumentParser("Configure Exostellar Infrastructure Optimizer")
+        parser.add_argument('--dry-run', action='store_true', default=False, help="Print the changes that would be made without making them")
         parser.add_argument('--debug', '-d', action='count', default=False, help="Enable debug messages")
         args = parser.parse_args()
 
         if args.debug:
             logger.setLevel(logging.DEBUG)
 
-        app = ConfigureXio()
+        app = ConfigureXio(dry_run=args.dry_run)
     except SystemExit as e:
         exit(e)
     except:
@@ -0,0 +1,158 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+'''
+Client for the Exostellar Management Server (EMS) REST API.
+
+Used by configure_xio.py and configure_xwo.py.
+All requests share a pooled session with timeouts and retries.
+
+EmsPlan holds the changes needed to get from the actual EMS state to the desired state
+so that only the objects that changed get written.
+'''
+import json
+import requests
+from requests.adapters import HTTPAdapter, Retry
+from time import sleep, time
+
+class EmsClient:
+
+    # (connect, read) timeouts in seconds
+    TIMEOUT = (10, 120)
+
+    # Retry connection errors and server errors with exponential backoff.
+    # POST isn't idempotent so it is only retried if the connection failed.
+    MAX_RETRIES = 5
+    RETRY_BACKOFF_FACTOR = 1
+    RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+    def __init__(self, ems_url, max_connections=16):
+        self.ems_url = ems_url
+        self.headers = {'Content-type': 'application/json'}
+
+        retry = Retry(
+            total = self.MAX_RETRIES,
+            backoff_factor = self.RETRY_BACKOFF_FACTOR,
+            status_forcelist = self.RETRY_STATUS_CODES,
+            allowed_methods = frozenset(['GET', 'PUT']),
+            raise_on_status = False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, max_retries=retry)
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, path):
+        return self.session.get(f"{self.ems_url}{path}", timeout=self.TIMEOUT)
+
+    def post(self, path, data):
+        return self.session.post(f"{self.ems_url}{path}", data=json.dumps(data), headers=self.headers, timeout=self.TIMEOUT)
+
+    def put(self, path, data):
+        return self.session.put(f"{self.ems_url}{path}", data=json.dumps(data), headers=self.headers, timeout=self.TIMEOUT)
+
+    def wait_for_image(self, image_name, timeout=3600, min_interval=5, max_interval=60, backoff=1.5):
+        '''
+        Wait for an image creation job to finish.
+
+        Returns:
+            response of the last image get or None if the wait timed out.
+        '''
+        end_time = time() + timeout
+        interval = min_interval
+        while True:
+            response = self.get(f"/v1/image/{image_name}")
+            if response.status_code in [200, 400]:
+                return response
+            if time() + interval > end_time:
+                return None
+            sleep(interval)
+            interval = min(interval * backoff, max_interval)
+
+def diff_objects(current, desired, path=''):
+    '''
+    Get the differences between the current and desired versions of an EMS object.
+
+    Returns:
+        list of strings describing each difference
+    '''
+    differences = []
+    if isinstance(current, dict) and isinstance(desired, dict):
+        for key in sorted(set(current.keys()) | set(desired.keys()), key=str):
+            key_path = f"{path}.{key}" if path else f"{key}"
+            if key not in desired:
+                differences.append(f"- {key_path}")
+            elif key not in current:
+                differences.append(f"+ {key_path}: {json.dumps(desired[key])}")
+            else:
+                differences += diff_objects(current[key], desired[key], key_path)
+    elif current != desired:
+        differences.append(f"~ {path}: {json.dumps(current)} -> {json.dumps(desired)}")
+    return differences
+
+class EmsChange:
+    '''
+    A create or update of one EMS image, profile, or environment.
+    '''
+    def __init__(self, kind, name, action, desired, differences):
+        self.kind = kind
+        self.name = name
+        self.action = action
+        self.desired = desired
+        self.differences = differences
+
+    def __str__(self):
+        lines = [f"{self.action} {self.kind} {self.name}"]
+        for difference in self.differences:
+            lines.append(f"    {difference}")
+        return '\n'.join(lines)
+
+class EmsPlan:
+    '''
+    Changes needed to get from the actual EMS state to the desired state.
+    '''
+    def __init__(self):
+        self.changes = []
+        self.num_unchanged = 0
+
+    def add(self, kind, name, current, desired):
+        '''
+        Add a change if the desired object is different than the current object.
+
+        current is None if the object doesn't exist.
+        '''
+        if current is None:
+            self.changes.append(EmsChange(kind, name, 'create', desired, []))
+            return
+        differences = diff_objects(current, desired)
+        if differences:
+            self.changes.append(EmsChange(kind, name, 'update', desired, differences))
+        else:
+            self.num_unchanged += 1
+
+    def get_changes(self, kind):
+        return [change for change in self.changes if change.kind == kind]
+
+    def __str__(self):
+        num_creates = len([change for change in self.changes if change.action == 'create'])
+        num_updates = len(self.changes) - num_creates
+        lines = [f"{num_creates} to create, {num_updates} to update, {self.num_unchanged} unchanged"]
+        for change in self.changes:
+            lines.append(str(change))
+        return '\n'.join(lines)
@@ -22,11 +22,13 @@ Wait for AMI to be available and update SSM parameter
 '''
 import argparse
 import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 from logging import handlers
 from os import environ
 from sys import exit
-from time import sleep
+from time import sleep, time
 
 logger = logging.getLogger(__file__)
 logger_formatter = logging.Formatter('%(levelname)s:%(asctime)s: %(message)s')
@@ -36,6 +38,71 @@ logger.addHandler(logger_rotatingFileHandler)
 logger.setLevel(logging.INFO)
 logger.propagate = False
 
+# Exponential polling of the AMI state
+MIN_POLL_INTERVAL = 15
+MAX_POLL_INTERVAL = 120
+POLL_BACKOFF = 1.5
+
+# describe_images is eventually consistent so a new AMI may not be found right after copy_image.
+NOT_FOUND_TIMEOUT = 5 * 60
+
+def wait_for_ami(ec2_client, ami_id, region):
+    '''
+    Wait for an AMI to be available.
+
+    Polls quickly at first and then backs off so that short waits don't take a full minute.
+    The AMI is treated as pending if it isn't found for up to NOT_FOUND_TIMEOUT seconds.
+
+    Returns:
+        ami_info
+    '''
+    logger.info(f"Waiting for {ami_id} to be available in {region}.")
+    poll_interval = MIN_POLL_INTERVAL
+    not_found_deadline = time() + NOT_FOUND_TIMEOUT
+    while True:
+        try:
+            images = ec2_client.describe_images(ImageIds=[ami_id])['Images']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidAMIID.NotFound':
+                raise
+            images = []
+        if not images:
+            if time() > not_found_deadline:
+                raise RuntimeError(f"{ami_id} not found in {region}")
+            logger.info(f"{ami_id} not found in {region} yet")
+            sleep(poll_interval)
+            poll_interval = min(poll_interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+            continue
+        ami_info = images[0]
+        state = ami_info['State']
+        logger.info(f"{ami_id} in {region}: state={state}")
+        if state == 'available':
+            return ami_info
+        if state in ['invalid', 'deregistered', 'failed', 'error']:
+            raise RuntimeError(f"{ami_id} in {region} is {state}: {ami_info.get('StateReason', {}).get('Message', '')}")
+        sleep(poll_interval)
+        poll_interval = min(poll_interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+
+def copy_ami(ami_id, ami_name, main_region, region, ssm_parameter):
+    '''
+    Copy the AMI to a remote region, wait for the copy to be available, and save its id in the SSM parameter.
+    '''
+    logger.info(f"Copying {ami_id} to {region}")
+    ec2_client = boto3.session.Session().client('ec2', region_name=region)
+    remote_ami_id = ec2_client.copy_image(
+        Name = f"{ami_name}",
+        Encrypted = True,
+        SourceImageId = ami_id,
+        SourceRegion = main_region,
+        CopyImageTags = True
+    )['ImageId']
+    logger.info(f"Created {remote_ami_id} in {region}")
+    wait_for_ami(ec2_client, remote_ami_id, region)
+    logger.info(f"Writing {remote_ami_id} to {ssm_parameter}")
+    ssm_client = boto3.session.Session().client('ssm', region_name=main_region)
+    ssm_client.put_parameter(Name=ssm_parameter, Type='String', Value=remote_ami_id, Overwrite=True)
+    return remote_ami_id
+
 def main():
     try:
         parser = argparse.ArgumentParser("Wait for AMI to be available.")
@@ -58,58 +125,45 @@ def main():
         logger.info(f"instance-id: {args.instance_id}")
 
         ec2_client = boto3.client('ec2')
-        logger.info(f"Waiting for {args.ami_id} to be available.")
-        while True:
-            try:
-                ami_info = ec2_client.describe_images(ImageIds=[args.ami_id])['Images'][0]
-            except IndexError:
-                logger.error(f"{args.ami_id} not found")
-                exit(2)
-            state = ami_info['State']
-            ami_name = ami_info['Name']
-            logger.info(f"state={state}")
-            if state == 'available':
-                break
-            sleep(60)
+        try:
+            ami_info = wait_for_ami(ec2_client, args.ami_id, environ['AWS_DEFAULT_REGION'])
+        except RuntimeError as e:
+            logger.error(str(e))
+            exit(2)
+        ami_name = ami_info['Name']
         ssm_parameter = f"{args.base_ssm_parameter}/{environ['AWS_DEFAULT_REGION']}"
         logger.info(f"Writing {args.ami_id} to {ssm_parameter}")
         ssm_client = boto3.client('ssm')
         ssm_client.put_parameter(Name=ssm_parameter, Type='String', Value=args.ami_id, Overwrite=True)
 
-        # Copy AMI to remote regions
+        # Copy AMI to remote regions in parallel.
+        # Each region's SSM parameter is written as soon as its copy is available.
         main_region = environ['AWS_DEFAULT_REGION']
-        compute_regions = args.compute_regions.split(',')
-        remote_ami_ids = {}
-        for region in compute_regions:
-            if region == main_region:
-                continue
-            logger.info(f"Copying {args.ami_id} to {region}")
-            ec2_client = boto3.client('ec2', region_name=region)
-            remote_ami_ids[region] = ec2_client.copy_image(
-                Name = f"{ami_name}",
-                Encrypted = True,
-                SourceImageId = args.ami_id,
-                SourceRegion = main_region,
-                CopyImageTags = True
-            )['ImageId']
-            logger.info(f"Created {remote_ami_ids[region]} in {region}")
-        for region, remote_ami_id in remote_ami_ids.items():
-            logger.info(f"Waiting for {remote_ami_id} to be available in {region}.")
-            ec2_client = boto3.client('ec2', region_name=region)
-            while True:
-                state = ec2_client.describe_images(ImageIds=[remote_ami_id])['Images'][0]['State']
-                logger.info(f"state={state}")
-                if state == 'available':
-                    break
-                sleep(60)
-            ssm_parameter = f"{args.base_ssm_parameter}/{region}"
-            logger.info(f"Writing {remote_ami_id} to {ssm_parameter}")
-            ssm_client.put_parameter(Name=ssm_parameter, Type='String', Value=remote_ami_id, Overwrite=True)
+        remote_regions = sorted(set(args.compute_regions.split(',')) - set([main_region, '']))
+        copy_errors = []
+        if remote_regions:
+            with ThreadPoolExecutor(max_workers=len(remote_regions)) as executor:
+                futures = {}
+                for region in remote_regions:
+                    future = executor.submit(copy_ami, args.ami_id, ami_name, main_region, region, f"{args.base_ssm_parameter}/{region}")
+                    futures[future] = region
+                for future in as_completed(futures):
+                    region = futures[future]
+                    try:
+                        remote_ami_id = future.result()
+                        logger.info(f"{remote_ami_id} available in {region}")
+                    except Exception as e:
+                        logger.exception(f"Copy of {args.ami_id} to {region} failed: {e}")
+                        copy_errors.append(region)
 
         logger.info(f"Stopping {args.instance_id}")
 
         ec2_client = boto3.client('ec2')
         ec2_client.stop_instances(InstanceIds=[args.instance_id])
+
+        if copy_errors:
+            logger.error(f"Copy of {args.ami_id} failed in {', '.join(copy_errors)}")
+            exit(1)
     except Exception as e:
         logger.exception(str(e))
         exit(1)
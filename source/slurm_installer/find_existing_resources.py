@@ -29,6 +29,8 @@ installer_path = "/".join(os.path.dirname(os.path.abspath(__file__)).split("/")[
 sys.path.append(installer_path)
 
 from prompt import get_input as get_input
+from resource_inventory import DEFAULT_CACHE_TTL, ResourceInventory
+from security_group_rules import SecurityGroupRules
 
 logger = logging.getLogger(__file__)
 logger_formatter = logging.Formatter('%(levelname)s: %(message)s')
@@ -41,29 +43,26 @@ logger.setLevel(logging.INFO)
 pp = pprint.PrettyPrinter(indent=4)
 
 class FindExistingResource:
-    def __init__(self, region):
+    def __init__(self, region, session=None, account_id=None, cache_ttl=DEFAULT_CACHE_TTL):
         self.region = region
-        session = boto3.Session(region_name=self.region)
-        self.ec2 = session.client("ec2")
-        self.cloudformation = session.client("cloudformation")
-        self.iam = session.client("iam")
-        self.route53 = session.client("route53")
+        if not session:
+            session = boto3.Session(region_name=self.region)
+        self.ec2 = session.client("ec2", region_name=self.region)
+        self.cloudformation = session.client("cloudformation", region_name=self.region)
+        self.iam = session.client("iam", region_name=self.region)
+        self.route53 = session.client("route53", region_name=self.region)
         self.install_parameters = {}
-        self.sns = session.client("sns")
+        self.sns = session.client("sns", region_name=self.region)
+        self.efs = session.client("efs", region_name=self.region)
+
+        # Start getting the resources that will be prompted for in the background.
+        self.inventory = ResourceInventory(self.region, session, account_id, cache_ttl=cache_ttl)
+        self.inventory.prefetch()
 
     def get_soca_stack_name(self, prompt, specified_value=''):
         try:
             stacks = {}
-            for stack in self.cloudformation.list_stacks(
-                    StackStatusFilter=[
-                        'CREATE_COMPLETE',
-                        'ROLLBACK_COMPLETE',
-                        'UPDATE_COMPLETE',
-                        'UPDATE_ROLLBACK_COMPLETE',
-                        'IMPORT_COMPLETE',
-                        'IMPORT_ROLLBACK_COMPLETE'
-                    ]
-                )["StackSummaries"]:
+            for stack in self.inventory.get_stacks():
                 stack_name = stack['StackName']
                 if stack_name == specified_value:
                     return {'success': True, 'message': stack_name}
@@ -92,7 +91,7 @@ class FindExistingResource:
     def check_keypair(self, specified_value=''):
         try:
             key_pairs = []
-            for key_pair in self.ec2.describe_key_pairs()["KeyPairs"]:
+            for key_pair in self.inventory.get_key_pairs():
                 key_name = key_pair['KeyName']
                 if key_name == specified_value:
                     return True
@@ -112,7 +111,7 @@ class FindExistingResource:
         else:
             specified_value = ''
         key_pairs = []
-        for key_pair in self.ec2.describe_key_pairs()["KeyPairs"]:
+        for key_pair in self.inventory.get_key_pairs():
             key_name = key_pair['KeyName']
             if key_name == specified_value:
                 return key_name
@@ -139,16 +138,7 @@ class FindExistingResource:
         try:
             res_stack_name = None
             stacks = {}
-            for stack_dict in self.cloudformation.list_stacks(
-                    StackStatusFilter=[
-                        'CREATE_COMPLETE',
-                        'ROLLBACK_COMPLETE',
-                        'UPDATE_COMPLETE',
-                        'UPDATE_ROLLBACK_COMPLETE',
-                        'IMPORT_COMPLETE',
-                        'IMPORT_ROLLBACK_COMPLETE'
-                    ]
-                )["StackSummaries"]:
+            for stack_dict in self.inventory.get_stacks():
                 stack_name = stack_dict['StackName']
                 if stack_name == res_environment_name:
                     res_stack_name = stack_dict['StackName']
@@ -192,13 +182,7 @@ class FindExistingResource:
 
     def check_vpc_id(self, specified_vpc_id):
         try:
-            vpcs = {}
-            for page in self.ec2.get_paginator('describe_vpcs').paginate():
-                for vpc in page['Vpcs']:
-                    vpc_id = vpc['VpcId']
-                    if specified_vpc_id == vpc_id:
-                        return True
-            return False
+            return self.inventory.get_vpc(specified_vpc_id) is not None
         except:
             return False
 
@@ -212,18 +196,17 @@ class FindExistingResource:
         else:
             specified_value = ''
         try:
+            if specified_value and self.inventory.get_vpc(specified_value):
+                return specified_value
             vpcs = {}
-            for page in self.ec2.get_paginator('describe_vpcs').paginate():
-                for vpc in page['Vpcs']:
-                    vpc_id = vpc['VpcId']
-                    if specified_value == vpc_id:
-                        return vpc_id
-                    vpc_name = vpc_id
-                    for tag in vpc.get('Tags', []):
-                        key = tag['Key']
-                        if key == 'Name':
-                            vpc_name = tag['Value']
-                    vpcs[vpc_name] = vpc_id
+            for vpc in self.inventory.get_vpcs():
+                vpc_id = vpc['VpcId']
+                vpc_name = vpc_id
+                for tag in vpc.get('Tags', []):
+                    key = tag['Key']
+                    if key == 'Name':
+                        vpc_name = tag['Value']
+                vpcs[vpc_name] = vpc_id
             if specified_value:
                 msg = f"\n{fg('red')}Invalid {config_key}: {specified_value}\nValid values: {vpcs}{attr('reset')}"
                 if prompt:
@@ -254,18 +237,17 @@ class FindExistingResource:
         else:
             specified_value = ''
         try:
+            if specified_value and self.inventory.get_subnet(specified_value) and self.inventory.get_subnet(specified_value)['VpcId'] == vpc_id:
+                return specified_value
             subnets = {}
-            for page in self.ec2.get_paginator('describe_subnets').paginate(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]):
-                for subnet in page['Subnets']:
-                    subnet_id = subnet['SubnetId']
-                    if specified_value == subnet_id:
-                        return subnet_id
-                    subnet_name = subnet_id
-                    for tag in subnet.get('Tags', []):
-                        key = tag['Key']
-                        if key == 'Name':
-                            subnet_name = tag['Value']
-                    subnets[subnet_name] = subnet_id
+            for subnet in self.inventory.get_subnets_in_vpc(vpc_id):
+                subnet_id = subnet['SubnetId']
+                subnet_name = subnet_id
+                for tag in subnet.get('Tags', []):
+                    key = tag['Key']
+                    if key == 'Name':
+                        subnet_name = tag['Value']
+                subnets[subnet_name] = subnet_id
             if specified_value:
                 msg = f"\n{fg('red')}Invalid {config_key}: {specified_value}\nValid values: {subnets}{attr('reset')}"
                 if prompt:
@@ -290,11 +272,10 @@ class FindExistingResource:
 
     def check_sns_topic_arn(self, specified_sns_topic_arn):
         try:
-            for page in self.sns.get_paginator('list_topics').paginate():
-                for topic_dict in page['Topics']:
-                    sns_topic_arn = topic_dict['TopicArn']
-                    if specified_sns_topic_arn == sns_topic_arn:
-                        return True
+            for topic_dict in self.inventory.get_sns_topics():
+                sns_topic_arn = topic_dict['TopicArn']
+                if specified_sns_topic_arn == sns_topic_arn:
+                    return True
             return False
         except:
             return False
@@ -312,13 +293,12 @@ class FindExistingResource:
             specified_value = ''
         try:
             sns_topic_arns = {}
-            for page in self.sns.get_paginator('list_topics').paginate():
-                for topic_dict in page['Topics']:
-                    sns_topic_arn = topic_dict['TopicArn']
-                    if specified_value == sns_topic_arn:
-                        return sns_topic_arn
-                    sns_topic_name = sns_topic_arn.split(':')[-1]
-                    sns_topic_arns[sns_topic_name] = sns_topic_arn
+            for topic_dict in self.inventory.get_sns_topics():
+                sns_topic_arn = topic_dict['TopicArn']
+                if specified_value == sns_topic_arn:
+                    return sns_topic_arn
+                sns_topic_name = sns_topic_arn.split(':')[-1]
+                sns_topic_arns[sns_topic_name] = sns_topic_arn
             if specified_value:
                 # Value specified in config or on command line is invalid. Fail unless prompt is true
                 msg_type = 'warning' if prompt else 'error'
@@ -362,21 +342,21 @@ class FindExistingResource:
         try:
             security_group_ids = {} # sg-id: Name
             security_group_names = {} # Name: sg-id
-            for page in self.ec2.get_paginator('describe_security_groups').paginate(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]):
-                for security_group_dict in page['SecurityGroups']:
-                    security_group_id = security_group_dict['GroupId']
-                    security_group_name = security_group_dict['GroupName']
-                    for tag in security_group_dict.get('Tags', []):
-                        key = tag['Key']
-                        if key == 'Name':
-                            security_group_name = tag['Value']
-                    security_group_ids[security_group_id] = security_group_name
-                    # Make sure security group names are unique
-                    index = 1
-                    base_security_group_name = security_group_name
-                    while security_group_name in security_group_names:
-                        security_group_name = f"{base_security_group_name}{i}"
-                    security_group_names[security_group_name] = security_group_id
+            for security_group_dict in self.inventory.get_security_groups_in_vpc(vpc_id):
+                security_group_id = security_group_dict['GroupId']
+                security_group_name = security_group_dict['GroupName']
+                for tag in security_group_dict.get('Tags', []):
+                    key = tag['Key']
+                    if key == 'Name':
+                        security_group_name = tag['Value']
+                security_group_ids[security_group_id] = security_group_name
+                # Make sure security group names are unique
+                index = 1
+                base_security_group_name = security_group_name
+                while security_group_name in security_group_names:
+                    security_group_name = f"{base_security_group_name}{index}"
+                    index += 1
+                security_group_names[security_group_name] = security_group_id
             # Check specified values
             unchosen_security_group_names = security_group_names.copy()
             if specified_value:
@@ -444,7 +424,9 @@ class FindExistingResource:
                         logical_id = resource['LogicalResourceId']
                         if re.match(r'SOCAVpcPublic', logical_id):
                             subnet_id = resource['PhysicalResourceId']
-                            subnet = self.ec2.describe_subnets(SubnetIds=[subnet_id])['Subnets'][0]
+                            subnet = self.inventory.get_subnet(subnet_id)
+                            if not subnet:
+                                subnet = self.ec2.describe_subnets(SubnetIds=[subnet_id])['Subnets'][0]
                             availability_zone = subnet['AvailabilityZone']
                             public_subnets_info.append({'id': subnet_id, 'az': availability_zone})
             if public_subnets_info:
@@ -457,7 +439,7 @@ class FindExistingResource:
     def get_security_groups(self, prompt, vpc_id, security_group_names=[], prefix=''):
         try:
             security_groups = {}
-            for security_group in self.ec2.describe_security_groups(Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])['SecurityGroups']:
+            for security_group in self.inventory.get_security_groups_in_vpc(vpc_id):
                 resource_name = False
                 if "Tags" in security_group.keys():
                     for tag in security_group["Tags"]:
@@ -517,20 +499,42 @@ class FindExistingResource:
             print(str(err))
             return {'success': False, 'message': str(err)}
 
+    def get_security_group_dicts(self, security_group_ids):
+        '''
+        Describe the security groups that are being validated.
+
+        The inventory isn't used because it may be cached from before a rule was fixed.
+        '''
+        security_groups = []
+        paginator = self.ec2.get_paginator('describe_security_groups')
+        for page in paginator.paginate(GroupIds=sorted(set(security_group_ids))):
+            security_groups += page['SecurityGroups']
+        return security_groups
+
+    def get_efs_security_group_ids(self, file_system_id):
+        '''
+        Get the security groups attached to the mount targets of an EFS file system.
+        '''
+        security_group_ids = set()
+        for page in self.efs.get_paginator('describe_mount_targets').paginate(FileSystemId=file_system_id):
+            for mount_target in page['MountTargets']:
+                security_group_ids.update(self.efs.describe_mount_target_security_groups(MountTargetId=mount_target['MountTargetId'])['SecurityGroups'])
+        return sorted(security_group_ids)
+
     def validate_sg_rules(self, cfn_params, check_fs=True):
         try:
             # Begin Verify Security Group Rules
             print(f"\n====== Please wait a little as we {fg('misty_rose_3')}validate your security group rules {attr('reset')} ======\n")
-            sg_rules = self.get_rules_for_security_group([cfn_params["scheduler_sg"], cfn_params["compute_node_sg"]])
+            scheduler_sg = cfn_params["scheduler_sg"]
+            compute_node_sg = cfn_params["compute_node_sg"]
+            client_ip = cfn_params.get('client_ip', getattr(self, 'client_ip', None))
+            security_group_ids = [scheduler_sg, compute_node_sg]
             if check_fs is True:
-                fs_sg = self.get_fs_security_groups(cfn_params)
-
-            if sg_rules["success"] is True:
-                scheduler_sg_rules = sg_rules["message"][cfn_params["scheduler_sg"]]
-                compute_node_sg_rules = sg_rules["message"][cfn_params["compute_node_sg"]]
-            else:
-                print(f"{fg('red')}Error: {sg_rules['message']} {attr('reset')}")
-                sys.exit(1)
+                fs_security_group_ids = {}
+                for fs_key in ['fs_apps', 'fs_data']:
+                    fs_security_group_ids[fs_key] = self.get_efs_security_group_ids(cfn_params[fs_key])
+                    security_group_ids += fs_security_group_ids[fs_key]
+            sg_rules = SecurityGroupRules(self.get_security_group_dicts(security_group_ids))
 
             errors = {}
             errors["SCHEDULER_SG_IN_COMPUTE"] = {
@@ -544,11 +548,11 @@ class FindExistingResource:
             errors["CLIENT_IP_HTTPS_IN_SCHEDULER"] = {
                     "status": False,
                     "error": f"Client IP must be allowed for port 443 (80 optional) on Scheduler SG",
-                    "resolution": f"Add two rules on {cfn_params['scheduler_sg']} that allow TCP ports 80 and 443 for {self.client_ip}"}
+                    "resolution": f"Add two rules on {cfn_params['scheduler_sg']} that allow TCP ports 80 and 443 for {client_ip}"}
             errors["CLIENT_IP_SSH_IN_SCHEDULER"] = {
                     "status": False,
                     "error": f"Client IP must be allowed for port 22 (SSH) on Scheduler SG",
-                    "resolution": f"Add one rule on {cfn_params['scheduler_sg']} that allow TCP port 22 for {self.client_ip}"}
+                    "resolution": f"Add one rule on {cfn_params['scheduler_sg']} that allow TCP port 22 for {client_ip}"}
             errors["SCHEDULER_SG_EQUAL_COMPUTE"] = {
                     "status": False,
                     "error": "Scheduler SG and Compute SG must be different",
@@ -559,57 +563,39 @@ class FindExistingResource:
                     "resolution": f"Add a new (EGRESS) rule on {cfn_params['compute_node_sg']} that allow TCP ports '0-65535' for {cfn_params['compute_node_sg']}. Make sure you configure EGRESS rule and not INGRESS"}
 
             if check_fs is True:
-                errors["FS_APP_SG"] = {
-                    "status": False,
-                    "error": f"SG assigned to EFS App {cfn_params['fs_apps']} must allow Scheduler SG and Compute SG",
-                    "resolution": f"Add {cfn_params['scheduler_sg']} and {cfn_params['compute_node_sg']} on your EFS Apps {cfn_params['fs_apps']}"}
-
-                errors["FS_DATA_SG"] = {
-                    "status": False,
-                    "error": f"SG assigned to EFS App {cfn_params['fs_data']} must allow Scheduler SG and Compute SG",
-                    "resolution": f"Add {cfn_params['scheduler_sg']} and {cfn_params['compute_node_sg']} on your EFS Data {cfn_params['fs_data']}"}
+                for fs_key, error_id, fs_description in [('fs_apps', 'FS_APP_SG', 'EFS Apps'), ('fs_data', 'FS_DATA_SG', 'EFS Data')]:
+                    fs_sgs = ', '.join(fs_security_group_ids[fs_key]) or f"the mount target SGs of {cfn_params[fs_key]}"
+                    errors[error_id] = {
+                        "status": False,
+                        "error": f"Mount target SGs of {fs_description} {cfn_params[fs_key]} must allow NFS (TCP port 2049) ingress from Scheduler SG and Compute SG",
+                        "resolution": f"Add inbound rules on {fs_sgs} that allow TCP port 2049 from {cfn_params['scheduler_sg']} and {cfn_params['compute_node_sg']}"}
 
             # Verify Scheduler Rules
-            for rules in scheduler_sg_rules:
-                if rules["from_port"] == 0 and rules["to_port"] == 65535:
-                    for rule in rules["approved_ips"]:
-                        if cfn_params['compute_node_sg'] in rule:
-                            errors["COMPUTE_SG_IN_SCHEDULER"]["status"] = True
-
-                if rules["from_port"] == 443 or rules["from_port"] == 22:
-                    for rule in rules["approved_ips"]:
-                        client_ip_netmask = 32
-                        if client_ip_netmask == '32':
-                            if ipaddress.IPv4Address(self.client_ip) in ipaddress.IPv4Network(rule):
-                                if rules["from_port"] == 443:
-                                    errors["CLIENT_IP_HTTPS_IN_SCHEDULER"]["status"] = True
-                                if rules["from_port"] == 22:
-                                    errors["CLIENT_IP_SSH_IN_SCHEDULER"]["status"] = True
-                        else:
-                            if self.client_ip in rule:
-                                if rules["from_port"] == 443:
-                                    errors["CLIENT_IP_HTTPS_IN_SCHEDULER"]["status"] = True
-                                if rules["from_port"] == 22:
-                                    errors["CLIENT_IP_SSH_IN_SCHEDULER"]["status"] = True
-            # Verify Compute Node Rules
-            for rules in compute_node_sg_rules:
-                if rules["from_port"] == 0 and rules["to_port"] == 65535:
-                    for rule in rules["approved_ips"]:
-                        if cfn_params['scheduler_sg'] in rule:
-                            errors["SCHEDULER_SG_IN_COMPUTE"]["status"] = True
+            if sg_rules.allows_ingress_from_security_group(scheduler_sg, compute_node_sg, 'tcp', 0, 65535):
+                errors["COMPUTE_SG_IN_SCHEDULER"]["status"] = True
+            if client_ip:
+                if sg_rules.allows_ingress_from_address(scheduler_sg, client_ip, 'tcp', 443, 443):
+                    errors["CLIENT_IP_HTTPS_IN_SCHEDULER"]["status"] = True
+                if sg_rules.allows_ingress_from_address(scheduler_sg, client_ip, 'tcp', 22, 22):
+                    errors["CLIENT_IP_SSH_IN_SCHEDULER"]["status"] = True
+            else:
+                # Can't check the client rules without the client's IP address
+                del errors["CLIENT_IP_HTTPS_IN_SCHEDULER"]
+                del errors["CLIENT_IP_SSH_IN_SCHEDULER"]
 
-                        if rules["type"] == "egress":
-                            if cfn_params['compute_node_sg'] in rule:
-                                errors["COMPUTE_SG_EGRESS_EFA"]["status"] = True
+            # Verify Compute Node Rules
+            if sg_rules.allows_ingress_from_security_group(compute_node_sg, scheduler_sg, 'tcp', 0, 65535):
+                errors["SCHEDULER_SG_IN_COMPUTE"]["status"] = True
+            if sg_rules.allows_egress_to_security_group(compute_node_sg, compute_node_sg, 'tcp', 0, 65535):
+                errors["COMPUTE_SG_EGRESS_EFA"]["status"] = True
 
             if check_fs is True:
-                if cfn_params['scheduler_sg'] in fs_sg["message"][cfn_params['fs_apps']] and cfn_params['compute_node_sg'] in fs_sg["message"][cfn_params['fs_apps']]:
-                    errors["FS_APP_SG"]["status"] = True
-
-                if cfn_params['scheduler_sg'] in fs_sg["message"][cfn_params['fs_data']] and cfn_params['compute_node_sg'] in fs_sg["message"][cfn_params['fs_data']]:
-                    errors["FS_DATA_SG"]["status"] = True
+                # The file systems must allow NFS from both the scheduler and compute nodes.
+                for fs_key, error_id in [('fs_apps', 'FS_APP_SG'), ('fs_data', 'FS_DATA_SG')]:
+                    if all(sg_rules.allows_ingress_from_security_group(fs_security_group_ids[fs_key], source_sg, 'tcp', 2049, 2049) for source_sg in [scheduler_sg, compute_node_sg]):
+                        errors[error_id]["status"] = True
 
-            if cfn_params["scheduler_sg"] != cfn_params["compute_node_sg"]:
+            if scheduler_sg != compute_node_sg:
                 errors["SCHEDULER_SG_EQUAL_COMPUTE"]["status"] = True
 
             sg_errors = {}
@@ -662,7 +648,7 @@ class FindExistingResource:
     def get_hosted_zone_id(self, vpc_id):
         try:
             hosted_zone_ids = {}
-            for hosted_zone_summary in self.route53.list_hosted_zones_by_vpc(VPCId= vpc_id, VPCRegion=self.region)['HostedZoneSummaries']:
+            for hosted_zone_summary in self.inventory.get_hosted_zones(vpc_id):
                 if hosted_zone_summary['Owner'].get('OwningService', None):
                     # Ignore because created by a service like a VPC endpoint
                     continue
@@ -27,11 +27,14 @@ If you trigger ./installer.py directly, make sure to have all the Python and CDK
 import argparse
 import base64
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import ClientError
 from botocore.exceptions import ProfileNotFound, ValidationError
 from botocore import config
 from colored import fg, bg, attr
+from concurrent.futures import as_completed, ThreadPoolExecutor
 import datetime
+import hashlib
 import json
 import logging
 import os
@@ -42,7 +45,7 @@ from requests.exceptions import RequestException, Timeout
 import shutil
 from shutil import make_archive, copytree
 import sys
-from time import sleep
+from time import sleep, time
 import urllib3
 import yaml
 from yaml.scanner import ScannerError
@@ -54,6 +57,7 @@ sys.path.append(source_path)
 
 from find_existing_resources import FindExistingResource
 from prompt import get_input as get_input
+from stack_watcher import StackWatcher, SUCCESS_STATES as STACK_SUCCESS_STATES
 
 logger = logging.getLogger(__file__)
 logger_formatter = logging.Formatter('%(levelname)s: %(message)s')
@@ -82,6 +86,7 @@ class SlurmInstaller():
         parser.add_argument("--VpcId", type=str, help="Id of VPC to use")
         parser.add_argument("--SubnetId", type=str, help="SubnetId to use")
         parser.add_argument("--ErrorSnsTopicArn", type=str, default='', help="SNS topic for error notifications.")
+        parser.add_argument("--resource-cache-ttl", type=int, default=300, help="Seconds to cache the VPCs, subnets, security groups, etc. found in the region. 0 disables the cache.")
         parser.add_argument("--debug", action='store_const', const=True, default=False, help="Enable CDK debug mode")
         parser.add_argument("--cdk-cmd", type=str, choices=["deploy", "create", "update", "diff", "ls", "list", "synth", "synthesize", "destroy", "bootstrap"], default="synth")
         args = parser.parse_args()
@@ -153,6 +158,9 @@ class SlurmInstaller():
             logger.error(f"{fg('red')}Unable to retrieve the Account ID due to {err}{attr('reset')}")
             sys.exit(1)
 
+        # Start finding existing resources in the background while the stack name is checked.
+        resource_finder = FindExistingResource(region, session, self.install_parameters["account_id"], args.resource_cache_ttl)
+
         # User Specified Variables
         logger.info("\n====== Validating SLURM parameters ======\n")
 
@@ -169,8 +177,6 @@ class SlurmInstaller():
         self.install_parameters['stack_name'] = self.config["StackName"]
         logger.info("{:30} {}".format("stack_name:", self.install_parameters['stack_name']))
 
-        resource_finder = FindExistingResource(region)
-
         config_key = 'SshKeyPair'
         if config_key not in self.config and not args.SshKeyPair and not args.prompt:
             logger.error(f"{fg('red')}Must specify --prompt or --{config_key} on the command line or {config_key} in the config file.{attr('reset')}")
@@ -237,9 +243,11 @@ class SlurmInstaller():
         # Get the CIDR block for the VPC. Used in multi-region deployments
         config_key = 'CIDR'
         if config_key not in self.config:
-            cidr = ec2.describe_vpcs(VpcIds=[self.config['VpcId']])['Vpcs'][0]['CidrBlock']
-            self.config[config_key] = cidr
-        self.install_parameters[config_key] = cidr
+            vpc = resource_finder.inventory.get_vpc(self.config['VpcId'])
+            if not vpc:
+                vpc = ec2.describe_vpcs(VpcIds=[self.config['VpcId']])['Vpcs'][0]
+            self.config[config_key] = vpc['CidrBlock']
+        self.install_parameters[config_key] = self.config[config_key]
         logger.info(f"{config_key:30}: {self.install_parameters[config_key]}")
 
         # Optional
@@ -463,56 +471,154 @@ class SlurmInstaller():
     def wait_for_slurm_stack(self):
         '''
         Wait for the Slurm stack to be created or updated.
+
+        Streams the events of the ParallelCluster stack and its nested stacks and exits as soon as it reaches a terminal state.
         '''
         stack_name = self.config['slurm']['ClusterName']
-        cfn_client = boto3.client("cloudformation", region_name=self.config['Region'])
+        cfn_client = boto3.client("cloudformation", region_name=self.config['Region'], config=config.Config(retries={'mode': 'adaptive'}))
 
-        valid_states = ['CREATE_COMPLETE', 'UPDATE_COMPLETE']
-        invalid_states = ['CREATE_FAILED', 'DELETE_IN_PROGRESS', 'ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']
-        stack_status = None
-        while stack_status not in (valid_states + invalid_states):
-            try:
-                previous_stack_status = stack_status
-                sleep(10)
-                stack_info = cfn_client.describe_stacks(StackName=stack_name)
-            except ClientError as e:
-                logger.error(f"ParallelCluster stack ({stack_name}) doesn't exist. Failed to create cluster.")
-                exit(1)
-            if stack_info['Stacks'][0]:
-                stack_status = stack_info['Stacks'][0]['StackStatus']
-                if stack_status != previous_stack_status:
-                    logger.info(f"ParallelCluster stack ({stack_name}) in {stack_status} state.")
+        logger.info(f"\n====== Waiting for ParallelCluster stack ({stack_name}) ======\n")
+        stack_watcher = StackWatcher(cfn_client, stack_name)
+        stack_status = stack_watcher.watch()
+        if stack_status is None:
+            logger.error(f"ParallelCluster stack ({stack_name}) doesn't exist. Failed to create cluster.")
+            exit(1)
 
-        if stack_status in invalid_states:
-            logger.error(f"ParallelCluster stack ({stack_name} deployment failed. State: {stack_status}")
+        if stack_status not in STACK_SUCCESS_STATES:
+            logger.error(f"{fg('red')}ParallelCluster stack ({stack_name}) deployment failed. State: {stack_status}{attr('reset')}")
+            for failure in stack_watcher.failures:
+                logger.error(f"{fg('red')}    {failure}{attr('reset')}")
             exit(1)
 
         logger.info(f"ParallelCluster stack {stack_name} successfully deployed.")
 
-def upload_objects(install_directory, bucket, stack_name):
-    # Upload required assets to customer S3 bucket
+# Multipart settings for upload_objects.
+# The chunk size is also used to compute the expected ETag of multipart objects so it must match what the objects were uploaded with.
+UPLOAD_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+UPLOAD_MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+UPLOAD_MAX_WORKERS = 16
+
+def get_local_etag(filename, multipart_threshold=UPLOAD_MULTIPART_THRESHOLD, multipart_chunksize=UPLOAD_MULTIPART_CHUNKSIZE):
+    '''
+    Compute the ETag that S3 will report for a file uploaded with the given multipart settings.
+
+    Single part uploads have the MD5 of the object as the ETag.
+    Multipart uploads have the MD5 of the concatenated part MD5s followed by -<number of parts>.
+    '''
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as fh:
+        if file_size < multipart_threshold:
+            md5 = hashlib.md5() # nosec
+            for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+                md5.update(chunk)
+            return md5.hexdigest()
+        part_digests = []
+        for chunk in iter(lambda: fh.read(multipart_chunksize), b''):
+            part_digests.append(hashlib.md5(chunk).digest()) # nosec
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}" # nosec
+
+def list_remote_objects(s3_client, bucket, prefix):
+    '''
+    Get the size and ETag of all objects under prefix with a single list_objects_v2 pass.
+
+    Returns:
+        dict: {key: {'Size': int, 'ETag': str}}
+    '''
+    remote_objects = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for s3_object in page.get('Contents', []):
+            remote_objects[s3_object['Key']] = {
+                'Size': s3_object['Size'],
+                'ETag': s3_object['ETag'].strip('"')
+            }
+    return remote_objects
+
+def upload_objects(install_directory, bucket, stack_name, s3_client=None, max_workers=UPLOAD_MAX_WORKERS):
+    '''
+    Upload the dist directory to s3://bucket/stack_name/.
+
+    Only new or changed files are uploaded.
+    The remote objects are listed once and each local file is compared by size first and then by ETag
+    so that re-running the installer after a small change only uploads what actually changed.
+
+    Nothing in the installer builds a dist directory or calls this yet.
+    The stack's own assets are uploaded by the CDK app.
+
+    Returns:
+        bool: True if all uploads succeeded
+    '''
     logger.info(f"\n====== Uploading install files to {bucket}/{stack_name} ======\n")
-    dist_directory = f"{install_directory}/../../dist/{stack_name}/"
-    if os.path.isdir(dist_directory):
-        logger.info(f"{dist_directory} already exist. Creating a new one for your build")
-        shutil.rmtree(dist_directory)
-    os.makedirs(dist_directory)
-
+    dist_directory = realpath(f"{install_directory}/../../dist/{stack_name}")
+    if not os.path.isdir(dist_directory):
+        logger.error(f"{fg('red')}{dist_directory} doesn't exist. Nothing to upload.{attr('reset')}")
+        return False
+
+    if not s3_client:
+        s3_client = boto3.client('s3', config=config.Config(max_pool_connections=max_workers, retries={'mode': 'adaptive'}))
+    transfer_config = TransferConfig(
+        multipart_threshold = UPLOAD_MULTIPART_THRESHOLD,
+        multipart_chunksize = UPLOAD_MULTIPART_CHUNKSIZE,
+        # The files are uploaded in parallel so don't also parallelize the parts of each file too much.
+        max_concurrency = 4,
+        use_threads = True
+    )
+
+    start_time = time()
     try:
-        install_bucket = s3.Bucket(bucket)
-        for path, subdirs, files in os.walk(f"{dist_directory}"):
-            path = path.replace("\\", "/")
-            directory = path.split("/")[-1]
-            for file in files:
-                if directory:
-                    upload_location = f"{stack_name}/{directory}/{file}"
-                else:
-                    upload_location = f"{stack_name}/{file}"
-                logger.info(f"{fg('green')}[+] Uploading {os.path.join(path, file)} to s3://{bucket}/{upload_location} {attr('reset')}")
-                install_bucket.upload_file(os.path.join(path, file), upload_location)
+        remote_objects = list_remote_objects(s3_client, bucket, f"{stack_name}/")
+    except ClientError as e:
+        logger.error(f"{fg('red')}Couldn't list s3://{bucket}/{stack_name}/: {e}{attr('reset')}")
+        return False
+    logger.info(f"Found {len(remote_objects)} existing objects in s3://{bucket}/{stack_name}/")
 
-    except Exception as upload_error:
-        logger.info(f"{fg('red')} Error during upload {upload_error}{attr('reset')}")
+    def get_upload(local_path):
+        '''
+        Returns (local_path, key, size) if the file needs to be uploaded, else (local_path, key, None)
+        '''
+        key = f"{stack_name}/{os.path.relpath(local_path, dist_directory).replace(os.sep, '/')}"
+        size = os.path.getsize(local_path)
+        remote_object = remote_objects.get(key)
+        if remote_object and remote_object['Size'] == size and remote_object['ETag'] == get_local_etag(local_path):
+            return (local_path, key, None)
+        return (local_path, key, size)
+
+    def upload(local_path, key):
+        s3_client.upload_file(local_path, bucket, key, Config=transfer_config)
+
+    local_paths = []
+    for path, subdirs, files in os.walk(dist_directory):
+        for file in files:
+            local_paths.append(os.path.join(path, file))
+
+    uploads = []
+    unchanged = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Hashing is I/O bound so do it in the pool too.
+        for local_path, key, size in executor.map(get_upload, local_paths):
+            if size is None:
+                unchanged += 1
+                logger.debug(f"Unchanged: {key}")
+            else:
+                uploads.append((local_path, key, size))
+
+        uploaded_bytes = 0
+        errors = 0
+        futures = {executor.submit(upload, local_path, key): (local_path, key, size) for local_path, key, size in uploads}
+        for future in as_completed(futures):
+            local_path, key, size = futures[future]
+            try:
+                future.result()
+            except Exception as upload_error:
+                errors += 1
+                logger.error(f"{fg('red')}Error uploading {local_path} to s3://{bucket}/{key}: {upload_error}{attr('reset')}")
+                continue
+            uploaded_bytes += size
+            logger.info(f"{fg('green')}[+] Uploaded {local_path} to s3://{bucket}/{key} {attr('reset')}")
+
+    elapsed_time = max(time() - start_time, 0.001)
+    logger.info(f"Uploaded {len(uploads) - errors} of {len(local_paths)} files ({unchanged} unchanged, {errors} failed), {uploaded_bytes / 1024 / 1024:.1f} MiB in {elapsed_time:.1f}s ({uploaded_bytes / 1024 / 1024 / elapsed_time:.1f} MiB/s)")
+    return errors == 0
 
 
 if __name__ == "__main__":
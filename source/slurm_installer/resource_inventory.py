@@ -0,0 +1,253 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+'''
+Inventory of the existing resources in a region that the installer prompts for and validates.
+
+The inventories are fetched in parallel once and then looked up from indexes so that
+the prompts respond immediately even in accounts with thousands of security groups and subnets.
+The inventories are also cached on disk for a few minutes so that reruns of the installer don't fetch them again.
+'''
+
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+from os.path import expanduser, getmtime
+from threading import Lock
+from time import time
+
+logger = logging.getLogger(__file__)
+logger_formatter = logging.Formatter('%(levelname)s: %(message)s')
+logger_streamHandler = logging.StreamHandler()
+logger_streamHandler.setFormatter(logger_formatter)
+logger.addHandler(logger_streamHandler)
+logger.propagate = False
+logger.setLevel(logging.INFO)
+
+DEFAULT_CACHE_DIR = expanduser('~/.cache/aws-eda-slurm-cluster')
+
+DEFAULT_CACHE_TTL = 300
+
+STACK_STATUS_FILTER = [
+    'CREATE_COMPLETE',
+    'ROLLBACK_COMPLETE',
+    'UPDATE_COMPLETE',
+    'UPDATE_ROLLBACK_COMPLETE',
+    'IMPORT_COMPLETE',
+    'IMPORT_ROLLBACK_COMPLETE'
+]
+
+class ResourceInventory:
+
+    def __init__(self, region, session=None, account_id=None, cache_dir=DEFAULT_CACHE_DIR, cache_ttl=DEFAULT_CACHE_TTL):
+        '''
+        Args:
+            cache_ttl: Seconds that the inventories cached on disk are valid. 0 disables the disk cache.
+        '''
+        self.region = region
+        if not session:
+            session = boto3.Session(region_name=region)
+        self.ec2 = session.client('ec2', region_name=region)
+        self.cloudformation = session.client('cloudformation', region_name=region)
+        self.route53 = session.client('route53', region_name=region)
+        self.sns = session.client('sns', region_name=region)
+
+        self.cache_ttl = cache_ttl
+        self.cache_dir = f"{cache_dir}/{account_id if account_id else 'default'}/{region}"
+
+        self.loaders = {
+            'key_pairs': self.load_key_pairs,
+            'vpcs': self.load_vpcs,
+            'subnets': self.load_subnets,
+            'security_groups': self.load_security_groups,
+            'sns_topics': self.load_sns_topics,
+            'stacks': self.load_stacks,
+        }
+        self.inventories = {}
+        self.futures = {}
+        self.indexes = {}
+        self.lock = Lock()
+        self.executor = None
+
+    def prefetch(self):
+        '''
+        Start loading all of the inventories in the background.
+        '''
+        with self.lock:
+            if self.executor:
+                return
+            self.executor = ThreadPoolExecutor(max_workers=len(self.loaders))
+            for name, loader in self.loaders.items():
+                if name not in self.inventories:
+                    self.futures[name] = self.executor.submit(self.read_inventory, name)
+        self.executor.shutdown(wait=False)
+
+    def get(self, name):
+        '''
+        Get an inventory from memory, the background prefetch, the disk cache, or AWS in that order.
+        '''
+        if name in self.inventories:
+            return self.inventories[name]
+        with self.lock:
+            future = self.futures.pop(name, None)
+        if future:
+            inventory = future.result()
+        else:
+            inventory = self.read_inventory(name)
+        with self.lock:
+            self.inventories[name] = inventory
+        return inventory
+
+    def read_inventory(self, name):
+        inventory = self.read_cache_file(name)
+        if inventory is not None:
+            return inventory
+        logger.debug(f"Loading {name} in {self.region}")
+        inventory = self.loaders[name]()
+        self.write_cache_file(name, inventory)
+        return inventory
+
+    def cache_filename(self, name):
+        return f"{self.cache_dir}/{name}.json"
+
+    def read_cache_file(self, name):
+        if not self.cache_ttl:
+            return None
+        filename = self.cache_filename(name)
+        try:
+            if time() - getmtime(filename) > self.cache_ttl:
+                return None
+            with open(filename, 'r') as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def write_cache_file(self, name, inventory):
+        if not self.cache_ttl:
+            return
+        filename = self.cache_filename(name)
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            # Write to a temporary file and rename it so that a partially written file is never read.
+            tmp_filename = f"{filename}.{os.getpid()}.tmp"
+            with open(tmp_filename, 'w') as fh:
+                json.dump(inventory, fh, default=str)
+            os.replace(tmp_filename, filename)
+        except OSError as e:
+            logger.debug(f"Couldn't write {filename}: {e}")
+
+    def remove_cache_file(self, name):
+        try:
+            os.remove(self.cache_filename(name))
+        except OSError:
+            pass
+
+    def get_index(self, name, key):
+        '''
+        Get a dict of the items in an inventory indexed by key.
+        '''
+        index_name = (name, key)
+        if index_name not in self.indexes:
+            index = {}
+            for item in self.get(name):
+                index[item[key]] = item
+            self.indexes[index_name] = index
+        return self.indexes[index_name]
+
+    def get_grouped_index(self, name, key):
+        '''
+        Get a dict of lists of the items in an inventory grouped by key.
+        '''
+        index_name = (name, key, 'grouped')
+        if index_name not in self.indexes:
+            index = {}
+            for item in self.get(name):
+                index.setdefault(item[key], []).append(item)
+            self.indexes[index_name] = index
+        return self.indexes[index_name]
+
+    def load_key_pairs(self):
+        return self.ec2.describe_key_pairs()['KeyPairs']
+
+    def load_vpcs(self):
+        vpcs = []
+        for page in self.ec2.get_paginator('describe_vpcs').paginate():
+            vpcs += page['Vpcs']
+        return vpcs
+
+    def load_subnets(self):
+        subnets = []
+        for page in self.ec2.get_paginator('describe_subnets').paginate():
+            subnets += page['Subnets']
+        return subnets
+
+    def load_security_groups(self):
+        security_groups = []
+        for page in self.ec2.get_paginator('describe_security_groups').paginate():
+            security_groups += page['SecurityGroups']
+        return security_groups
+
+    def load_sns_topics(self):
+        topics = []
+        for page in self.sns.get_paginator('list_topics').paginate():
+            topics += page['Topics']
+        return topics
+
+    def load_stacks(self):
+        stacks = []
+        for page in self.cloudformation.get_paginator('list_stacks').paginate(StackStatusFilter=STACK_STATUS_FILTER):
+            stacks += page['StackSummaries']
+        return stacks
+
+    def get_key_pairs(self):
+        return self.get('key_pairs')
+
+    def get_vpcs(self):
+        return self.get('vpcs')
+
+    def get_vpc(self, vpc_id):
+        return self.get_index('vpcs', 'VpcId').get(vpc_id, None)
+
+    def get_subnet(self, subnet_id):
+        return self.get_index('subnets', 'SubnetId').get(subnet_id, None)
+
+    def get_subnets_in_vpc(self, vpc_id):
+        return self.get_grouped_index('subnets', 'VpcId').get(vpc_id, [])
+
+    def get_security_group(self, security_group_id):
+        return self.get_index('security_groups', 'GroupId').get(security_group_id, None)
+
+    def get_security_groups_in_vpc(self, vpc_id):
+        return self.get_grouped_index('security_groups', 'VpcId').get(vpc_id, [])
+
+    def get_sns_topics(self):
+        return self.get('sns_topics')
+
+    def get_stacks(self):
+        return self.get('stacks')
+
+    def get_hosted_zones(self, vpc_id):
+        '''
+        Hosted zones are looked up per VPC so they are loaded on demand instead of prefetched.
+        '''
+        name = f"hosted_zones-{vpc_id}"
+        if name not in self.loaders:
+            self.loaders[name] = lambda: self.route53.list_hosted_zones_by_vpc(VPCId=vpc_id, VPCRegion=self.region)['HostedZoneSummaries']
+        return self.get(name)
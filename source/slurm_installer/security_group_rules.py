@@ -0,0 +1,249 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+'''
+Evaluate security group rules to check whether traffic is allowed.
+
+The rules of each security group are indexed by (group id, direction, protocol).
+Each index entry has:
+* The port ranges allowed for each referenced security group.
+* A binary trie of the allowed CIDRs with the port ranges allowed for each.
+
+Port ranges are kept merged and sorted so coverage of a range is a binary search
+and address lookups only walk the bits of the address.
+
+Used by the installer to validate existing security groups and by create-slurm-security-groups
+to check the security groups that it created.
+'''
+
+from bisect import bisect_right
+import ipaddress
+
+MIN_PORT = 0
+MAX_PORT = 65535
+
+ALL_PROTOCOLS = '-1'
+
+# describe_security_groups returns the protocol name or number
+PROTOCOL_NAMES = {
+    '1': 'icmp',
+    '6': 'tcp',
+    '17': 'udp',
+    '58': 'icmpv6',
+}
+
+def normalize_protocol(protocol):
+    protocol = str(protocol).lower()
+    return PROTOCOL_NAMES.get(protocol, protocol)
+
+class PortRanges:
+    '''
+    Set of port ranges stored as sorted, merged, non-overlapping ranges.
+    '''
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.pending = []
+
+    def add(self, from_port, to_port):
+        self.pending.append((from_port, to_port))
+
+    def merge(self):
+        if not self.pending:
+            return
+        ranges = sorted(list(zip(self.starts, self.ends)) + self.pending)
+        self.pending = []
+        self.starts = []
+        self.ends = []
+        for from_port, to_port in ranges:
+            if self.ends and from_port <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], to_port)
+            else:
+                self.starts.append(from_port)
+                self.ends.append(to_port)
+
+    def ranges(self):
+        self.merge()
+        return list(zip(self.starts, self.ends))
+
+    def covers(self, from_port, to_port):
+        '''
+        Check if every port in the range is in the set.
+        '''
+        self.merge()
+        index = bisect_right(self.starts, from_port) - 1
+        return index >= 0 and self.ends[index] >= to_port
+
+def port_ranges_cover(port_ranges_list, from_port, to_port):
+    '''
+    Check if the union of several port range sets covers the range.
+    '''
+    port_ranges_list = [port_ranges for port_ranges in port_ranges_list if port_ranges]
+    for port_ranges in port_ranges_list:
+        if port_ranges.covers(from_port, to_port):
+            return True
+    if len(port_ranges_list) < 2:
+        return False
+    union = PortRanges()
+    for port_ranges in port_ranges_list:
+        for start, end in port_ranges.ranges():
+            union.add(start, end)
+    return union.covers(from_port, to_port)
+
+class CidrTrie:
+    '''
+    Binary trie of CIDR blocks with the port ranges allowed for each.
+
+    Each node is [child for bit 0, child for bit 1, PortRanges or None].
+    '''
+    def __init__(self):
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+
+    def add(self, network, from_port, to_port):
+        network = ipaddress.ip_network(network, strict=False)
+        node = self.roots[network.version]
+        address = int(network.network_address)
+        for bit_index in range(network.prefixlen):
+            bit = (address >> (network.max_prefixlen - 1 - bit_index)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            node[2] = PortRanges()
+        node[2].add(from_port, to_port)
+
+    def lookup(self, address_or_network):
+        '''
+        Get the port ranges of every CIDR that contains the address or network.
+        '''
+        network = ipaddress.ip_network(address_or_network, strict=False)
+        node = self.roots[network.version]
+        address = int(network.network_address)
+        port_ranges_list = []
+        for bit_index in range(network.prefixlen + 1):
+            if node[2]:
+                port_ranges_list.append(node[2])
+            if bit_index == network.prefixlen:
+                break
+            bit = (address >> (network.max_prefixlen - 1 - bit_index)) & 1
+            node = node[bit]
+            if node is None:
+                break
+        return port_ranges_list
+
+class RuleSet:
+    '''
+    Rules for one security group, direction, and protocol.
+    '''
+    def __init__(self):
+        self.security_groups = {}
+        self.prefix_lists = {}
+        self.cidrs = CidrTrie()
+
+class SecurityGroupRules:
+
+    def __init__(self, security_groups=[]):
+        '''
+        Args:
+            security_groups: list of security group dicts as returned by describe_security_groups
+        '''
+        self.rule_sets = {}
+        for security_group in security_groups:
+            self.add_security_group(security_group)
+
+    def add_security_group(self, security_group):
+        group_id = security_group['GroupId']
+        for direction, permissions_key in [('ingress', 'IpPermissions'), ('egress', 'IpPermissionsEgress')]:
+            for ip_permission in security_group.get(permissions_key, []):
+                self.add_ip_permission(group_id, direction, ip_permission)
+
+    def add_ip_permission(self, group_id, direction, ip_permission):
+        protocol = normalize_protocol(ip_permission['IpProtocol'])
+        from_port = ip_permission.get('FromPort', MIN_PORT)
+        to_port = ip_permission.get('ToPort', MAX_PORT)
+        if protocol == ALL_PROTOCOLS or from_port == -1:
+            # All ports or all ICMP types
+            from_port = MIN_PORT
+            to_port = MAX_PORT
+        rule_set = self.rule_sets.setdefault((group_id, direction, protocol), RuleSet())
+        for user_id_group_pair in ip_permission.get('UserIdGroupPairs', []):
+            rule_set.security_groups.setdefault(user_id_group_pair['GroupId'], PortRanges()).add(from_port, to_port)
+        for ip_range in ip_permission.get('IpRanges', []):
+            rule_set.cidrs.add(ip_range['CidrIp'], from_port, to_port)
+        for ipv6_range in ip_permission.get('Ipv6Ranges', []):
+            rule_set.cidrs.add(ipv6_range['CidrIpv6'], from_port, to_port)
+        for prefix_list_id in ip_permission.get('PrefixListIds', []):
+            rule_set.prefix_lists.setdefault(prefix_list_id['PrefixListId'], PortRanges()).add(from_port, to_port)
+
+    def get_rule_sets(self, group_ids, direction, protocol):
+        if isinstance(group_ids, str):
+            group_ids = [group_ids]
+        protocol = normalize_protocol(protocol)
+        rule_sets = []
+        for group_id in group_ids:
+            for rule_protocol in set([protocol, ALL_PROTOCOLS]):
+                rule_set = self.rule_sets.get((group_id, direction, rule_protocol), None)
+                if rule_set:
+                    rule_sets.append(rule_set)
+        return rule_sets
+
+    def allows_security_group(self, group_ids, direction, peer_group_ids, protocol, from_port, to_port):
+        '''
+        Check if any of the security groups has rules that allow the peer security groups on all of the ports.
+        '''
+        if isinstance(peer_group_ids, str):
+            peer_group_ids = [peer_group_ids]
+        port_ranges_list = []
+        for rule_set in self.get_rule_sets(group_ids, direction, protocol):
+            for peer_group_id in peer_group_ids:
+                port_ranges_list.append(rule_set.security_groups.get(peer_group_id, None))
+        return port_ranges_cover(port_ranges_list, from_port, to_port)
+
+    def allows_address(self, group_ids, direction, address_or_network, protocol, from_port, to_port):
+        '''
+        Check if any of the security groups has CIDR rules that allow the address or network on all of the ports.
+        '''
+        port_ranges_list = []
+        for rule_set in self.get_rule_sets(group_ids, direction, protocol):
+            port_ranges_list += rule_set.cidrs.lookup(address_or_network)
+        return port_ranges_cover(port_ranges_list, from_port, to_port)
+
+    def allows_ingress_from_security_group(self, group_ids, source_group_ids, protocol, from_port, to_port):
+        return self.allows_security_group(group_ids, 'ingress', source_group_ids, protocol, from_port, to_port)
+
+    def allows_egress_to_security_group(self, group_ids, destination_group_ids, protocol, from_port, to_port):
+        return self.allows_security_group(group_ids, 'egress', destination_group_ids, protocol, from_port, to_port)
+
+    def allows_ingress_from_address(self, group_ids, address_or_network, protocol, from_port, to_port):
+        return self.allows_address(group_ids, 'ingress', address_or_network, protocol, from_port, to_port)
+
+    def can_reach(self, source_group_ids, destination_group_ids, protocol, from_port, to_port):
+        '''
+        Check if instances with the source security groups can connect to instances with the destination security groups.
+
+        The source must allow the traffic out, either to one of the destination security groups or to all addresses,
+        and the destination must allow it in from one of the source security groups.
+        Security groups are stateful so the return traffic doesn't need rules.
+        '''
+        egress_allowed = (
+            self.allows_egress_to_security_group(source_group_ids, destination_group_ids, protocol, from_port, to_port) or
+            self.allows_address(source_group_ids, 'egress', '0.0.0.0/0', protocol, from_port, to_port)
+        )
+        if not egress_allowed:
+            return False
+        return self.allows_ingress_from_security_group(destination_group_ids, source_group_ids, protocol, from_port, to_port)
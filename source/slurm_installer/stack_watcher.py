@@ -0,0 +1,236 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+'''
+Watch a CloudFormation stack and its nested stacks until the deployment reaches a terminal state.
+
+The stack events are paged incrementally so that each poll only reads the events since the last one seen.
+Nested stacks are discovered from the events of their parent and watched until they finish.
+'''
+
+from botocore.exceptions import ClientError
+from colored import fg, attr
+from datetime import datetime, timedelta, timezone
+import logging
+from time import sleep, time
+
+logger = logging.getLogger(__file__)
+logger_formatter = logging.Formatter('%(levelname)s: %(message)s')
+logger_streamHandler = logging.StreamHandler()
+logger_streamHandler.setFormatter(logger_formatter)
+logger.addHandler(logger_streamHandler)
+logger.propagate = False
+logger.setLevel(logging.INFO)
+
+SUCCESS_STATES = [
+    'CREATE_COMPLETE',
+    'UPDATE_COMPLETE',
+    'IMPORT_COMPLETE',
+]
+
+FAILED_STATES = [
+    'CREATE_FAILED',
+    'DELETE_COMPLETE',
+    'DELETE_FAILED',
+    'IMPORT_ROLLBACK_COMPLETE',
+    'IMPORT_ROLLBACK_FAILED',
+    'ROLLBACK_COMPLETE',
+    'ROLLBACK_FAILED',
+    'UPDATE_FAILED',
+    'UPDATE_ROLLBACK_COMPLETE',
+    'UPDATE_ROLLBACK_FAILED',
+    # Not terminal, but the deployment has failed and the stack is going away.
+    'DELETE_IN_PROGRESS',
+]
+
+TERMINAL_STATES = SUCCESS_STATES + FAILED_STATES
+
+MIN_POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 30
+
+# How often to report the resources that are still in progress when nothing else is happening.
+PROGRESS_INTERVAL = 120
+
+# How long to wait for the stack to show up before giving up.
+STACK_MISSING_TIMEOUT = 300
+
+class StackWatcher:
+
+    def __init__(self, cfn_client, stack_name, start_time=None):
+        '''
+        Args:
+            cfn_client: boto3 CloudFormation client
+            stack_name (str): Name or id of the root stack
+            start_time (datetime): Ignore events before this time. Defaults to now.
+        '''
+        self.cfn_client = cfn_client
+        self.stack_name = stack_name
+        if not start_time:
+            # Allow for some clock skew between the local host and CloudFormation
+            start_time = datetime.now(timezone.utc) - timedelta(seconds=60)
+        self.start_time = start_time
+
+        # {stack_id: last seen event id}
+        self.active_stacks = {}
+        # Stack ids that have already been discovered so they aren't added back once they finish
+        self.known_stacks = set()
+        # {(stack_id, logical id): {'ResourceType': str, 'ResourceStatus': str, 'Start': datetime}}
+        self.resources = {}
+        self.failures = []
+        self.root_stack_id = None
+        self.stack_status = None
+        self.watch_start_time = time()
+
+    def watch(self):
+        '''
+        Stream the stack events until the root stack reaches a terminal state.
+
+        Returns:
+            str: The terminal stack status. None if the stack doesn't exist.
+        '''
+        poll_interval = MIN_POLL_INTERVAL
+        last_progress_time = time()
+        first_missing_time = None
+        while True:
+            try:
+                stack = self.cfn_client.describe_stacks(StackName=self.stack_name)['Stacks'][0]
+            except ClientError as e:
+                if 'does not exist' not in str(e):
+                    raise
+                if not first_missing_time:
+                    first_missing_time = time()
+                if time() - first_missing_time > STACK_MISSING_TIMEOUT:
+                    logger.error(f"{fg('red')}{self.stack_name} stack doesn't exist.{attr('reset')}")
+                    return None
+                sleep(poll_interval)
+                continue
+            if not self.root_stack_id:
+                self.root_stack_id = stack['StackId']
+                self.add_stack(self.root_stack_id)
+
+            new_events = 0
+            for active_stack_id in list(self.active_stacks.keys()):
+                new_events += self.poll_stack_events(active_stack_id)
+
+            # Read the status after the events so that the final events are always printed before returning.
+            previous_stack_status = self.stack_status
+            self.stack_status = stack['StackStatus']
+            if self.stack_status != previous_stack_status:
+                logger.info(f"{self.elapsed()} {self.stack_name} stack in {self.stack_status} state.")
+            if self.stack_status in TERMINAL_STATES:
+                # Pick up any events that arrived between the describe_stacks and now.
+                for active_stack_id in list(self.active_stacks.keys()):
+                    self.poll_stack_events(active_stack_id)
+                return self.stack_status
+
+            if new_events:
+                poll_interval = MIN_POLL_INTERVAL
+                last_progress_time = time()
+            else:
+                poll_interval = min(poll_interval * 1.5, MAX_POLL_INTERVAL)
+                if time() - last_progress_time >= PROGRESS_INTERVAL:
+                    self.log_in_progress_resources()
+                    last_progress_time = time()
+            sleep(poll_interval)
+
+    def add_stack(self, stack_id):
+        self.known_stacks.add(stack_id)
+        self.active_stacks[stack_id] = None
+
+    def poll_stack_events(self, stack_id):
+        '''
+        Get the events since the last one seen for the stack and log them oldest first.
+
+        Returns:
+            int: Number of new events
+        '''
+        last_event_id = self.active_stacks[stack_id]
+        events = []
+        # Events are returned newest first so only page back until the last event that was already seen.
+        paginator = self.cfn_client.get_paginator('describe_stack_events')
+        done = False
+        for page in paginator.paginate(StackName=stack_id):
+            for event in page['StackEvents']:
+                if event['EventId'] == last_event_id or event['Timestamp'] < self.start_time:
+                    done = True
+                    break
+                events.append(event)
+            if done:
+                break
+        if not events:
+            return 0
+        self.active_stacks[stack_id] = events[0]['EventId']
+
+        for event in reversed(events):
+            self.process_event(stack_id, event)
+        return len(events)
+
+    def process_event(self, stack_id, event):
+        logical_id = event['LogicalResourceId']
+        resource_type = event['ResourceType']
+        status = event['ResourceStatus']
+        reason = event.get('ResourceStatusReason', '')
+        timestamp = event['Timestamp']
+        stack_name = event['StackName']
+        is_stack = resource_type == 'AWS::CloudFormation::Stack'
+
+        key = (stack_id, logical_id)
+        resource = self.resources.get(key)
+        duration = ''
+        if status.endswith('_IN_PROGRESS'):
+            if not resource or not resource['ResourceStatus'].endswith('_IN_PROGRESS'):
+                self.resources[key] = {'ResourceType': resource_type, 'ResourceStatus': status, 'Start': timestamp}
+            else:
+                resource['ResourceStatus'] = status
+        elif resource:
+            duration = f" ({(timestamp - resource['Start']).total_seconds():.0f}s)"
+            del self.resources[key]
+
+        message = f"{self.elapsed()} {stack_name} {logical_id} ({resource_type}) {status}{duration}"
+        if reason and ('FAILED' in status or 'ROLLBACK' in status):
+            self.failures.append(f"{stack_name} {logical_id}: {reason}")
+            logger.info(f"{fg('red')}{message}: {reason}{attr('reset')}")
+        elif status.endswith('_COMPLETE') and not ('ROLLBACK' in status or 'DELETE' in status):
+            logger.info(f"{fg('green')}{message}{attr('reset')}")
+        else:
+            logger.info(message)
+
+        if not is_stack:
+            return
+        physical_id = event.get('PhysicalResourceId', '')
+        if physical_id == stack_id:
+            # Status of the stack itself. Stop watching nested stacks once they are done.
+            if status in TERMINAL_STATES and physical_id != self.root_stack_id:
+                del self.active_stacks[stack_id]
+        elif physical_id.startswith('arn:') and physical_id not in self.known_stacks:
+            logger.debug(f"Watching nested stack {physical_id}")
+            self.add_stack(physical_id)
+
+    def log_in_progress_resources(self):
+        now = datetime.now(timezone.utc)
+        in_progress = sorted(self.resources.items(), key=lambda item: item[1]['Start'])
+        if not in_progress:
+            return
+        logger.info(f"{self.elapsed()} {len(in_progress)} resources in progress:")
+        for (stack_id, logical_id), resource in in_progress:
+            logger.info(f"    {logical_id:40} {resource['ResourceType']:40} {resource['ResourceStatus']:20} {(now - resource['Start']).total_seconds():.0f}s")
+
+    def elapsed(self):
+        elapsed = int(time() - self.watch_start_time)
+        return f"[{elapsed // 60:3d}m{elapsed % 60:02d}s]"
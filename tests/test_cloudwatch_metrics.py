@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import gc
+import json
+from os.path import abspath, dirname
+import pytest
+import sys
+
+REPO_DIR = abspath(f"{dirname(__file__)}/..")
+sys.path.insert(0, f"{REPO_DIR}/source")
+
+pytest.importorskip('botocore')
+
+import SlurmPlugin
+from SlurmPlugin import CloudWatchMetrics
+
+class FakeCloudWatchClient:
+    def __init__(self):
+        self.calls = []
+
+    def put_metric_data(self, Namespace, MetricData):
+        self.calls.append((Namespace, MetricData))
+
+@pytest.fixture
+def cw_client():
+    return FakeCloudWatchClient()
+
+def test_statistic_set_aggregation(cw_client):
+    metrics = CloudWatchMetrics('TEST', lambda: cw_client, flush_interval=3600)
+    for value in [1, 2, 6]:
+        metrics.put_metric('Latency', value, [{'Name': 'Region', 'Value': 'us-east-1'}], unit='Seconds')
+    metrics.put_metric('Latency', 10, [{'Name': 'Region', 'Value': 'us-west-2'}], unit='Seconds')
+    metrics.flush()
+    assert len(cw_client.calls) == 1
+    (namespace, metric_data) = cw_client.calls[0]
+    assert namespace == 'TEST'
+    assert len(metric_data) == 2
+    us_east_1 = [data for data in metric_data if data['Dimensions'] == [{'Name': 'Region', 'Value': 'us-east-1'}]][0]
+    assert us_east_1['MetricName'] == 'Latency'
+    assert us_east_1['Unit'] == 'Seconds'
+    assert us_east_1['StatisticValues'] == {'SampleCount': 3, 'Sum': 9.0, 'Minimum': 1.0, 'Maximum': 6.0}
+
+    # The buffer is empty after a flush
+    metrics.flush()
+    assert len(cw_client.calls) == 1
+    metrics.close()
+
+def test_batching(cw_client):
+    metrics = CloudWatchMetrics('TEST', lambda: cw_client, flush_interval=3600)
+    number_of_metrics = CloudWatchMetrics.MAX_METRIC_DATA * 2 + 1
+    for index in range(number_of_metrics):
+        metrics.put_metric(f"Metric{index}", index)
+    metrics.flush()
+    assert [len(metric_data) for namespace, metric_data in cw_client.calls] == [CloudWatchMetrics.MAX_METRIC_DATA, CloudWatchMetrics.MAX_METRIC_DATA, 1]
+    metrics.close()
+
+def test_emf(tmp_path):
+    emf_filename = tmp_path / 'metrics.emf'
+    def create_client():
+        raise AssertionError("emf mode must not create a client")
+    metrics = CloudWatchMetrics('TEST', create_client, mode='emf', flush_interval=3600, emf_filename=str(emf_filename))
+    number_of_values = CloudWatchMetrics.MAX_EMF_VALUES + 5
+    for value in range(number_of_values):
+        metrics.put_metric('Count', value, [{'Name': 'Region', 'Value': 'us-east-1'}])
+    metrics.flush()
+    lines = [json.loads(line) for line in emf_filename.read_text().splitlines()]
+    assert len(lines) == 2
+    assert lines[0]['_aws']['CloudWatchMetrics'] == [{'Namespace': 'TEST', 'Dimensions': [['Region']], 'Metrics': [{'Name': 'Count', 'Unit': 'Count'}]}]
+    assert lines[0]['Region'] == 'us-east-1'
+    assert lines[0]['Count'] + lines[1]['Count'] == [float(value) for value in range(number_of_values)]
+    metrics.close()
+
+def test_disabled(cw_client):
+    metrics = CloudWatchMetrics('TEST', lambda: cw_client, mode='disabled')
+    metrics.put_metric('Count', 1)
+    metrics.flush()
+    assert cw_client.calls == []
+    assert metrics.flush_thread is None
+
+def test_exit_handler_flushes_without_keeping_instances_alive(cw_client):
+    metrics = CloudWatchMetrics('TEST', lambda: cw_client, flush_interval=3600)
+    metrics.put_metric('Count', 1)
+    SlurmPlugin._close_cloudwatch_metrics()
+    assert len(cw_client.calls) == 1
+
+    idle_metrics = CloudWatchMetrics('TEST', lambda: cw_client)
+    idle_metrics_count = len(SlurmPlugin._cloudwatch_metrics_instances)
+    del idle_metrics
+    gc.collect()
+    assert len(SlurmPlugin._cloudwatch_metrics_instances) == idle_metrics_count - 1
+
+def test_instance_config_selection_metrics(cw_client, monkeypatch):
+    monkeypatch.setenv('SLURM_PLUGIN_METRICS_MODE', 'api')
+    plugin = SlurmPlugin.SlurmPlugin(slurm_config_file=None, region='us-east-1')
+    plugin._cw = cw_client
+    plugin.instance_type_and_family_info = {
+        'us-east-1': {
+            'instance_families': {
+                'c5': {'instance_types': ['c5.large', 'c5.xlarge'], 'MaxInstanceType': 'c5.xlarge'},
+                'm5': {'instance_types': ['m5.large'], 'MaxInstanceType': 'm5.large'},
+            }
+        }
+    }
+    instance_config = {
+        'UseOnDemand': True,
+        'UseSpot': False,
+        'DisableSimultaneousMultithreading': True,
+        'EnableEfa': False,
+        'Include': {'InstanceFamilies': ['c5'], 'InstanceTypes': []},
+    }
+    instance_types = plugin.get_instance_types_from_instance_config(instance_config, ['us-east-1'], None)
+    assert sorted(instance_types['us-east-1'].keys()) == ['c5.large', 'c5.xlarge']
+    plugin.metrics.flush()
+    metric_data = {data['MetricName']: data for data in cw_client.calls[0][1]}
+    assert metric_data[SlurmPlugin.SlurmPlugin.CW_INSTANCE_TYPES_SELECTED]['StatisticValues']['Sum'] == 2
+    assert metric_data[SlurmPlugin.SlurmPlugin.CW_INSTANCE_CONFIG_SELECTION_TIME]['Unit'] == 'Seconds'
+    plugin.metrics.close()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import json
+from os.path import abspath, dirname
+import pytest
+import sys
+import types
+
+REPO_DIR = abspath(f"{dirname(__file__)}/..")
+sys.path.insert(0, f"{REPO_DIR}/source")
+
+from EC2InstanceTypeInfoPkg.check_instance_type_info import check_instance_type_and_family_info
+
+OLD_FORMAT_JSON = f"{REPO_DIR}/tests/instance_type_info.old_format.json"
+
+INSTANCE_TYPE_INFO = {
+    'us-east-1': {
+        'instance_types': {
+            'c5.large': {
+                'architecture': 'x86_64',
+                'SustainedClockSpeedInGhz': 3.4,
+                'DefaultVCpus': 2,
+                'DefaultCores': 1,
+                'DefaultThreadsPerCore': 2,
+                'ValidThreadsPerCore': [1, 2],
+                'MemoryInMiB': 4096,
+                'SSDCount': 0,
+                'SSDTotalSizeGB': 0,
+                'Hypervisor': 'nitro',
+                'NetworkPerformance': 'Up to 10 Gigabit',
+            }
+        },
+        'instance_families': {
+            'c5': {
+                'instance_types': ['c5.large'],
+                'architecture': 'x86_64',
+                'MaxCoreCount': 1,
+                'MaxInstanceType': 'c5.large',
+                'MaxInstanceSize': 'large',
+            }
+        }
+    }
+}
+
+def test_check_instance_type_and_family_info():
+    check_instance_type_and_family_info(INSTANCE_TYPE_INFO)
+    with open(OLD_FORMAT_JSON, 'r') as fh:
+        old_format_info = json.load(fh)
+    with pytest.raises(KeyError):
+        check_instance_type_and_family_info(old_format_info)
+
+@pytest.fixture
+def slurm_plugin_config(tmp_path):
+    pytest.importorskip('botocore')
+    instance_type_info_file = tmp_path / 'instance_type_info.json'
+    slurm_config_file = tmp_path / 'slurm_config.json'
+    slurm_config_file.write_text(json.dumps({
+        'region': 'us-east-1',
+        'InstanceTypeInfoFile': str(instance_type_info_file),
+        'CloudWatchMetricsMode': 'disabled',
+    }))
+    return (str(slurm_config_file), instance_type_info_file)
+
+@pytest.fixture
+def fake_ec2_instance_type_info(monkeypatch):
+    '''
+    Replace EC2InstanceTypeInfo so that the fallback doesn't call AWS.
+    '''
+    calls = []
+    class EC2InstanceTypeInfo:
+        def __init__(self, regions, get_savings_plans=True, json_filename=None, debug=False):
+            calls.append(regions)
+            self.instance_type_and_family_info = INSTANCE_TYPE_INFO
+    module = types.ModuleType('EC2InstanceTypeInfoPkg.EC2InstanceTypeInfo')
+    module.EC2InstanceTypeInfo = EC2InstanceTypeInfo
+    monkeypatch.setitem(sys.modules, 'EC2InstanceTypeInfoPkg.EC2InstanceTypeInfo', module)
+    return calls
+
+def test_cached_catalog(slurm_plugin_config, fake_ec2_instance_type_info):
+    from SlurmPlugin import SlurmPlugin
+    (slurm_config_file, instance_type_info_file) = slurm_plugin_config
+    instance_type_info_file.write_text(json.dumps(INSTANCE_TYPE_INFO))
+    plugin = SlurmPlugin(slurm_config_file)
+    plugin.get_instance_type_and_family_info()
+    assert plugin.instance_type_and_family_info == INSTANCE_TYPE_INFO
+    assert fake_ec2_instance_type_info == []
+
+@pytest.mark.parametrize('content', [
+    open(OLD_FORMAT_JSON, 'r').read(),
+    json.dumps(INSTANCE_TYPE_INFO)[0:100],
+])
+def test_invalid_cached_catalog(slurm_plugin_config, fake_ec2_instance_type_info, content):
+    from SlurmPlugin import SlurmPlugin
+    (slurm_config_file, instance_type_info_file) = slurm_plugin_config
+    instance_type_info_file.write_text(content)
+    plugin = SlurmPlugin(slurm_config_file)
+    with pytest.raises(ValueError):
+        plugin.get_instance_type_and_family_info(offline=True)
+    assert fake_ec2_instance_type_info == []
+    plugin.get_instance_type_and_family_info()
+    assert plugin.instance_type_and_family_info == INSTANCE_TYPE_INFO
+    assert fake_ec2_instance_type_info == [['us-east-1']]
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+from os.path import abspath, dirname
+import pytest
+import sys
+
+REPO_DIR = abspath(f"{dirname(__file__)}/..")
+sys.path.insert(0, f"{REPO_DIR}/source/slurm_installer")
+
+from security_group_rules import CidrTrie, PortRanges, SecurityGroupRules, port_ranges_cover
+
+# Security groups in the format returned by describe_security_groups
+DEFAULT_EGRESS = [
+    {
+        'IpProtocol': '-1',
+        'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+        'Ipv6Ranges': [],
+        'PrefixListIds': [],
+        'UserIdGroupPairs': []
+    }
+]
+
+def security_group(group_id, ingress=[], egress=DEFAULT_EGRESS):
+    return {
+        'GroupId': group_id,
+        'GroupName': group_id,
+        'VpcId': 'vpc-0123456789abcdef0',
+        'IpPermissions': ingress,
+        'IpPermissionsEgress': egress
+    }
+
+def group_permission(protocol, from_port, to_port, group_id):
+    return {
+        'IpProtocol': protocol,
+        'FromPort': from_port,
+        'ToPort': to_port,
+        'IpRanges': [],
+        'Ipv6Ranges': [],
+        'PrefixListIds': [],
+        'UserIdGroupPairs': [{'GroupId': group_id, 'UserId': '123456789012'}]
+    }
+
+def cidr_permission(protocol, from_port, to_port, cidrs=[], ipv6_cidrs=[]):
+    return {
+        'IpProtocol': protocol,
+        'FromPort': from_port,
+        'ToPort': to_port,
+        'IpRanges': [{'CidrIp': cidr} for cidr in cidrs],
+        'Ipv6Ranges': [{'CidrIpv6': cidr} for cidr in ipv6_cidrs],
+        'PrefixListIds': [],
+        'UserIdGroupPairs': []
+    }
+
+def test_port_ranges_merge():
+    port_ranges = PortRanges()
+    port_ranges.add(201, 300)
+    port_ranges.add(100, 200)
+    port_ranges.add(150, 160)
+    port_ranges.add(400, 500)
+    assert port_ranges.ranges() == [(100, 300), (400, 500)]
+
+    # Ranges added after a merge are merged with the existing ranges.
+    port_ranges.add(301, 399)
+    assert port_ranges.ranges() == [(100, 500)]
+
+def test_port_ranges_covers():
+    port_ranges = PortRanges()
+    port_ranges.add(100, 200)
+    port_ranges.add(300, 400)
+    assert port_ranges.covers(100, 200)
+    assert port_ranges.covers(150, 150)
+    assert port_ranges.covers(300, 400)
+    assert not port_ranges.covers(99, 100)
+    assert not port_ranges.covers(200, 201)
+    assert not port_ranges.covers(150, 350)
+    assert not port_ranges.covers(401, 401)
+    assert not PortRanges().covers(0, 0)
+
+def test_port_ranges_cover_union():
+    low = PortRanges()
+    low.add(100, 200)
+    high = PortRanges()
+    high.add(201, 300)
+    assert port_ranges_cover([low, high], 100, 300)
+    assert not port_ranges_cover([low, high], 100, 301)
+    assert not port_ranges_cover([low], 100, 300)
+    assert not port_ranges_cover([None, low], 100, 300)
+    assert not port_ranges_cover([], 100, 100)
+
+def test_cidr_trie_ipv4():
+    cidrs = CidrTrie()
+    cidrs.add('10.0.0.0/8', 22, 22)
+    cidrs.add('10.1.0.0/16', 443, 443)
+    cidrs.add('10.1.2.3/32', 80, 80)
+    # Host bits are ignored like they are by EC2.
+    cidrs.add('192.168.1.1/24', 53, 53)
+
+    def ranges(address):
+        return [port_ranges.ranges() for port_ranges in cidrs.lookup(address)]
+
+    assert ranges('10.2.0.1') == [[(22, 22)]]
+    assert ranges('10.1.0.1') == [[(22, 22)], [(443, 443)]]
+    assert ranges('10.1.2.3') == [[(22, 22)], [(443, 443)], [(80, 80)]]
+    assert ranges('10.1.0.0/16') == [[(22, 22)], [(443, 443)]]
+    # A network is only allowed by CIDRs that contain all of it.
+    assert ranges('10.0.0.0/7') == []
+    assert ranges('192.168.1.200') == [[(53, 53)]]
+    assert ranges('172.16.0.1') == []
+
+def test_cidr_trie_ipv6():
+    cidrs = CidrTrie()
+    cidrs.add('::/0', 22, 22)
+    cidrs.add('2001:db8::/32', 443, 443)
+    cidrs.add('0.0.0.0/0', 80, 80)
+
+    def ranges(address):
+        return [port_ranges.ranges() for port_ranges in cidrs.lookup(address)]
+
+    assert ranges('2001:db8::1') == [[(22, 22)], [(443, 443)]]
+    assert ranges('2001:db9::1') == [[(22, 22)]]
+    # IPv4 and IPv6 CIDRs don't match each other.
+    assert ranges('10.0.0.1') == [[(80, 80)]]
+
+def test_ports_split_across_rules():
+    sg_rules = SecurityGroupRules([
+        security_group('sg-a', ingress=[
+            group_permission('tcp', 100, 200, 'sg-b'),
+            group_permission('tcp', 201, 300, 'sg-b')
+        ])
+    ])
+    assert sg_rules.allows_ingress_from_security_group('sg-a', 'sg-b', 'tcp', 100, 300)
+    assert sg_rules.allows_ingress_from_security_group('sg-a', 'sg-b', 'tcp', 150, 250)
+    assert not sg_rules.allows_ingress_from_security_group('sg-a', 'sg-b', 'tcp', 100, 301)
+    assert not sg_rules.allows_ingress_from_security_group('sg-a', 'sg-b', 'udp', 100, 200)
+    assert not sg_rules.allows_ingress_from_security_group('sg-a', 'sg-c', 'tcp', 100, 200)
+
+def test_ports_split_across_groups_and_cidrs():
+    sg_rules = SecurityGroupRules([
+        security_group('sg-a', ingress=[
+            cidr_permission('tcp', 100, 200, cidrs=['10.0.0.0/8']),
+            group_permission('tcp', 1000, 2000, 'sg-c')
+        ]),
+        security_group('sg-b', ingress=[
+            cidr_permission('tcp', 201, 300, cidrs=['10.1.0.0/16']),
+            group_permission('tcp', 2001, 3000, 'sg-c')
+        ])
+    ])
+    # An instance with both security groups is allowed the union of their rules.
+    assert sg_rules.allows_ingress_from_address(['sg-a', 'sg-b'], '10.1.2.3', 'tcp', 100, 300)
+    assert not sg_rules.allows_ingress_from_address(['sg-a', 'sg-b'], '10.2.0.1', 'tcp', 100, 300)
+    assert not sg_rules.allows_ingress_from_address('sg-a', '10.1.2.3', 'tcp', 100, 300)
+    assert sg_rules.allows_ingress_from_security_group(['sg-a', 'sg-b'], 'sg-c', 'tcp', 1000, 3000)
+    assert not sg_rules.allows_ingress_from_security_group('sg-b', 'sg-c', 'tcp', 1000, 3000)
+
+def test_ipv6_ingress():
+    sg_rules = SecurityGroupRules([
+        security_group('sg-a', ingress=[
+            cidr_permission('tcp', 22, 22, ipv6_cidrs=['2001:db8::/32'])
+        ])
+    ])
+    assert sg_rules.allows_ingress_from_address('sg-a', '2001:db8::1', 'tcp', 22, 22)
+    assert not sg_rules.allows_ingress_from_address('sg-a', '2001:db9::1', 'tcp', 22, 22)
+    assert not sg_rules.allows_ingress_from_address('sg-a', '10.0.0.1', 'tcp', 22, 22)
+
+def test_all_protocols():
+    sg_rules = SecurityGroupRules([
+        security_group('sg-a', ingress=[
+            {
+                'IpProtocol': '-1',
+                'IpRanges': [],
+                'Ipv6Ranges': [],
+                'PrefixListIds': [],
+                'UserIdGroupPairs': [{'GroupId': 'sg-b', 'UserId': '123456789012'}]
+            }
+        ])
+    ])
+    assert sg_rules.allows_ingress_from_security_group('sg-a', 'sg-b', 'tcp', 0, 65535)
+    assert sg_rules.allows_ingress_from_security_group('sg-a', 'sg-b', 'udp', 53, 53)
+    assert sg_rules.allows_ingress_from_security_group('sg-a', 'sg-b', 'icmp', 0, 65535)
+    assert not sg_rules.allows_ingress_from_security_group('sg-a', 'sg-c', 'tcp', 22, 22)
+
+def test_icmp():
+    sg_rules = SecurityGroupRules([
+        security_group('sg-a', ingress=[
+            # All ICMP types and codes
+            cidr_permission('icmp', -1, -1, cidrs=['10.0.0.0/8']),
+            # describe_security_groups can return the protocol number
+            cidr_permission('58', -1, -1, ipv6_cidrs=['2001:db8::/32'])
+        ])
+    ])
+    assert sg_rules.allows_ingress_from_address('sg-a', '10.0.0.1', 'icmp', 0, 65535)
+    assert sg_rules.allows_ingress_from_address('sg-a', '10.0.0.1', '1', 8, 8)
+    assert sg_rules.allows_ingress_from_address('sg-a', '2001:db8::1', 'icmpv6', 128, 128)
+    assert not sg_rules.allows_ingress_from_address('sg-a', '10.0.0.1', 'tcp', 22, 22)
+    assert not sg_rules.allows_ingress_from_address('sg-a', '172.16.0.1', 'icmp', 8, 8)
+
+@pytest.mark.parametrize(
+    'scheduler_egress,compute_node_ingress,expected', [
+        # Default egress and ingress from the scheduler
+        (DEFAULT_EGRESS, [group_permission('tcp', 0, 65535, 'sg-scheduler')], True),
+        # Egress only to the compute node security group
+        ([group_permission('tcp', 0, 65535, 'sg-compute-node')], [group_permission('tcp', 0, 65535, 'sg-scheduler')], True),
+        # No ingress rule
+        (DEFAULT_EGRESS, [], False),
+        # Ingress doesn't cover all of the ports
+        (DEFAULT_EGRESS, [group_permission('tcp', 0, 1023, 'sg-scheduler')], False),
+        # No egress rule
+        ([], [group_permission('tcp', 0, 65535, 'sg-scheduler')], False),
+        # Egress to a different security group
+        ([group_permission('tcp', 0, 65535, 'sg-other')], [group_permission('tcp', 0, 65535, 'sg-scheduler')], False),
+    ]
+)
+def test_can_reach(scheduler_egress, compute_node_ingress, expected):
+    sg_rules = SecurityGroupRules([
+        security_group('sg-scheduler', egress=scheduler_egress),
+        security_group('sg-compute-node', ingress=compute_node_ingress)
+    ])
+    assert sg_rules.can_reach('sg-scheduler', 'sg-compute-node', 'tcp', 0, 65535) == expected
+    # Security groups are stateful so the reverse direction needs its own rules.
+    assert not sg_rules.can_reach('sg-compute-node', 'sg-scheduler', 'tcp', 0, 65535)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+from os.path import abspath, dirname
+import pytest
+import sys
+
+REPO_DIR = abspath(f"{dirname(__file__)}/..")
+sys.path.insert(0, f"{REPO_DIR}/source/cdk")
+
+from slurm_conf import compress_hostlist, expand_hostlist, get_onprem_compute_node_settings
+
+ONPREM_NODES_CONF = '''#
+# ON PREMISES COMPUTE NODES
+#
+NodeName=Default State=DOWN
+
+NodeName=onprem-c7-x86-t3-2xl-0 NodeAddr=onprem-c7-x86-t3-2xl-0.onprem.com  CPUs=4  RealMemory=30512   Feature=c7,CentOS_7_x86_64,x86_64,GHz:2.5 Weight=1
+NodeName=onprem-c7-x86-t3-2xl-1 NodeAddr=onprem-c7-x86-t3-2xl-1.onprem.com  CPUs=4  RealMemory=30512   Feature=c7,CentOS_7_x86_64,x86_64,GHz:2.5 Weight=1
+NodeName=onprem-c7-x86-t3-2xl-2 NodeAddr=onprem-c7-x86-t3-2xl-2.onprem.com  CPUs=4  RealMemory=30512   Feature=c7,CentOS_7_x86_64,x86_64,GHz:2.5 Weight=1
+NodeName=onprem-big-[0001-2000] CPUs=64 RealMemory=512000 # Big nodes
+
+PartitionName=onprem Default=YES PriorityTier=20000 Nodes=\\
+onprem-c7-x86-t3-2xl-0,onprem-c7-x86-t3-2xl-1,onprem-c7-x86-t3-2xl-2
+
+SuspendExcParts=onprem
+'''
+
+def test_compress_hostlist():
+    assert compress_hostlist(['node3', 'node1', 'node2', 'node5']) == 'node[1-3,5]'
+    assert compress_hostlist(['node0001', 'node0002', 'node0003']) == 'node[0001-0003]'
+    assert compress_hostlist(['a1', 'b2', 'c']) == 'a1,b2,c'
+    assert compress_hostlist(['node9', 'node10']) == 'node[9-10]'
+
+def test_expand_hostlist():
+    assert expand_hostlist('node[0008-0010,0012],login') == ['node0008', 'node0009', 'node0010', 'node0012', 'login']
+    hostnames = [f"node{index:04d}" for index in range(1, 2001)]
+    assert expand_hostlist(compress_hostlist(hostnames)) == hostnames
+
+def test_onprem_compute_node_settings(tmp_path):
+    config_file = tmp_path / 'slurm_nodes_on_prem.conf'
+    config_file.write_text(ONPREM_NODES_CONF)
+    settings = get_onprem_compute_node_settings(str(config_file), 'onprem')
+    assert settings == [
+        {
+            'NodeName': 'onprem-c7-x86-t3-2xl-[0-2]',
+            'NodeAddr': 'onprem-c7-x86-t3-2xl-0.onprem.com,onprem-c7-x86-t3-2xl-1.onprem.com,onprem-c7-x86-t3-2xl-2.onprem.com',
+            'CPUs': '4',
+            'Feature': 'c7,CentOS_7_x86_64,x86_64,GHz:2.5',
+            'RealMemory': '30512',
+            'State': 'DOWN',
+            'Weight': '1',
+        },
+        {
+            'NodeName': 'onprem-big-[0001-2000]',
+            'CPUs': '64',
+            'RealMemory': '512000',
+            'State': 'DOWN',
+        },
+        {
+            'NodeSet': 'onprem_nodes',
+            'Nodes': 'onprem-big-[0001-2000],onprem-c7-x86-t3-2xl-[0-2]',
+        },
+        {
+            'PartitionName': 'onprem',
+            'Default': 'YES',
+            'PriorityTier': '20000',
+            'Nodes': 'onprem-c7-x86-t3-2xl-[0-2]',
+        },
+        {
+            'SuspendExcParts': 'onprem',
+        },
+    ]
+
+def test_onprem_compute_node_settings_duplicate_node(tmp_path):
+    config_file = tmp_path / 'slurm_nodes_on_prem.conf'
+    config_file.write_text('NodeName=node[1-3] CPUs=4\nNodeName=node3 CPUs=8\n')
+    with pytest.raises(ValueError):
+        get_onprem_compute_node_settings(str(config_file), 'onprem')
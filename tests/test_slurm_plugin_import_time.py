@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+from os import environ
+from os.path import abspath, dirname
+import pytest
+import subprocess
+from subprocess import check_output
+import sys
+
+REPO_DIR = abspath(f"{dirname(__file__)}/..")
+
+pytest.importorskip('botocore')
+
+# SlurmPlugin is imported by short lived scripts so its import time is on their critical path.
+# Override with SLURM_PLUGIN_IMPORT_TIME_BUDGET on slow hosts.
+IMPORT_TIME_BUDGET = float(environ.get('SLURM_PLUGIN_IMPORT_TIME_BUDGET', 0.5))
+
+RUNS = 5
+
+def get_import_time():
+    '''
+    Import SlurmPlugin in a new interpreter and return the time in seconds.
+
+    The time is measured in the child so that interpreter startup isn't included.
+    '''
+    code = "import time; t = time.perf_counter(); import SlurmPlugin; print(time.perf_counter() - t)"
+    output = check_output([sys.executable, '-c', code], cwd=f"{REPO_DIR}/source", stderr=subprocess.STDOUT, encoding='utf8')
+    return float(output.split()[-1])
+
+def test_slurm_plugin_import_time():
+    # Use the best run so that a cold file cache doesn't cause failures.
+    import_times = sorted(get_import_time() for run in range(RUNS))
+    print(f"SlurmPlugin import times: {', '.join(f'{t:.3f}' for t in import_times)}s budget: {IMPORT_TIME_BUDGET}s")
+    assert import_times[0] < IMPORT_TIME_BUDGET